@@ -0,0 +1,286 @@
+'''
+    afpacket.py
+    Backend de recepción y envío de tramas mediante un socket AF_PACKET con anillos mapeados en memoria
+    (PACKET_RX_RING/PACKET_TX_RING, TPACKET_V3). Ofrece las mismas operaciones que rc1_pcap usa el nivel Ethernet
+    (abrir, bucle de recepción con callback, breakloop, inject y cerrar) sin pasar por libpcap.
+    Las tramas recibidas se entregan como memoryview sobre el anillo: solo son válidas mientras dura la llamada
+    a la función de callback.
+'''
+
+from rc1_pcap import pcap_pkthdr, timeval
+import ctypes
+import socket
+import struct
+import mmap
+import select
+import time
+import threading
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_TX_RING = 13
+TPACKET_V3 = 2
+ETH_P_ALL = 0x0003
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_WRONG_FORMAT = 4
+
+#Valores por defecto de los anillos: bloques de 1 MiB con huecos de 2 KiB (caben tramas de hasta ETH_FRAME_MAX)
+RING_BLOCK_SIZE = 1 << 20
+RING_BLOCK_NR = 16
+RING_FRAME_SIZE = 1 << 11
+#Tiempo (ms) tras el que el núcleo entrega un bloque aunque no esté lleno
+RING_BLOCK_TIMEOUT = 10
+TX_BLOCK_NR = 2
+
+#struct tpacket_req3: block_size, block_nr, frame_size, frame_nr, retire_blk_tov, sizeof_priv, feature_req_word
+tpacket_req3 = struct.Struct('IIIIIII')
+#struct tpacket_block_desc: version, offset_to_priv y tpacket_hdr_v1 (block_status, num_pkts, offset_to_first_pkt)
+BLOCK_STATUS_OFF = 8
+block_desc = struct.Struct('III')
+#struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac
+tpacket3_hdr = struct.Struct('IIIIIIH')
+TP_STATUS_OFF = 20
+SO_ATTACH_FILTER = 26
+#struct sock_fprog: número de instrucciones y puntero a las instrucciones BPF (8 bytes cada una)
+sock_fprog = struct.Struct('HxxxxxxP')
+#En envío los datos van tras la cabecera tpacket3_hdr alineada (TPACKET3_HDRLEN - sizeof(struct sockaddr_ll))
+TX_DATA_OFF = 48
+u32 = struct.Struct('I')
+
+
+class afpacket_t():
+    def __init__(self,sock,mm,rx_block_size,rx_block_nr,tx_offset,tx_frame_size,tx_frame_nr):
+        self.sock = sock
+        self.mm = mm
+        self.view = memoryview(mm)
+        self.rx_block_size = rx_block_size
+        self.rx_block_nr = rx_block_nr
+        self.rx_block = 0
+        self.tx_offset = tx_offset
+        self.tx_frame_size = tx_frame_size
+        self.tx_frame_nr = tx_frame_nr
+        self.tx_frame = 0
+        self.tx_lock = threading.Lock()
+        self.poll = select.poll()
+        self.poll.register(sock.fileno(),select.POLLIN | select.POLLERR)
+        self.breakloop = False
+
+
+def afpacket_open(interface,errbuf,block_size=RING_BLOCK_SIZE,block_nr=RING_BLOCK_NR,frame_size=RING_FRAME_SIZE,tx=True):
+    '''
+        Nombre: afpacket_open
+        Descripción: Abre un socket AF_PACKET sobre la interfaz con un anillo de recepción TPACKET_V3 y, opcionalmente,
+            uno de envío, y los mapea en memoria.
+        Argumentos:
+            -interface: nombre de la interfaz
+            -errbuf: bytearray donde se añade el mensaje de error si lo hay
+            -block_size: tamaño de cada bloque del anillo de recepción (múltiplo del tamaño de página)
+            -block_nr: número de bloques del anillo de recepción
+            -frame_size: tamaño de cada hueco de trama del anillo de envío
+            -tx: si es True se crea también el anillo de envío
+        Retorno: Manejador afpacket_t o None en caso de error
+    '''
+    sock = None
+    try:
+        sock = socket.socket(socket.AF_PACKET,socket.SOCK_RAW,socket.htons(ETH_P_ALL))
+        sock.setsockopt(SOL_PACKET,PACKET_VERSION,TPACKET_V3)
+        sock.setsockopt(SOL_PACKET,PACKET_RX_RING,tpacket_req3.pack(block_size,block_nr,frame_size,
+            (block_size//frame_size)*block_nr,RING_BLOCK_TIMEOUT,0,0))
+        tx_frame_nr = 0
+        if tx:
+            tx_frame_nr = (block_size//frame_size)*TX_BLOCK_NR
+            sock.setsockopt(SOL_PACKET,PACKET_TX_RING,tpacket_req3.pack(block_size,TX_BLOCK_NR,frame_size,
+                tx_frame_nr,0,0,0))
+        sock.bind((interface,ETH_P_ALL))
+        rx_size = block_size*block_nr
+        tx_size = block_size*TX_BLOCK_NR if tx else 0
+        mm = mmap.mmap(sock.fileno(),rx_size+tx_size,mmap.MAP_SHARED,mmap.PROT_READ | mmap.PROT_WRITE)
+    except OSError as e:
+        if sock is not None:
+            sock.close()
+        errbuf.extend(bytes(str(e),'utf-8'))
+        return None
+    return afpacket_t(sock,mm,block_size,block_nr,rx_size,frame_size,tx_frame_nr)
+
+
+def afpacket_loop(ring,cnt,callback_fun,user,to_ms=100):
+    '''
+        Nombre: afpacket_loop
+        Descripción: Equivalente a pcap_loop. Recorre los bloques del anillo de recepción según el núcleo los va
+            entregando y llama a callback_fun(user,header,data) por cada trama, con data un memoryview sobre el anillo.
+            Cada bloque se devuelve al núcleo tras procesar todas sus tramas.
+        Argumentos:
+            -ring: manejador afpacket_t
+            -cnt: número de tramas a procesar (-1 para infinitas)
+            -callback_fun: función de callback con el prototipo de pcap_loop
+            -user: datos de usuario
+            -to_ms: tiempo máximo de espera en poll antes de volver a comprobar breakloop
+        Retorno: 0 si se ha alcanzado cnt, -2 si se ha llamado a afpacket_breakloop
+    '''
+    ring.breakloop = False
+    mm = ring.mm
+    view = ring.view
+    n = 0
+    while True:
+        base = ring.rx_block*ring.rx_block_size
+        status,num_pkts,off = block_desc.unpack_from(mm,base+BLOCK_STATUS_OFF)
+        if not status & TP_STATUS_USER:
+            if ring.breakloop:
+                ring.breakloop = False
+                return -2
+            ring.poll.poll(to_ms)
+            continue
+        pos = base+off
+        for i in range(num_pkts):
+            next_off,tp_sec,tp_nsec,snaplen,length,tp_status,tp_mac = tpacket3_hdr.unpack_from(mm,pos)
+            header = pcap_pkthdr()
+            header.len = length
+            header.caplen = snaplen
+            header.ts = timeval(tp_sec,tp_nsec//1000)
+            callback_fun(user,header,view[pos+tp_mac:pos+tp_mac+snaplen])
+            pos += next_off
+        n += num_pkts
+        u32.pack_into(mm,base+BLOCK_STATUS_OFF,TP_STATUS_KERNEL)
+        ring.rx_block = (ring.rx_block+1) % ring.rx_block_nr
+        if cnt > 0 and n >= cnt:
+            return 0
+        if ring.breakloop:
+            ring.breakloop = False
+            return -2
+
+
+def afpacket_breakloop(ring):
+    '''
+        Nombre: afpacket_breakloop
+        Descripción: Equivalente a pcap_breakloop. afpacket_loop termina como mucho to_ms después
+        Argumentos:
+            -ring: manejador afpacket_t
+        Retorno: Ninguno
+    '''
+    ring.breakloop = True
+
+
+def afpacket_inject(ring,buf,size):
+    '''
+        Nombre: afpacket_inject
+        Descripción: Equivalente a pcap_inject. Copia la trama en el siguiente hueco libre del anillo de envío,
+            lo marca como listo para enviar y avisa al núcleo.
+        Argumentos:
+            -ring: manejador afpacket_t
+            -buf: bytes con la trama Ethernet completa
+            -size: número de bytes de buf a enviar
+        Retorno: Número de bytes enviados o -1 en caso de error
+    '''
+    if ring.tx_frame_nr == 0 or size > ring.tx_frame_size-TX_DATA_OFF:
+        return -1
+    with ring.tx_lock:
+        pos = ring.tx_offset+ring.tx_frame*ring.tx_frame_size
+        #Si el hueco sigue ocupado esperamos a que el núcleo lo libere
+        for i in range(1000):
+            if u32.unpack_from(ring.mm,pos+TP_STATUS_OFF)[0] in (TP_STATUS_AVAILABLE,TP_STATUS_WRONG_FORMAT):
+                break
+            time.sleep(0.0001)
+        else:
+            return -1
+        ring.view[pos+TX_DATA_OFF:pos+TX_DATA_OFF+size] = buf[:size]
+        u32.pack_into(ring.mm,pos+16,size)
+        u32.pack_into(ring.mm,pos+12,size)
+        u32.pack_into(ring.mm,pos+TP_STATUS_OFF,TP_STATUS_SEND_REQUEST)
+        ring.tx_frame = (ring.tx_frame+1) % ring.tx_frame_nr
+        try:
+            ring.sock.send(b'',socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass
+        except OSError:
+            return -1
+    return size
+
+
+def afpacket_setfilter(ring,insns):
+    '''
+        Nombre: afpacket_setfilter
+        Descripción: Instala en el socket un filtro BPF clásico (el núcleo copia el programa, así que insns puede liberarse
+            después). Las tramas que no pasan el filtro no llegan al anillo de recepción.
+        Argumentos:
+            -ring: manejador afpacket_t
+            -insns: bytes con las instrucciones BPF (por ejemplo las compiladas con pcap_compile)
+        Retorno: 0 si todo es correcto, -1 en caso de error
+    '''
+    buf = ctypes.create_string_buffer(bytes(insns),len(insns))
+    try:
+        ring.sock.setsockopt(socket.SOL_SOCKET,SO_ATTACH_FILTER,sock_fprog.pack(len(insns)//8,ctypes.addressof(buf)))
+    except OSError:
+        return -1
+    return 0
+
+
+def afpacket_close(ring):
+    '''
+        Nombre: afpacket_close
+        Descripción: Equivalente a pcap_close. Libera los anillos y cierra el socket
+        Argumentos:
+            -ring: manejador afpacket_t
+        Retorno: Ninguno
+    '''
+    ring.view.release()
+    try:
+        ring.mm.close()
+    except BufferError:
+        pass
+    ring.sock.close()
+
+
+if __name__ == "__main__":
+    #Prueba de rendimiento: un hilo envía tramas de prueba por la interfaz tan rápido como puede mientras se cuentan
+    #las tramas recibidas durante unos segundos con libpcap (pcap_loop) y con el anillo AF_PACKET.
+    #Ejemplo: sudo python3 afpacket.py --itf lo --seconds 5
+    import argparse
+    import rc1_pcap
+    parser = argparse.ArgumentParser(description='Compara los paquetes por segundo recibidos con libpcap y con AF_PACKET TPACKET_V3')
+    parser.add_argument('--itf', dest='interface', default='lo',help='Interfaz a usar (lo o un extremo de un par veth)')
+    parser.add_argument('--seconds', dest='seconds', type=float, default=3,help='Duración de cada medida')
+    args = parser.parse_args()
+
+    #Trama de prueba con un ethertype experimental para no interferir con otros protocolos
+    frame = bytes([0xFF]*6) + bytes([0x02,0,0,0,0,1]) + b'\x88\xb5' + bytes(46)
+    def sender(stop):
+        s = socket.socket(socket.AF_PACKET,socket.SOCK_RAW)
+        s.bind((args.interface,0))
+        while not stop.is_set():
+            try:
+                s.send(frame)
+            except OSError:
+                pass
+        s.close()
+
+    def measure(name,start,loop,breakloop,close):
+        count = [0]
+        def cb(us,header,data):
+            count[0] += 1
+        handle = start()
+        if handle is None:
+            print('{}: no se pudo abrir la interfaz'.format(name))
+            return
+        stop = threading.Event()
+        tx = threading.Thread(target=sender,args=(stop,))
+        tx.daemon = True
+        tx.start()
+        threading.Timer(args.seconds,breakloop,(handle,)).start()
+        t = time.time()
+        loop(handle,-1,cb,None)
+        t = time.time()-t
+        stop.set()
+        tx.join()
+        close(handle)
+        print('{}: {} tramas en {:.2f} s -> {:.0f} pps'.format(name,count[0],t,count[0]/t))
+
+    errbuf = bytearray()
+    measure('libpcap',lambda: rc1_pcap.pcap_open_live(args.interface,1514,1,10,errbuf),
+        rc1_pcap.pcap_loop,rc1_pcap.pcap_breakloop,rc1_pcap.pcap_close)
+    measure('AF_PACKET TPACKET_V3',lambda: afpacket_open(args.interface,errbuf),
+        afpacket_loop,afpacket_breakloop,afpacket_close)
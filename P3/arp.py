@@ -10,12 +10,16 @@ import socket
 import struct
 import fcntl
 import time
+import asyncio
+import threading
+import queue
+import os
 from threading import Lock
-from expiringdict import ExpiringDict
+from collections import OrderedDict
 from time import sleep
 import pdb
 
-#Semáforo global
+#Semáforo global. Protege la tabla de resoluciones pendientes
 globalLock =Lock()
 #Dirección de difusión (Broadcast)
 broadcastAddr = bytes([0xFF]*6)
@@ -24,17 +28,266 @@ ARPHeader = bytes([0x00,0x01,0x08,0x00,0x06,0x04])
 #longitud (en bytes) de la cabecera común ARP
 ARP_HLEN = 6
 
-#Variable que alamacenará que dirección IP se está intentando resolver
-requestedIP = None
-#Variable que alamacenará que dirección MAC resuelta o None si no se ha podido obtener
-resolvedMAC = None
-#Variable que alamacenará True mientras estemos esperando una respuesta ARP
-awaitingResponse = False
+#IP (bytes), MAC y máscara de red (entero de 32 bits) propias. Se fijan en initARP
+myIP = None
+myMAC = None
+myNetmask = 0
+#Aprendizaje de vecinos a partir de peticiones y anuncios gratuitos: tiempo (s) tras una confirmación durante el que no
+#se acepta otra MAC para la misma IP, y ritmo máximo (por segundo) y ráfaga de altas o cambios de MAC
+ARP_LOCKTIME = 1
+ARP_LEARN_RATE = 50
+ARP_LEARN_BURST = 100
+learnTokens = ARP_LEARN_BURST
+learnLast = 0
+arpLearnStats = {'learned':0,'updated':0,'spoofed':0,'ratelimited':0,'conflicts':0}
+#Número de peticiones ARP por resolución y tiempo (en segundos) a esperar respuesta tras la primera. Cada reintento
+#espera ARP_BACKOFF veces más que el anterior, hasta un máximo de ARP_TIMEOUT_MAX
+ARP_RETRIES = 3
+ARP_TIMEOUT = 0.05
+ARP_BACKOFF = 2
+ARP_TIMEOUT_MAX = 1.0
+#Estadísticas de resolución: contadores y últimos ARP_LATENCY_SAMPLES tiempos de resolución (en segundos)
+ARP_LATENCY_SAMPLES = 1024
+arpStats = {'resolved':0,'failed':0,'requests':0}
+arpLatencies = []
+statsLock = Lock()
+#Resoluciones en curso. Diccionario IP (entero de 32 bits) -> arpPending_t compartido por todos los que esperan esa IP
+pendingResolutions = {}
+#Hilo que envía las peticiones de refresco de la caché de vecinos
+refreshThread = None
+#Datagramas en espera de que se resuelva la MAC de su siguiente salto. Diccionario IP (entero de 32 bits) -> lista de
+#(datagramas, Ethertype), protegido con globalLock. Como mucho ARP_QUEUE_LEN envíos por vecino
+pendingPackets = {}
+ARP_QUEUE_LEN = 256
+#Fichero en el que se guarda la caché de vecinos al parar el nivel Ethernet (None para no guardarla) y antigüedad
+#máxima (s) de las entradas que se cargan de él
+arpSnapshotFile = None
+ARP_SNAPSHOT_MAX_AGE = 3600
+#Formato del fichero: ARP_SNAPSHOT_MAGIC seguido de un registro por entrada con IP, MAC y fecha de la última confirmación
+ARP_SNAPSHOT_MAGIC = b'ARPC\x01'
+ARPSnapshotRecord = struct.Struct('!I6sd')
+arpQueueStats = {'queued':0,'flushed':0,'overflow':0,'timeout':0}
+
+#Estados de las entradas de la caché de vecinos (como en Linux)
+NUD_REACHABLE = 'REACHABLE'
+NUD_STALE = 'STALE'
+NUD_PROBE = 'PROBE'
+#Número máximo de entradas de la caché de vecinos y número de particiones (cada una con su propio Lock)
+NEIGH_CAPACITY = 4096
+NEIGH_STRIPES = 16
+#Tiempo (s) que una entrada es REACHABLE tras confirmarse y tiempo adicional que se conserva como STALE
+NEIGH_REACHABLE_TIME = 30
+NEIGH_STALE_TIME = 60
+#Antelación (s) con la que se refresca una entrada REACHABLE que se está usando antes de que pase a STALE
+NEIGH_REFRESH_TIME = 5
+#Peticiones unicast de refresco y tiempo (s) de espera entre ellas antes de dar la entrada por perdida
+NEIGH_PROBES = 3
+NEIGH_PROBE_TIME = 1
+#Resoluciones asíncronas en curso. Diccionario IP (entero de 32 bits) -> asyncio.Future con la MAC resuelta
+pendingFutures = {}
+
+
+
+class arpPending_t():
+    def __init__(self):
+        #Se activa al recibir la respuesta o al abandonar la resolución
+        self.event = threading.Event()
+        self.mac = None
+        #Instante (time.monotonic) en que llegó la respuesta
+        self.when = None
+
+
+class neighbour_t():
+    def __init__(self,mac,now):
+        self.mac = mac
+        self.state = NUD_REACHABLE
+        #Instante (time.monotonic) de la última confirmación, del último uso y de la última petición de refresco
+        self.confirmed = now
+        #Instante del último cambio de MAC (ARP_LOCKTIME se cuenta desde aquí)
+        self.changed = now
+        self.used = now
+        self.probed = 0
+        self.probes = 0
+
+
+class neighbourCache_t():
+    '''
+        Caché de vecinos: IP (entero de 32 bits) -> neighbour_t. Las entradas se reparten en particiones según la IP, cada
+        una con su propio Lock y su orden LRU, para que las consultas desde varios hilos no compitan por un único Lock.
+        Una entrada confirmada es REACHABLE durante reachable segundos y después STALE durante stale segundos más; en
+        ambos estados se devuelve su MAC sin bloquear. Cuando una entrada usada va a caducar, o se usa estando STALE,
+        pasa a PROBE y se pide su refresco con una petición unicast (la envía el hilo de refresco de initARP).
+    '''
+    def __init__(self,capacity=NEIGH_CAPACITY,stripes=NEIGH_STRIPES,reachable=NEIGH_REACHABLE_TIME,stale=NEIGH_STALE_TIME):
+        self.stripes = [OrderedDict() for i in range(stripes)]
+        self.locks = [Lock() for i in range(stripes)]
+        self.capacity = max(1,-(-capacity//stripes))
+        self.reachable = reachable
+        self.stale = stale
+        #IPs cuyo refresco hay que pedir
+        self.refresh = queue.Queue()
+
+    def lookup(self,ip):
+        '''
+            Nombre: lookup
+            Descripción: Devuelve la MAC de ip si está en caché, actualizando su estado y su posición LRU
+            Argumentos:
+                -ip: entero de 32 bits con la IP
+            Retorno: MAC o None si no está o ha caducado
+        '''
+        n = ip % len(self.stripes)
+        now = time.monotonic()
+        with self.locks[n]:
+            tabla = self.stripes[n]
+            entrada = tabla.get(ip)
+            if entrada is None:
+                return None
+            edad = now-entrada.confirmed
+            if edad >= self.reachable+self.stale or (entrada.state == NUD_PROBE and entrada.probes >= NEIGH_PROBES and
+                    now-entrada.probed >= NEIGH_PROBE_TIME):
+                del tabla[ip]
+                return None
+            if entrada.state == NUD_REACHABLE and edad >= self.reachable:
+                entrada.state = NUD_STALE
+            if entrada.state == NUD_STALE or (entrada.state == NUD_REACHABLE and edad >= self.reachable-NEIGH_REFRESH_TIME):
+                entrada.state = NUD_PROBE
+                entrada.probes = 0
+            if entrada.state == NUD_PROBE and entrada.probes < NEIGH_PROBES and now-entrada.probed >= NEIGH_PROBE_TIME:
+                entrada.probes += 1
+                entrada.probed = now
+                self.refresh.put((ip,entrada.mac))
+            entrada.used = now
+            tabla.move_to_end(ip)
+            return entrada.mac
+
+    def confirm(self,ip,mac):
+        '''
+            Nombre: confirm
+            Descripción: Añade o confirma la asociación ip -> mac y la marca como REACHABLE. Si la partición está llena se
+                descarta la entrada usada hace más tiempo
+            Argumentos:
+                -ip: entero de 32 bits con la IP
+                -mac: bytes con la MAC
+            Retorno: Ninguno
+        '''
+        n = ip % len(self.stripes)
+        now = time.monotonic()
+        with self.locks[n]:
+            tabla = self.stripes[n]
+            entrada = tabla.get(ip)
+            if entrada is None:
+                tabla[ip] = neighbour_t(mac,now)
+                if len(tabla) > self.capacity:
+                    tabla.popitem(last=False)
+                return
+            if entrada.mac != mac:
+                entrada.mac = mac
+                entrada.changed = now
+            entrada.state = NUD_REACHABLE
+            entrada.confirmed = now
+            entrada.probes = 0
+
+    def load(self,ip,mac):
+        '''
+            Nombre: load
+            Descripción: Añade una entrada sin confirmar (por ejemplo cargada de disco) en estado STALE: se usa su MAC sin
+                bloquear y se revalida con una petición unicast la primera vez que se use. Si ya hay una entrada para ip
+                no se modifica
+            Argumentos:
+                -ip: entero de 32 bits con la IP
+                -mac: bytes con la MAC
+            Retorno: Ninguno
+        '''
+        n = ip % len(self.stripes)
+        now = time.monotonic()
+        with self.locks[n]:
+            tabla = self.stripes[n]
+            if ip in tabla or len(tabla) >= self.capacity:
+                return
+            entrada = neighbour_t(mac,now-self.reachable)
+            entrada.state = NUD_STALE
+            entrada.changed = 0
+            tabla[ip] = entrada
+
+    def learn(self,ip,mac):
+        '''
+            Nombre: learn
+            Descripción: Añade o cambia la MAC de una entrada aprendida sin confirmación, en estado STALE
+            Argumentos:
+                -ip: entero de 32 bits con la IP
+                -mac: bytes con la MAC
+            Retorno: Ninguno
+        '''
+        n = ip % len(self.stripes)
+        now = time.monotonic()
+        with self.locks[n]:
+            tabla = self.stripes[n]
+            entrada = tabla.get(ip)
+            if entrada is None:
+                entrada = tabla[ip] = neighbour_t(mac,now)
+                if len(tabla) > self.capacity:
+                    tabla.popitem(last=False)
+            elif entrada.mac != mac:
+                entrada.mac = mac
+                entrada.changed = now
+            entrada.state = NUD_STALE
+            entrada.confirmed = now-self.reachable
+            entrada.probes = 0
+
+    def peek(self,ip):
+        '''
+            Nombre: peek
+            Descripción: Devuelve la entrada de ip sin modificar su estado ni su posición LRU
+            Argumentos:
+                -ip: entero de 32 bits con la IP
+            Retorno: neighbour_t o None
+        '''
+        n = ip % len(self.stripes)
+        with self.locks[n]:
+            return self.stripes[n].get(ip)
+
+    def contains(self,ip):
+        '''
+            Nombre: contains
+            Descripción: Indica si hay una entrada para ip, sin modificar su estado
+            Argumentos:
+                -ip: entero de 32 bits con la IP
+            Retorno: True o False
+        '''
+        n = ip % len(self.stripes)
+        with self.locks[n]:
+            return ip in self.stripes[n]
+
+    def delete(self,ip):
+        n = ip % len(self.stripes)
+        with self.locks[n]:
+            self.stripes[n].pop(ip,None)
+
+    def clear(self):
+        for n in range(len(self.stripes)):
+            with self.locks[n]:
+                self.stripes[n].clear()
+
+    def items(self):
+        '''
+            Nombre: items
+            Descripción: Devuelve una copia de las entradas de la caché
+            Argumentos: Ninguno
+            Retorno: Lista de tuplas (IP, neighbour_t)
+        '''
+        entradas = []
+        for n in range(len(self.stripes)):
+            with self.locks[n]:
+                entradas.extend(self.stripes[n].items())
+        return entradas
+
+    def __len__(self):
+        return sum(len(tabla) for tabla in self.stripes)
+
+
+#Caché de ARP (caché de vecinos)
+cache = neighbourCache_t()
 
-#Variable para proteger la caché
-cacheLock = Lock()
-#Caché de ARP. Es un diccionario similar al estándar de Python solo que eliminará las entradas a los 10 segundos
-cache = ExpiringDict(max_len=100, max_age_seconds=10)
 
 hw_type = b'\x00\x01'
 protocol_type = b'\x08\x00'
@@ -49,14 +302,13 @@ def getIP(interface):
             -interface: nombre de la interfaz
         Retorno: Entero de 32 bits con la dirección IP de la interfaz
     '''
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    ip = fcntl.ioctl(
-        s.fileno(),
-        0x8915,  # SIOCGIFADDR
-        struct.pack('256s', (interface[:15].encode('utf-8')))
-    )[20:24]
-    s.close()
-    return struct.unpack('!I',ip)[0]
+    vif = getVirtualInterface(interface)
+    if vif is not None:
+        return vif.ip
+    info = getInterfaceInfo(interface)
+    if info is None:
+        return None
+    return info.ip
 
 def printCache():
     '''
@@ -65,11 +317,9 @@ def printCache():
         Argumentos: Ninguno
         Retorno: Ninguno
     '''
-    print('{:>12}\t\t{:>12}'.format('IP','MAC'))
-    with cacheLock:
-        for k in cache:
-            if k in cache:
-                print ('{:>12}\t\t{:>12}'.format(socket.inet_ntoa(struct.pack('!I',k)),':'.join(['{:02X}'.format(b) for b in cache[k]])))
+    print('{:>12}\t\t{:>12}\t\t{:>12}'.format('IP','MAC','Estado'))
+    for k,entrada in cache.items():
+        print ('{:>12}\t\t{:>12}\t\t{:>12}'.format(socket.inet_ntoa(struct.pack('!I',k)),':'.join(['{:02X}'.format(b) for b in entrada.mac]),entrada.state))
 
 
 
@@ -81,6 +331,8 @@ def processARPRequest(data,MAC):
             -Si la MAC origen de la trama ARP no es la misma que la recibida del nivel Ethernet retornar
             -Extraer la IP origen contenida en la petición ARP
             -Extraer la IP destino contenida en la petición ARP
+            -Si la petición es para la propia IP o es un anuncio gratuito (IP origen igual a IP destino), aprender la
+            asociación IP/MAC del emisor con learnNeighbour
             -Comprobar si la IP destino de la petición ARP es la propia IP:
                 -Si no es la propia IP retornar
                 -Si es la propia IP:
@@ -102,7 +354,11 @@ def processARPRequest(data,MAC):
     senderIP = data[14: 18]    #IP origen
     targetIP = data[24: 28]
 
-    if bytes(targetIP) == myIP:                                #si esta ip es el destinatario del arp_request -> somos el equipo que contesta
+    if bytes(targetIP) == myIP or senderIP == targetIP:
+        #Aprendemos al emisor de las peticiones para nosotros y actualizamos con los anuncios gratuitos
+        learnNeighbour(senderIP,senderEth,bytes(targetIP) == myIP and senderIP != targetIP)
+
+    if bytes(targetIP) == myIP and senderIP != targetIP:      #si esta ip es el destinatario del arp_request -> somos el equipo que contesta
         arp_reply = createARPReply(senderIP, senderEth)             #enviamos una respuesta con el MAC del que nos envia y su ip
         if sendEthernetFrame(arp_reply, len(data), b'\x08\x06', senderEth) == goodeth_frame: #enviamos la trama arp con toda la informacion
             logging.info("Trama ARPReply enviada correctamente")
@@ -123,18 +379,20 @@ def processARPReply(data,MAC):
             -Comprobar si la IP destino de la petición ARP es la propia IP:
                 -Si no es la propia IP retornar
                 -Si es la propia IP:
-                    -Comprobar si la IP origen se corresponde con la solicitada (requestedIP). Si no se corresponde retornar
-                    -Copiar la MAC origen a la variable global resolvedMAC
+                    -Comprobar si hay una resolución pendiente para la IP origen en pendingResolutions (o pendingFutures)
+                    o si es la respuesta a un refresco de una entrada de la caché (estado PROBE). Si no es así retornar
+                    -Si la respuesta cambia la MAC de una entrada existente, aplicar las mismas reglas que learnNeighbour
+                    (ARP_LOCKTIME y límite de ritmo) con allowNeighbourChange
                     -Añadir a la caché ARP la asociación MAC/IP.
-                    -Cambiar el valor de la variable awaitingResponse a False
-                    -Cambiar el valor de la variable requestedIP a None
-        Las variables globales (requestedIP, awaitingResponse y resolvedMAC) son accedidas concurrentemente por la función ARPResolution y deben ser protegidas mediante un Lock.
+                    -Guardar la MAC en la resolución pendiente y despertar a todos los que la esperan
+            -Si es una respuesta gratuita (IP origen igual a IP destino) actualizar la entrada del emisor con learnNeighbour
+        La tabla pendingResolutions se accede concurrentemente desde ARPResolution y se protege con globalLock.
         Argumentos:
             -data: bytearray con el contenido de la trama ARP (después de la cabecera común)
             -MAC: dirección MAC origen extraída por el nivel Ethernet
         Retorno: Ninguno
     '''
-    global requestedIP,resolvedMAC,awaitingResponse,cache
+    global cache
 
     senderEth = data[8: 14]     #MAC origen
     if bytes(senderEth) != MAC:
@@ -145,21 +403,136 @@ def processARPReply(data,MAC):
     targetIP = data[24: 28]
 
     if bytes(targetIP) == myIP:                                #si esta ip es el destinatario del arp_request -> somos el equipo que contesta
-        if senderIP == requestedIP:                     #si nos esta contestando al que le hemos enviado request
-            globalLock.acquire()
-            resolvedMAC = senderEth                   #esta es la direccion MAC por la que preguntamos -> resolvedMAC
-            print("Entra en el lock de MAC")
-
-            cacheLock.acquire()
-            print("se ha resuelto la MAC ")
-
-            cache.update({struct.unpack('!I',senderIP)[0]:senderEth})
-            cacheLock.release()
-            awaitingResponse = False
-            requestedIP = None
-            globalLock.release()
+        ip = struct.unpack('!I',senderIP)[0]
+        mac = bytes(senderEth)
+        actual = cache.peek(ip)
+        if not isPending(ip) and (actual is None or actual.state != NUD_PROBE):     #no hemos preguntado por esta IP
+            return
+        if actual is not None and actual.mac != mac and not allowNeighbourChange(actual,time.monotonic()):
+            return
+        print("se ha resuelto la MAC ")
+        cache.confirm(ip,mac)
+        completeResolution(ip,mac)
+    elif senderIP == targetIP:                          #respuesta gratuita: solo actualiza entradas existentes
+        learnNeighbour(senderIP,senderEth,False)
     return
 
+
+def isPending(ip):
+    #Indica si hay una resolución síncrona o asíncrona en curso para ip
+    with globalLock:
+        return ip in pendingResolutions or ip in pendingFutures
+
+
+def completeResolution(ip,mac):
+    '''
+        Nombre: completeResolution
+        Descripción: Entrega la MAC de ip a las resoluciones en curso (síncronas y asíncronas) y envía los datagramas que
+            esperaban en su cola
+        Argumentos:
+            -ip: entero de 32 bits con la IP
+            -mac: bytes con la MAC
+        Retorno: Ninguno
+    '''
+    fut = pendingFutures.get(ip)
+    with globalLock:
+        pend = pendingResolutions.get(ip)
+    flushPendingPackets(ip,mac)
+    if pend is not None:
+        pend.mac = mac
+        pend.when = time.monotonic()
+        pend.event.set()
+    if fut is not None:
+        #Resolución asíncrona pendiente: se completa el futuro desde el hilo de su bucle de eventos
+        fut.get_loop().call_soon_threadsafe(_completeFuture,fut,mac)
+
+
+def learnNeighbour(senderIP,senderEth,create):
+    '''
+        Nombre: learnNeighbour
+        Descripción: Aprende la asociación IP/MAC del emisor de una petición o de un anuncio gratuito. Las entradas
+            aprendidas quedan en estado STALE (no hay confirmación de que el vecino nos alcance), así que se usan sin
+            bloquear y se revalidan al usarlas. Para evitar suplantaciones se descartan:
+                -IP origen la propia o fuera de nuestra red, y MAC origen de grupo o nula
+                -Cambios de MAC de una entrada cuya MAC cambió hace menos de ARP_LOCKTIME segundos, sea cual sea su estado
+                -Altas y cambios de MAC por encima de ARP_LEARN_RATE por segundo (ráfagas de hasta ARP_LEARN_BURST)
+            Las tramas enviadas por nosotros mismos (las entrega de vuelta la captura) y las sondas de RFC 5227 (IP origen
+            0.0.0.0) se ignoran sin contarlas como conflicto ni suplantación.
+        Argumentos:
+            -senderIP: bytes con la IP del emisor
+            -senderEth: bytes con la MAC del emisor
+            -create: True si se pueden crear entradas nuevas (peticiones dirigidas a nuestra IP), False si solo se
+            actualizan las existentes (anuncios gratuitos)
+        Retorno: True si se ha aprendido o actualizado la entrada, False en otro caso
+    '''
+    if myIP is None:
+        return False
+    ip = struct.unpack('!I',senderIP)[0]
+    mac = bytes(senderEth)
+    if mac == myMAC or ip == 0:
+        return False
+    propia = struct.unpack('!I',myIP)[0]
+    if ip == propia:
+        logging.warning("Otro equipo ({}) anuncia nuestra IP".format(':'.join(['{:02X}'.format(b) for b in mac])))
+        with statsLock:
+            arpLearnStats['conflicts'] += 1
+        return False
+    if mac[0] & 1 or mac == bytes(6) or (ip & myNetmask) != (propia & myNetmask):
+        with statsLock:
+            arpLearnStats['spoofed'] += 1
+        return False
+    actual = cache.peek(ip)
+    if actual is None and not create:
+        return False
+    if actual is not None and actual.mac == mac:
+        #Misma MAC: no cambia nada, pero puede haber quien la espere
+        completeResolution(ip,mac)
+        return True
+    if not allowNeighbourChange(actual,time.monotonic()):
+        return False
+    with statsLock:
+        arpLearnStats['learned' if actual is None else 'updated'] += 1
+    cache.learn(ip,mac)
+    completeResolution(ip,mac)
+    return True
+
+
+def allowNeighbourChange(actual,now):
+    '''
+        Nombre: allowNeighbourChange
+        Descripción: Decide si se puede dar de alta una entrada o cambiar su MAC sin que lo hayamos pedido: rechaza los
+            cambios antes de ARP_LOCKTIME segundos desde el último cambio de MAC de la entrada y aplica el límite de ritmo
+            (ARP_LEARN_RATE por segundo, ráfagas de hasta ARP_LEARN_BURST)
+        Argumentos:
+            -actual: neighbour_t existente o None si es un alta
+            -now: instante actual (time.monotonic)
+        Retorno: True si se permite el cambio, False si se descarta (y se cuenta en arpLearnStats)
+    '''
+    global learnTokens,learnLast
+    with statsLock:
+        if actual is not None and now-actual.changed < ARP_LOCKTIME:
+            arpLearnStats['spoofed'] += 1
+            return False
+        learnTokens = min(ARP_LEARN_BURST,learnTokens+(now-learnLast)*ARP_LEARN_RATE)
+        learnLast = now
+        if learnTokens < 1:
+            arpLearnStats['ratelimited'] += 1
+            return False
+        learnTokens -= 1
+        return True
+
+
+def getARPLearnStats():
+    '''
+        Nombre: getARPLearnStats
+        Descripción: Devuelve los contadores del aprendizaje de vecinos a partir de peticiones y anuncios gratuitos
+        Argumentos: Ninguno
+        Retorno: Diccionario con las entradas aprendidas, actualizadas, descartadas por posible suplantación, descartadas
+            por límite de ritmo y los conflictos con la IP propia
+    '''
+    with statsLock:
+        return dict(arpLearnStats)
+
 def createARPRequest(ip):
     '''
         Nombre: createARPRequest
@@ -227,6 +600,10 @@ def process_arp_frame(us,header,data,srcMac):
     '''
     #hw_type = 2 #los bytes que no cambian de una trama/ paquete de datos a otros
 
+    if myMAC is not None and bytes(srcMac) == myMAC:
+        #Trama enviada por nosotros que la captura nos devuelve (por ejemplo la petición ARP gratuita de initARP)
+        return
+
 
     if data[0:2] == hw_type and data[2:4] == protocol_type and data[4:5] == hw_size and data[5:6] == protocol_size:
         logging.info("cabecera de ARP correcta -> 6 primeros bytes")
@@ -240,34 +617,272 @@ def process_arp_frame(us,header,data,srcMac):
     else:
         return
 
-def initARP(interface):
+def initARP(interface,snapshot=None):
     '''
         Nombre: initARP
         Descripción: Esta función construirá inicializará el nivel ARP. Esta función debe realizar, al menos, las siguientes tareas:
             -Registrar la función del callback process_arp_frame con el Ethertype 0x0806
             -Obtener y almacenar la dirección MAC e IP asociadas a la interfaz especificada
             -Realizar una petición ARP gratuita y comprobar si la IP propia ya está asignada. En caso positivo se debe devolver error.
+            -Si se indica un fichero de caché, cargarlo (entradas en estado STALE) y guardarlo al parar el nivel Ethernet
             -Marcar la variable de nivel ARP inicializado a True
+        Argumentos:
+            -interface: nombre de la interfaz
+            -snapshot: fichero en el que se guarda la caché de vecinos entre ejecuciones o None
+        Retorno: True o False en función de si se ha inicializado el nivel o no
     '''
-    global myIP,myMAC,arpInitialized
+    global myIP,myMAC,myNetmask,arpInitialized,arpSnapshotFile
     registerCallback(process_arp_frame, b'\x08\x06')
 
     if interface is not None:
         myMAC = getHwAddr(interface)
         myIP = getIP(interface)
         myIP = (struct.pack("!I", myIP))
+        vif = getVirtualInterface(interface)
+        info = vif if vif is not None else getInterfaceInfo(interface)
+        myNetmask = info.netmask if info is not None and info.netmask is not None else 0
     else:
         return False
 
+    startNeighbourRefresh()
+
 
     if ARPResolution(myIP) is not None: #Si la peticion arp gratuita se contesta se determina que la ip ya esta asignada
         logging.error("arp gratuita realizada, error ip en uso")
         return False
 
+    if snapshot is not None:
+        arpSnapshotFile = snapshot
+        loadARPSnapshot(snapshot)
+        registerStopCallback(saveARPSnapshot)
+
     arpInitialized = True
     return True
 
-def ARPResolution(ip):
+def saveARPSnapshot(path=None):
+    '''
+        Nombre: saveARPSnapshot
+        Descripción: Guarda la caché de vecinos en un fichero (IP, MAC y fecha de la última confirmación de cada entrada).
+            Se escribe en un fichero temporal que luego se renombra, así que el fichero nunca queda a medias
+        Argumentos:
+            -path: fichero a escribir (arpSnapshotFile si es None)
+        Retorno: Número de entradas guardadas
+    '''
+    if path is None:
+        path = arpSnapshotFile
+    if path is None:
+        return 0
+    ahora = time.time()-time.monotonic()
+    registros = [ARPSnapshotRecord.pack(ip,entrada.mac,ahora+entrada.confirmed) for ip,entrada in cache.items()]
+    tmp = '{}.{}.tmp'.format(path,os.getpid())
+    with open(tmp,'wb') as f:
+        f.write(ARP_SNAPSHOT_MAGIC)
+        f.write(b''.join(registros))
+    os.replace(tmp,path)
+    return len(registros)
+
+
+def loadARPSnapshot(path):
+    '''
+        Nombre: loadARPSnapshot
+        Descripción: Carga en la caché de vecinos, en estado STALE, las entradas de un fichero guardado con saveARPSnapshot
+            que se confirmaron hace menos de ARP_SNAPSHOT_MAX_AGE segundos. Se ignoran la IP propia y los ficheros que no
+            existen o no tienen el formato esperado
+        Argumentos:
+            -path: fichero a leer
+        Retorno: Número de entradas cargadas
+    '''
+    try:
+        with open(path,'rb') as f:
+            data = f.read()
+    except OSError:
+        return 0
+    if not data.startswith(ARP_SNAPSHOT_MAGIC):
+        logging.error("{} no es un fichero de caché ARP".format(path))
+        return 0
+    limite = time.time()-ARP_SNAPSHOT_MAX_AGE
+    propia = struct.unpack('!I',myIP)[0] if myIP is not None else None
+    n = 0
+    fin = len(data)-(len(data)-len(ARP_SNAPSHOT_MAGIC)) % ARPSnapshotRecord.size
+    for ip,mac,confirmada in ARPSnapshotRecord.iter_unpack(memoryview(data)[len(ARP_SNAPSHOT_MAGIC):fin]):
+        if confirmada >= limite and ip != propia:
+            cache.load(ip,mac)
+            n += 1
+    return n
+
+
+def neighbourRefresh():
+    #Envía las peticiones unicast de refresco que pide la caché de vecinos
+    while True:
+        ip,mac = cache.refresh.get()
+        arp_request = createARPRequest(ip.to_bytes(4, byteorder='big'))
+        sendEthernetFrame(arp_request, len(arp_request), b'\x08\x06', mac)
+
+
+def startNeighbourRefresh():
+    '''
+        Nombre: startNeighbourRefresh
+        Descripción: Arranca (una sola vez) el hilo que refresca en segundo plano las entradas de la caché de vecinos
+        Argumentos: Ninguno
+        Retorno: Ninguno
+    '''
+    global refreshThread
+    with globalLock:
+        if refreshThread is not None:
+            return
+        refreshThread = threading.Thread(target=neighbourRefresh)
+        refreshThread.daemon = True
+        refreshThread.start()
+
+
+def flushPendingPackets(ip,mac):
+    '''
+        Nombre: flushPendingPackets
+        Descripción: Envía de una vez los datagramas que esperaban a que se resolviera la MAC de ip
+        Argumentos:
+            -ip: entero de 32 bits con la IP del vecino
+            -mac: MAC resuelta
+        Retorno: Ninguno
+    '''
+    with globalLock:
+        pendientes = pendingPackets.pop(ip,None)
+    if not pendientes:
+        return
+    for datagramas,etherType in pendientes:
+        sendEthernetFrames(datagramas,etherType,mac)
+    with statsLock:
+        arpQueueStats['flushed'] += len(pendientes)
+
+
+def resolvePendingPackets(ip):
+    #Resuelve la MAC de ip para los datagramas en espera. Si no hay respuesta se descartan
+    mac = ARPResolution(ip)
+    if mac is not None:
+        flushPendingPackets(ip,mac)
+        return
+    with globalLock:
+        pendientes = pendingPackets.pop(ip,[])
+    with statsLock:
+        arpQueueStats['timeout'] += len(pendientes)
+    if pendientes:
+        logging.error("No se ha podido resolver la MAC de {}: {} envíos descartados".format(
+            socket.inet_ntoa(struct.pack('!I',ip)),len(pendientes)))
+
+
+def sendToNeighbour(ip,datagramas,etherType):
+    '''
+        Nombre: sendToNeighbour
+        Descripción: Envía un lote de tramas a un vecino sin bloquear al que llama. Si la MAC del vecino está en caché se
+            envían directamente con sendEthernetFrames. Si no, se copian a la cola del vecino (como mucho ARP_QUEUE_LEN
+            envíos) y se lanza su resolución en un hilo aparte si no había ya una en curso. Los datagramas en cola se
+            envían en cuanto processARPReply añade la MAC a la caché, o se descartan si la resolución falla.
+        Argumentos:
+            -ip: IP del vecino (entero de 32 bits o bytes)
+            -datagramas: lista de secuencias de trozos de bytes con el payload de cada trama (como en sendEthernetFrames)
+            -etherType: valor de tipo Ethernet de las tramas
+        Retorno: True si se han enviado o encolado las tramas, False en otro caso
+    '''
+    if type(ip) is not int:
+        ip = struct.unpack('!I',bytes(ip))[0]
+    mac = cache.lookup(ip)
+    if mac is not None:
+        return sendEthernetFrames(datagramas,etherType,mac) == 0
+    #Los trozos pueden ser memoryview sobre buffers del que llama: se copian antes de encolarlos
+    copia = [b''.join(trozos) for trozos in datagramas]
+    with globalLock:
+        pendientes = pendingPackets.get(ip)
+        nueva = pendientes is None
+        if nueva:
+            pendientes = pendingPackets[ip] = []
+        if len(pendientes) >= ARP_QUEUE_LEN:
+            desbordado = True
+        else:
+            desbordado = False
+            pendientes.append(([(trozo,) for trozo in copia],etherType))
+    with statsLock:
+        arpQueueStats['overflow' if desbordado else 'queued'] += 1
+    if desbordado:
+        return False
+    if nueva:
+        t = threading.Thread(target=resolvePendingPackets,args=(ip,))
+        t.daemon = True
+        t.start()
+    return True
+
+
+def getARPQueueStats():
+    '''
+        Nombre: getARPQueueStats
+        Descripción: Devuelve los contadores de la cola de datagramas en espera de resolución ARP
+        Argumentos: Ninguno
+        Retorno: Diccionario con los envíos encolados, enviados tras resolverse, descartados por cola llena y
+            descartados por no resolverse la MAC, y el número de envíos en cola
+    '''
+    with statsLock:
+        stats = dict(arpQueueStats)
+    with globalLock:
+        stats['pending'] = sum(len(p) for p in pendingPackets.values())
+    return stats
+
+
+def arpTimeouts(retries=None,timeout=None,backoff=None):
+    '''
+        Nombre: arpTimeouts
+        Descripción: Calcula el tiempo de espera tras cada petición de una resolución ARP con espera exponencial
+        Argumentos:
+            -retries: número de peticiones (ARP_RETRIES si es None)
+            -timeout: espera tras la primera petición (ARP_TIMEOUT si es None)
+            -backoff: factor por el que se multiplica la espera en cada reintento (ARP_BACKOFF si es None)
+        Retorno: Lista con la espera (en segundos) tras cada petición
+    '''
+    retries = ARP_RETRIES if retries is None else retries
+    timeout = ARP_TIMEOUT if timeout is None else timeout
+    backoff = ARP_BACKOFF if backoff is None else backoff
+    return [min(timeout*backoff**i,ARP_TIMEOUT_MAX) for i in range(retries)]
+
+
+def recordResolution(inicio,fin,peticiones):
+    '''
+        Nombre: recordResolution
+        Descripción: Actualiza las estadísticas con el resultado de una resolución
+        Argumentos:
+            -inicio: instante (time.monotonic) en que empezó la resolución
+            -fin: instante en que llegó la respuesta o None si no se ha resuelto
+            -peticiones: número de peticiones ARP enviadas
+        Retorno: Ninguno
+    '''
+    with statsLock:
+        arpStats['requests'] += peticiones
+        if fin is None:
+            arpStats['failed'] += 1
+            return
+        arpStats['resolved'] += 1
+        arpLatencies.append(fin-inicio)
+        if len(arpLatencies) > ARP_LATENCY_SAMPLES:
+            del arpLatencies[0]
+
+
+def getARPStats():
+    '''
+        Nombre: getARPStats
+        Descripción: Devuelve las estadísticas de resolución ARP
+        Argumentos: Ninguno
+        Retorno: Diccionario con los contadores y el mínimo, media, mediana, percentil 99 y máximo de los tiempos de
+            resolución recientes (en segundos, None si no hay muestras)
+    '''
+    with statsLock:
+        stats = dict(arpStats)
+        muestras = sorted(arpLatencies)
+    n = len(muestras)
+    stats['min'] = muestras[0] if n else None
+    stats['avg'] = sum(muestras)/n if n else None
+    stats['p50'] = muestras[n//2] if n else None
+    stats['p99'] = muestras[min(n-1,(n*99)//100)] if n else None
+    stats['max'] = muestras[-1] if n else None
+    return stats
+
+
+def ARPResolution(ip,retries=None,timeout=None,backoff=None):
     '''
         Nombre: ARPResolution
         Descripción: Esta función intenta realizar una resolución ARP para una IP dada y devuelve la dirección MAC asociada a dicha IP
@@ -278,25 +893,30 @@ def ARPResolution(ip):
                     -Construir una petición ARP llamando a la función createARPRequest (descripción más adelante)
                     -Enviar dicha petición
                     -Comprobar si se ha recibido respuesta o no:
-                        -Si no se ha recibido respuesta reenviar la petición hasta un máximo de 3 veces. Si no se recibe respuesta devolver None
+                        -Si no se ha recibido respuesta reenviar la petición hasta un máximo de retries veces. Si no se recibe respuesta devolver None
                         -Si se ha recibido respuesta devolver la dirección MAC
-            Esta función necesitará comunicarse con el la función de recepción (para comprobar si hay respuesta y la respuesta en sí) mediante 3 variables globales:
-                -awaitingResponse: indica si está True que se espera respuesta. Si está a False quiere decir que se ha recibido respuesta
-                -requestedIP: contiene la IP por la que se está preguntando
-                -resolvedMAC: contiene la dirección MAC resuelta (en caso de que awaitingResponse) sea False.
-            Como estas variables globales se leen y escriben concurrentemente deben ser protegidas con un Lock
+            La comunicación con la función de recepción se hace mediante una entrada arpPending_t por IP en pendingResolutions,
+            protegida con globalLock. Si ya hay una resolución en curso para la misma IP no se envían más peticiones: se espera
+            a la misma entrada. Así varios hilos pueden resolver IPs distintas a la vez.
+            La espera tras cada petición termina en cuanto processARPReply activa el evento de la entrada, y cada reintento
+            espera backoff veces más que el anterior.
+        Argumentos:
+            -ip: dirección a resolver (entero de 32 bits o bytes)
+            -retries: número máximo de peticiones a enviar (ARP_RETRIES si es None)
+            -timeout: tiempo (en segundos) a esperar respuesta tras la primera petición (ARP_TIMEOUT si es None)
+            -backoff: factor de crecimiento de la espera en cada reintento (ARP_BACKOFF si es None)
+        Retorno: Dirección MAC resuelta o None si no se ha recibido respuesta
     '''
-    global requestedIP,awaitingResponse,resolvedMAC
     arp_request = bytearray()
     IP32Bit = ip
 
     if type(IP32Bit) is int:
         IP32Bit = ip.to_bytes(4, byteorder='big')    #IPQuad  = socket.inet_ntoa(IP32Bit)
+    else:
+        ip = struct.unpack('!I',IP32Bit)[0]            #la caché usa como clave el entero de 32 bits
 
-    try:
-        mac_del_cache = cache[ip]
-    except KeyError:
-        mac_del_cache = None
+    mac_del_cache = cache.lookup(ip)
+    if mac_del_cache is None:
         print("La cache no tiene el dato")
 
     if mac_del_cache:
@@ -305,25 +925,150 @@ def ARPResolution(ip):
 
 
     else:
+        with globalLock:
+            pend = pendingResolutions.get(ip)
+            propia = pend is None
+            if propia:
+                pend = arpPending_t()
+                pendingResolutions[ip] = pend
+
+        esperas = arpTimeouts(retries,timeout,backoff)
+        if not propia:
+            #Otro hilo ya está preguntando por esta IP: esperamos a su resultado
+            pend.event.wait(sum(esperas))
+            return pend.mac
+
         arp_request = createARPRequest(IP32Bit)
+        inicio = time.monotonic()
+        num_tries = 0
+        try:
+            for espera in esperas:
+                sendEthernetFrame(arp_request, len(arp_request), b'\x08\x06', broadcastAddr)
+                num_tries += 1
+                if pend.event.wait(espera):
+                    break
+            return pend.mac
+        finally:
+            with globalLock:
+                del pendingResolutions[ip]
+            pend.event.set()
+            recordResolution(inicio,pend.when,num_tries)
 
-        with globalLock:
-            awaitingResponse = True
-            requestedIP = IP32Bit
-            resolvedMAC = None
 
-        for num_tries in range(3):
-            sendEthernetFrame(arp_request, len(arp_request), b'\x08\x06', broadcastAddr)
-            time.sleep(0.05)
+def ARPResolutionMany(ips,retries=None,timeout=None,backoff=None):
+    '''
+        Nombre: ARPResolutionMany
+        Descripción: Resuelve varias IPs a la vez. Envía las peticiones de todas las IPs que no están en caché y espera las
+            respuestas en paralelo, de modo que el tiempo total es el de una sola resolución y no el de una por IP.
+            Las IPs que ya está resolviendo otro hilo no se vuelven a preguntar.
+        Argumentos:
+            -ips: lista de direcciones a resolver (enteros de 32 bits o bytes)
+            -retries, timeout, backoff: como en ARPResolution
+        Retorno: Diccionario IP (entero de 32 bits) -> MAC resuelta o None
+    '''
+    resultado = {}
+    propias = {}
+    ajenas = {}
+    esperas = arpTimeouts(retries,timeout,backoff)
+    inicio = time.monotonic()
+    limiteAjenas = inicio+sum(esperas)
+    peticiones = 0
+    for ip in ips:
+        if type(ip) is not int:
+            ip = struct.unpack('!I',bytes(ip))[0]
+        mac = cache.lookup(ip)
+        if mac:
+            resultado[ip] = mac
+            continue
+        with globalLock:
+            pend = pendingResolutions.get(ip)
+            if pend is None:
+                pend = arpPending_t()
+                pendingResolutions[ip] = pend
+                propias[ip] = pend
+            elif ip not in propias:
+                ajenas[ip] = pend
+    try:
+        for espera in esperas:
+            for ip,pend in propias.items():
+                if not pend.event.is_set():
+                    arp_request = createARPRequest(ip.to_bytes(4, byteorder='big'))
+                    sendEthernetFrame(arp_request, len(arp_request), b'\x08\x06', broadcastAddr)
+                    peticiones += 1
+            limite = time.monotonic()+espera
+            for pend in propias.values():
+                if not pend.event.wait(max(0,limite-time.monotonic())):
+                    break
+            else:
+                break
+        for pend in ajenas.values():
+            pend.event.wait(max(0,limiteAjenas-time.monotonic()))
+    finally:
+        with globalLock:
+            for ip in propias:
+                del pendingResolutions[ip]
+        for pend in propias.values():
+            pend.event.set()
+            recordResolution(inicio,pend.when,0)
+        with statsLock:
+            arpStats['requests'] += peticiones
+    for ip,pend in list(propias.items())+list(ajenas.items()):
+        resultado[ip] = pend.mac
+    return resultado
 
-            globalLock.acquire()
-            if not awaitingResponse:
-                ret = resolvedMAC
-                globalLock.release()
-                return ret
-            globalLock.release()
+def _completeFuture(fut,mac):
+    if not fut.done():
+        fut.set_result(mac)
 
-        return None
+async def ARPResolutionAsync(ip,retries=None,timeout=None,backoff=None):
+    '''
+        Nombre: ARPResolutionAsync
+        Descripción: Variante awaitable de ARPResolution para usar con el nivel Ethernet en modo asyncio. En lugar de dormir
+            y consultar las variables globales, espera a un futuro por IP que completa processARPReply. Varias
+            resoluciones de la misma IP en curso comparten el futuro y una única serie de peticiones ARP, y se pueden
+            lanzar resoluciones de IPs distintas en paralelo.
+        Argumentos:
+            -ip: dirección a resolver (entero de 32 bits o bytes)
+            -retries, timeout, backoff: como en ARPResolution
+        Retorno: Dirección MAC resuelta o None si no se ha recibido respuesta
+    '''
+    if type(ip) is int:
+        IP32Bit = ip.to_bytes(4, byteorder='big')
+    else:
+        IP32Bit = bytes(ip)
+        ip = struct.unpack('!I',IP32Bit)[0]
 
+    mac_del_cache = cache.lookup(ip)
+    if mac_del_cache:
+        return mac_del_cache
 
+    fut = pendingFutures.get(ip)
+    if fut is not None:
+        #Ya hay una resolución en curso para esta IP: esperamos a su resultado
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut),sum(arpTimeouts(retries,timeout,backoff)))
+        except asyncio.TimeoutError:
+            return None
 
+    fut = asyncio.get_running_loop().create_future()
+    pendingFutures[ip] = fut
+    arp_request = createARPRequest(IP32Bit)
+    inicio = time.monotonic()
+    fin = None
+    num_tries = 0
+    try:
+        for espera in arpTimeouts(retries,timeout,backoff):
+            sendEthernetFrame(arp_request, len(arp_request), b'\x08\x06', broadcastAddr)
+            num_tries += 1
+            try:
+                mac = await asyncio.wait_for(asyncio.shield(fut),espera)
+                fin = time.monotonic()
+                return mac
+            except asyncio.TimeoutError:
+                pass
+        return None
+    finally:
+        del pendingFutures[ip]
+        if not fut.done():
+            fut.set_result(None)
+        recordResolution(inicio,fin,num_tries)
@@ -0,0 +1,85 @@
+'''
+    checksum.py
+    Checksum de Internet (RFC 1071) común a IP, ICMP y UDP.
+    La suma en complemento a 1 de las palabras de 16 bits de un buffer coincide con el valor del buffer, leído como un
+    único entero big-endian, módulo 0xFFFF (porque 2^16 = 1 mód 0xFFFF). int.from_bytes y el módulo se calculan en C,
+    así que el coste por byte es mínimo incluso con buffers de 64 KB, sin recorrer el buffer en Python.
+    Todos los valores (sumas parciales y checksums) están en orden de red: se escriben con struct.pack('!H',valor).
+'''
+
+import struct
+
+
+def checksum_partial(data,s=0):
+    '''
+        Nombre: checksum_partial
+        Descripción: Suma en complemento a 1 de las palabras de 16 bits de data, acumulada sobre una suma parcial previa.
+            Permite calcular el checksum de varios trozos (fragmentos, pseudocabecera + datos) sin concatenarlos,
+            siempre que todos salvo el último tengan longitud par.
+        Argumentos:
+            -data: bytes, bytearray o memoryview con los datos. Si la longitud es impar se rellena con un byte a 0
+            -s: suma parcial previa (0 si es el primer trozo)
+        Retorno: Suma parcial de 16 bits (0 solo si todas las palabras sumadas son 0)
+    '''
+    n = int.from_bytes(data,'big')
+    if len(data) & 1:
+        n <<= 8
+    n += s
+    r = n % 0xFFFF
+    if r == 0 and n != 0:
+        r = 0xFFFF
+    return r
+
+
+def checksum_fold(s):
+    '''
+        Nombre: checksum_fold
+        Descripción: Convierte una suma parcial en el checksum final (complemento a 1 de la suma)
+        Argumentos:
+            -s: suma parcial devuelta por checksum_partial
+        Retorno: Entero de 16 bits con el checksum en orden de red
+    '''
+    return ~s & 0xFFFF
+
+
+def chksum(msg,s=0):
+    '''
+        Nombre: chksum
+        Descripción: Calcula el checksum de Internet sobre msg. Al validar, un mensaje con el checksum correcto da 0
+        Argumentos:
+            -msg: array de bytes con el contenido sobre el que se calculará el checksum
+            -s: suma parcial previa (por ejemplo la de la pseudocabecera de UDP)
+        Retorno: Entero de 16 bits con el resultado del checksum en ORDEN DE RED
+    '''
+    return checksum_fold(checksum_partial(msg,s))
+
+
+def pseudo_header_sum(srcIP,dstIP,protocol,length):
+    '''
+        Nombre: pseudo_header_sum
+        Descripción: Suma parcial de la pseudocabecera IPv4 que usan los checksums de UDP y TCP
+        Argumentos:
+            -srcIP: bytes con la IP origen
+            -dstIP: bytes con la IP destino
+            -protocol: valor del campo protocolo de IP
+            -length: longitud del segmento UDP/TCP (cabecera + datos)
+        Retorno: Suma parcial de 16 bits
+    '''
+    return checksum_partial(bytes(srcIP)+bytes(dstIP)+struct.pack('!xBH',protocol,length))
+
+
+def checksum_update(cksum,old,new):
+    '''
+        Nombre: checksum_update
+        Descripción: Actualiza un checksum cuando cambia una palabra de 16 bits del mensaje, sin recalcularlo (RFC 1624,
+            ecuación 3: HC' = ~(~HC + ~m + m')). Útil para cambios de TTL, IPID, banderas u offset.
+        Argumentos:
+            -cksum: checksum actual en orden de red
+            -old: valor anterior de la palabra de 16 bits
+            -new: nuevo valor de la palabra de 16 bits
+        Retorno: Entero de 16 bits con el nuevo checksum en orden de red
+    '''
+    s = (~cksum & 0xFFFF) + (~old & 0xFFFF) + new
+    s = (s & 0xFFFF) + (s >> 16)
+    s = (s & 0xFFFF) + (s >> 16)
+    return ~s & 0xFFFF
@@ -6,14 +6,23 @@
 '''
 
 from rc1_pcap import *
+from afpacket import *
+from vlink import *
+from netinfo import *
 import logging
 import socket
 import struct
 from binascii import hexlify
 import struct
 import threading
+import queue
+import asyncio
+import ctypes
 #Tamaño máximo de una trama Ethernet (para las prácticas)
 ETH_FRAME_MAX = 1514
+#Snaplen del manejador sin interfaz con el que se compilan los filtros del backend AF_PACKET: debe admitir tramas con
+#etiquetas 802.1Q (1518 bytes o más), si no el filtro compilado las recorta
+ETH_FILTER_SNAPLEN = 65535
 #Tamaño mínimo de una trama Ethernet
 ETH_FRAME_MIN = 60
 PROMISC = 1
@@ -21,11 +30,52 @@ NO_PROMISC = 0
 TO_MS = 10
 #Dirección de difusión (Broadcast)
 broadcastAddr = bytes([0xFF]*6)
-#Diccionario que alamacena para un Ethertype dado qué función de callback se debe ejecutar
+#Diccionario que alamacena para un Ethertype dado (entero) qué función de callback se debe ejecutar
 upperProtos = {}
+#Funciones de callback para tramas con etiquetas 802.1Q. Diccionario (tupla de VLAN IDs, Ethertype) -> función
+vlanProtos = {}
+#Ethertypes (TPID) de las etiquetas VLAN: 802.1Q, 802.1ad (QinQ) y el valor antiguo de QinQ
+VLAN_TPIDS = (0x8100, 0x88A8, 0x9100)
+VLAN_VID_MASK = 0x0FFF
+ETHERTYPE_ARP = 0x0806
+ETHERTYPE_IP = 0x0800
+#Direcciones destino aceptadas en recepción: la propia, la de difusión y los grupos multicast añadidos con
+#addMulticastAddress. Se modifica siempre en el sitio para que las referencias importadas sigan siendo válidas
+acceptedDst = {broadcastAddr}
+multicastGroups = set()
+#Si es True se instala en la interfaz un filtro BPF con los Ethertypes registrados y las direcciones aceptadas, de modo
+#que el resto de tramas se descartan en el núcleo sin llegar a Python
+ETH_AUTO_FILTER = True
+#Cabecera Ethernet sin etiquetas y con hasta dos etiquetas VLAN: MAC destino, MAC origen y Ethertype/TPID, TCI,
+#Ethertype/TPID, TCI, Ethertype
+ethHeader = struct.Struct('!6s6sH')
+ethHeaderVLAN = struct.Struct('!6s6sHHHHH')
+#Funciones a llamar (sin argumentos) al parar el nivel Ethernet, antes de cerrar la interfaz
+stopCallbacks = []
 ethertype1 = b'\x08\x06'
 ethertype2 = b'\x08\x00'
 levelInitialized = False
+#Manejador de la interfaz abierta (None si el nivel está parado) e hilo de recepción
+handle = None
+recvThread = None
+#Número de tramas por lote en recepción (0 para recibir trama a trama con pcap_loop)
+rxBatchSize = 0
+#Número de hilos trabajadores y tamaño de la cola de cada uno para el procesado de tramas recibidas
+RX_WORKERS = 4
+RX_QUEUE_LEN = 1024
+#Hilos trabajadores (lista vacía para crear un hilo por trama con process_frame)
+rxWorkers = []
+#Contadores de tramas encoladas y descartadas por tener la cola llena. Solo los modifica el hilo de recepción
+rxQueued = 0
+rxDrops = 0
+#Backends de acceso a la interfaz: libpcap o socket AF_PACKET con anillos TPACKET_V3 (módulo afpacket)
+BACKEND_PCAP = 'pcap'
+BACKEND_AFPACKET = 'afpacket'
+BACKEND_VLINK = 'vlink'
+backend = BACKEND_PCAP
+#Bucle de eventos asyncio en el que se reciben las tramas (None si se usa el hilo de recepción)
+asyncLoop = None
+asyncFd = -1
 
 def getHwAddr(interface):
     '''
@@ -36,11 +86,13 @@ def getHwAddr(interface):
         Retorno:
             -Dirección MAC de la itnerfaz
     '''
-    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
-    s.bind((interface,0))
-    mac =  (s.getsockname()[4])
-    s.close()
-    return mac
+    vif = getVirtualInterface(interface)
+    if vif is not None:
+        return vif.mac
+    info = getInterfaceInfo(interface)
+    if info is None:
+        return None
+    return info.mac
 
 
 def process_Ethernet_frame(us,header,data):
@@ -49,7 +101,10 @@ def process_Ethernet_frame(us,header,data):
         Descripción: Esta función se ejecutará cada vez que llegue una trama Ethernet.
             Esta función debe realizar, al menos, las siguientes tareas:
                 -Extraer los campos de dirección Ethernet destino, origen y ethertype
-                -Comprobar si la dirección destino es la propia o la de broadcast. En caso de que la trama no vaya en difusión o no sea para nuestra interfaz la descartaremos (haciendo un return).
+                -Comprobar si la dirección destino es la propia, la de broadcast o un grupo multicast aceptado (acceptedDst). En caso
+                contrario la descartaremos (haciendo un return).
+                -Si la trama lleva una etiqueta 802.1Q (o dos, QinQ) buscar la función de callback registrada para sus VLAN IDs y
+                el Ethertype interior con registerVLANCallback. Si no lleva etiquetas:
                 -Comprobar si existe una función de callback de nivel superior asociada al Ethertype de la trama:
                     -En caso de que exista, llamar a la función de nivel superior con los parámetros que corresponde:
                         -us (datos de usuario)
@@ -64,23 +119,30 @@ def process_Ethernet_frame(us,header,data):
         Retorno:
             -Ninguno
     '''
-    destino_limit = 6
-    origin_limit = 12
-    ethertype_limit = 14
+    #Una sola lectura de la cabecera, con las posibles etiquetas VLAN (las tramas tienen al menos ETH_FRAME_MIN bytes
+    #salvo en capturas recortadas)
+    if len(data) >= ethHeaderVLAN.size:
+        ethernet_destino,ethernet_origin,ethertype,tci1,tipo1,tci2,tipo2 = ethHeaderVLAN.unpack_from(data)
+    else:
+        ethernet_destino,ethernet_origin,ethertype = ethHeader.unpack_from(data)
+        tipo1 = None
 
-    ethernet_destino = bytes(data[:destino_limit])
-    ethernet_origin = bytes(data[destino_limit:origin_limit])
-    ethertype = bytes(data[origin_limit:ethertype_limit])
+    if ethernet_destino not in acceptedDst:
+        return
 
-    if ethernet_destino == broadcastAddr or ethernet_destino == macAddress:
+    if ethertype not in VLAN_TPIDS:
         funcion = upperProtos.get(ethertype)
-        if funcion:
-            funcion(us, header, data[ethertype_limit:], ethernet_origin)
-    else:
+        payload = 14
+    elif tipo1 is None:
         return
-
-
-    #TODO: Implementar aquí el código que procesa una trama Ethernet en recepción
+    elif tipo1 not in VLAN_TPIDS:
+        funcion = vlanProtos.get(((tci1 & VLAN_VID_MASK,),tipo1))
+        payload = 18
+    else:
+        funcion = vlanProtos.get(((tci1 & VLAN_VID_MASK,tci2 & VLAN_VID_MASK),tipo2))
+        payload = 22
+    if funcion:
+        funcion(us, header, data[payload:], ethernet_origin)
 
 
 def process_frame(us,header,data):
@@ -98,6 +160,133 @@ def process_frame(us,header,data):
     '''
     threading.Thread(target=process_Ethernet_frame,args=(us,header,data)).start()
 
+def process_Ethernet_batch(us,frames):
+    '''
+        Nombre: process_Ethernet_batch
+        Descripción: Procesa en orden una lista de tramas llamando a process_Ethernet_frame para cada una
+        Argumentos:
+            -us: datos de usuarios pasados desde pcap_dispatch_batch (en nuestro caso será None)
+            -frames: lista de tuplas (header,data)
+        Retorno:
+            -Ninguno
+    '''
+    for header,data in frames:
+        process_Ethernet_frame(us,header,data)
+
+def process_ring_frame(us,header,data):
+    '''
+        Nombre: process_ring_frame
+        Descripción: Esta función se pasa a afpacket_loop. data es un memoryview sobre el anillo de recepción que deja de ser
+        válido al devolver el bloque al núcleo, así que se copia antes de pasar la trama a otro hilo.
+        Argumentos:
+            -us: datos de usuarios pasados desde afpacket_loop (en nuestro caso será None)
+            -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts.
+            -data: memoryview con el contenido de la trama Ethernet
+        Retorno:
+            -Ninguno
+    '''
+    if rxWorkers:
+        dispatch_frame(us,header,bytearray(data))
+    else:
+        process_frame(us,header,bytearray(data))
+
+def process_batch(us,batch):
+    '''
+        Nombre: process_batch
+        Descripción: Esta función se pasa a pcap_dispatch_batch y se ejecutará una vez por cada lote de tramas.
+        Copia las tramas fuera del buffer del lote (que se reutiliza) y las procesa en un único hilo nuevo,
+        de modo que el hilo de recepción no se bloquea y se crea un hilo por lote en lugar de uno por trama.
+        Argumentos:
+            -us: datos de usuarios pasados desde pcap_dispatch_batch (en nuestro caso será None)
+            -batch: lote pcap_batch con las tramas recibidas
+        Retorno:
+            -Ninguno
+    '''
+    if rxWorkers:
+        for header,data in batch:
+            dispatch_frame(us,header,bytearray(data))
+        return
+    frames = [(header,bytearray(data)) for header,data in batch]
+    threading.Thread(target=process_Ethernet_batch,args=(us,frames)).start()
+
+def dispatch_frame(us,header,data):
+    '''
+        Nombre: dispatch_frame
+        Descripción: Esta función se pasa a pcap_loop cuando hay hilos trabajadores y reparte cada trama a uno de ellos.
+        Las tramas ARP van siempre al primer trabajador, que solo procesa ARP: su procesado nunca se bloquea y así
+        una respuesta ARP no puede quedarse esperando detrás de una trama que está esperando esa misma resolución.
+        El resto de tramas se reparten según la MAC origen y el ethertype, de modo que las tramas de un mismo
+        flujo (por ejemplo los fragmentos de un datagrama) se procesan en orden. Si la cola del trabajador está
+        llena la trama se descarta y se incrementa rxDrops.
+        Argumentos:
+            -us: datos de usuarios pasados desde pcap_loop (en nuestro caso será None)
+            -header: estructura pcap_pkthdr que contiene los campos len, caplen y ts.
+            -data: bytearray con el contenido de la trama Ethernet
+        Retorno:
+            -Ninguno
+    '''
+    global rxQueued,rxDrops
+    if data[12] == 0x08 and data[13] == 0x06:
+        worker = rxWorkers[0]
+    else:
+        worker = rxWorkers[1 + hash(bytes(data[6:14])) % (len(rxWorkers)-1)]
+    try:
+        worker.queue.put_nowait((us,header,data))
+        rxQueued += 1
+    except queue.Full:
+        rxDrops += 1
+
+def process_readable():
+    '''
+        Nombre: process_readable
+        Descripción: Esta función se registra en el bucle de eventos y se ejecuta cuando el descriptor de pcap tiene
+        datos. Procesa con pcap_dispatch (handle en modo no bloqueante) todas las tramas disponibles en el propio hilo
+        del bucle, por lo que las funciones de nivel superior no deben bloquearse.
+        Argumentos: Ninguno
+        Retorno: Ninguno
+    '''
+    if handle is not None:
+        pcap_dispatch(handle,-1,process_Ethernet_frame,None)
+
+def getEventLoop():
+    '''
+        Nombre: getEventLoop
+        Descripción: Devuelve el bucle de eventos asyncio en el que trabaja el nivel Ethernet
+        Argumentos: Ninguno
+        Retorno: Bucle de eventos o None si el nivel Ethernet usa el hilo de recepción
+    '''
+    return asyncLoop
+
+def getRxStats():
+    '''
+        Nombre: getRxStats
+        Descripción: Devuelve los contadores del repartidor de tramas recibidas
+        Argumentos: Ninguno
+        Retorno: Diccionario con las tramas encoladas, las descartadas y la ocupación actual de la cola de cada trabajador
+    '''
+    return {'queued':rxQueued,'drops':rxDrops,'depth':[w.queue.qsize() for w in rxWorkers]}
+
+
+class rxWorker(threading.Thread):
+    ''' Hilo trabajador con una cola acotada propia. Procesa en orden las tramas que le asigna dispatch_frame
+        hasta que recibe None.
+    '''
+    def __init__(self,queueLen):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue.Queue(queueLen)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            us,header,data = item
+            try:
+                process_Ethernet_frame(us,header,data)
+            except Exception:
+                logging.exception('Error procesando una trama recibida')
+
 
 class rxThread(threading.Thread):
     ''' Clase que implementa un hilo de recepción. De esta manera al iniciar el nivel Ethernet
@@ -106,21 +295,54 @@ class rxThread(threading.Thread):
     '''
     def __init__(self):
         threading.Thread.__init__(self)
+        self.stopped = False
 
     def run(self):
         global handle
         #Ejecuta pcap_loop. OJO: handle debe estar inicializado con el resultado de pcap_open_live
         if handle is not None:
-            pcap_loop(handle,-1,process_frame,None)
+            if backend == BACKEND_AFPACKET:
+                afpacket_loop(handle,-1,process_ring_frame,None)
+            elif backend == BACKEND_VLINK:
+                vlink_loop(handle,-1,dispatch_frame if rxWorkers else process_frame,None)
+            elif rxBatchSize > 0:
+                #Recepción por lotes: pcap_dispatch vuelve cada TO_MS, lo que permite vaciar lotes incompletos
+                batch = pcap_batch(rxBatchSize,ETH_FRAME_MAX,TO_MS)
+                while not self.stopped:
+                    if pcap_dispatch_batch(handle,-1,process_batch,None,batch) < 0:
+                        break
+            elif rxWorkers:
+                pcap_loop(handle,-1,dispatch_frame,None)
+            else:
+                pcap_loop(handle,-1,process_frame,None)
     def stop(self):
         global handle
         #Para la ejecución de pcap_loop
+        self.stopped = True
         if handle is not None:
-            pcap_breakloop(handle)
+            if backend == BACKEND_AFPACKET:
+                afpacket_breakloop(handle)
+            elif backend == BACKEND_VLINK:
+                vlink_breakloop(handle)
+            else:
+                pcap_breakloop(handle)
+
 
 
 
 
+def registerStopCallback(callback_func):
+    '''
+        Nombre: registerStopCallback
+        Descripción: Registra una función que se llamará al parar el nivel Ethernet con stopEthernetLevel, antes de cerrar
+            la interfaz. Permite a los niveles superiores guardar su estado. Registrar dos veces la misma función no tiene efecto
+        Argumentos:
+            -callback_func: función sin argumentos
+        Retorno: Ninguno
+    '''
+    if callback_func not in stopCallbacks:
+        stopCallbacks.append(callback_func)
+
 
 def registerCallback(callback_func, ethertype):
     '''
@@ -140,19 +362,129 @@ def registerCallback(callback_func, ethertype):
                     -data: payload de la trama Ethernet. Es decir, la cabecera Ethernet NUNCA se pasa hacia arriba.
                     -srcMac: dirección MAC que ha enviado la trama actual.
                 La función no retornará nada. Si una trama se quiere descartar basta con hacer un return sin valor y dejará de procesarse.
-            -ethertype: valor de Ethernetype para el cuál se quiere registrar una función de callback.
+            -ethertype: valor de Ethernetype para el cuál se quiere registrar una función de callback (bytes en orden de red o
+            entero). Se admite cualquier Ethertype.
         Retorno: Ninguno
     '''
+    if ethertype is None:
+        return
+    upperProtos[etherTypeValue(ethertype)] = callback_func
+    updateEthernetFilter()
+
+
+def registerVLANCallback(callback_func, ethertype, vlan):
+    '''
+        Nombre: registerVLANCallback
+        Descripción: Registra la función de callback para las tramas de una VLAN con un Ethertype dado. La función recibe el
+            payload tras las etiquetas VLAN, con el mismo prototipo que en registerCallback
+        Argumentos:
+            -callback_func: función de callback (o None para eliminar la que haya)
+            -ethertype: Ethertype interior (bytes en orden de red o entero)
+            -vlan: VLAN ID (entero) de una trama con una etiqueta, o tupla (VLAN exterior, VLAN interior) para QinQ
+        Retorno: Ninguno
+    '''
+    clave = ((vlan,) if type(vlan) is int else tuple(vlan),etherTypeValue(ethertype))
+    if callback_func is None:
+        vlanProtos.pop(clave,None)
+    else:
+        vlanProtos[clave] = callback_func
+    updateEthernetFilter()
+
+
+def etherTypeValue(ethertype):
+    #Convierte un Ethertype en bytes (orden de red) a entero
+    if type(ethertype) is int:
+        return ethertype
+    return int.from_bytes(ethertype,'big')
+
+
+def addMulticastAddress(mac):
+    '''
+        Nombre: addMulticastAddress
+        Descripción: Acepta en recepción las tramas dirigidas a un grupo multicast
+        Argumentos:
+            -mac: bytes con la dirección MAC del grupo (con el bit de grupo activo)
+        Retorno: True si se ha añadido, False si no es una dirección de grupo
+    '''
+    mac = bytes(mac)
+    if len(mac) != 6 or not mac[0] & 1:
+        return False
+    multicastGroups.add(mac)
+    acceptedDst.add(mac)
+    updateEthernetFilter()
+    return True
+
+
+def delMulticastAddress(mac):
+    '''
+        Nombre: delMulticastAddress
+        Descripción: Deja de aceptar las tramas dirigidas a un grupo multicast
+        Argumentos:
+            -mac: bytes con la dirección MAC del grupo
+        Retorno: Ninguno
+    '''
+    mac = bytes(mac)
+    multicastGroups.discard(mac)
+    if mac != broadcastAddr:
+        acceptedDst.discard(mac)
+    updateEthernetFilter()
+
+
+def buildEthernetFilter():
+    '''
+        Nombre: buildEthernetFilter
+        Descripción: Construye la expresión de filtro (sintaxis de pcap) que deja pasar solo las tramas que
+            process_Ethernet_frame no descartaría: dirigidas a una dirección de acceptedDst y con un Ethertype
+            registrado o con etiqueta VLAN si hay funciones registradas por VLAN
+        Argumentos: Ninguno
+        Retorno: Cadena con el filtro
+    '''
+    destinos = ' or '.join('ether dst {}'.format(':'.join('{:02x}'.format(b) for b in mac)) for mac in sorted(acceptedDst))
+    tipos = ['ether proto 0x{:04x}'.format(t) for t in sorted(upperProtos) if upperProtos[t] is not None]
+    #vlan cambia el desplazamiento de lo que va detrás, por eso va al final
+    if vlanProtos:
+        tipos.append('vlan')
+    if not tipos:
+        return '({})'.format(destinos)
+    return '({}) and ({})'.format(destinos,' or '.join(tipos))
 
-    global upperProtos, ethertype1, ethertype2
-    if ethertype is not None and ethertype == ethertype1:
-        upperProtos[ethertype1] = callback_func
-    elif ethertype is not None and ethertype == ethertype2:
-        upperProtos[ethertype2] = callback_func
-    return
 
-    #upperProtos es el diccionario que relaciona función de callback y ethertype
-def startEthernetLevel(interface):
+def updateEthernetFilter():
+    '''
+        Nombre: updateEthernetFilter
+        Descripción: Compila el filtro de buildEthernetFilter y lo instala en la interfaz abierta (con pcap_setfilter o, con el
+            backend AF_PACKET, en el propio socket). Se llama al abrir la interfaz y cada vez que cambian los Ethertypes
+            registrados o las direcciones aceptadas. No hace nada si ETH_AUTO_FILTER es False o con interfaces virtuales
+        Argumentos: Ninguno
+        Retorno: True si se ha instalado el filtro, False en otro caso
+    '''
+    if not ETH_AUTO_FILTER or handle is None or backend == BACKEND_VLINK:
+        return False
+    filtro = buildEthernetFilter()
+    programa = bpf_program()
+    if backend == BACKEND_AFPACKET:
+        #Se compila sobre un manejador sin interfaz y se instala el código en el socket
+        compilador = pcap_open_dead(DLT_EN10MB,ETH_FILTER_SNAPLEN)
+    else:
+        compilador = handle
+    try:
+        if pcap_compile(compilador,programa,filtro,1,PCAP_NETMASK_UNKNOWN) != 0:
+            logging.error("No se pudo compilar el filtro {}: {}".format(filtro,pcap_geterr(compilador)))
+            return False
+        if backend == BACKEND_AFPACKET:
+            ret = afpacket_setfilter(handle,ctypes.string_at(programa.bf_insns,programa.bf_len*8))
+        else:
+            ret = pcap_setfilter(handle,programa)
+        pcap_freecode(programa)
+    finally:
+        if compilador is not handle:
+            pcap_close(compilador)
+    if ret != 0:
+        logging.error("No se pudo instalar el filtro {}".format(filtro))
+        return False
+    logging.debug("Filtro instalado: {}".format(filtro))
+    return True
+def startEthernetLevel(interface,batchSize=0,numWorkers=RX_WORKERS,queueLen=RX_QUEUE_LEN,loop=None,ioBackend=BACKEND_PCAP):
     '''
     1-------->
         Nombre: startEthernetLevel
@@ -165,9 +497,18 @@ def startEthernetLevel(interface):
                 -Si todo es correcto marcar la variable global de nivel incializado a True
         Argumentos:
             -Interface: nombre de la interfaz sobre la que inicializar el nivel Ethernet
+            -batchSize: si es mayor que 0 las tramas se reciben en lotes de hasta batchSize tramas
+            -numWorkers: número de hilos trabajadores que procesan las tramas recibidas (mínimo 2, uno de ellos
+                reservado para ARP). Con 0 se crea un hilo nuevo por trama
+            -queueLen: número máximo de tramas pendientes en la cola de cada trabajador
+            -loop: bucle de eventos asyncio. Si se especifica no se arranca el hilo de recepción: el descriptor de pcap
+                se registra en el bucle (debe llamarse desde el hilo del bucle) y las tramas se procesan en él
+            -ioBackend: BACKEND_PCAP (libpcap) o BACKEND_AFPACKET (anillos AF_PACKET TPACKET_V3). Con BACKEND_AFPACKET
+                no se admite el modo asyncio y batchSize se ignora, ya que el anillo entrega las tramas por bloques.
+                Si la interfaz es virtual (registrada con addVirtualInterface) se usa siempre BACKEND_VLINK
         Retorno: 0 si todo es correcto, -1 en otro caso
     '''
-    global macAddress,handle,levelInitialized,recvThread
+    global macAddress,handle,levelInitialized,recvThread,rxBatchSize,rxWorkers,asyncLoop,asyncFd,backend
     handle = None
     errbuf = bytearray()
     if levelInitialized == True:
@@ -175,14 +516,57 @@ def startEthernetLevel(interface):
     #levelInitialized = False
     #TODO: implementar aquí la inicialización de la interfaz y de las variables globales
     macAddress = getHwAddr(interface)
-    handle = pcap_open_live(interface, ETH_FRAME_MAX, PROMISC, TO_MS, errbuf)
+    acceptedDst.clear()
+    acceptedDst.update(multicastGroups)
+    acceptedDst.add(broadcastAddr)
+    if macAddress is not None:
+        acceptedDst.add(bytes(macAddress))
+    rxBatchSize = batchSize
+    backend = ioBackend
+    if getVirtualInterface(interface) is not None:
+        backend = BACKEND_VLINK
+    if backend == BACKEND_VLINK:
+        if loop is not None:
+            print("Las interfaces virtuales no admiten el modo asyncio")
+            return -1
+        handle = vlink_open(interface, errbuf)
+    elif backend == BACKEND_AFPACKET:
+        if loop is not None:
+            print("El backend AF_PACKET no admite el modo asyncio")
+            return -1
+        handle = afpacket_open(interface, errbuf)
+    else:
+        handle = pcap_open_live(interface, ETH_FRAME_MAX, PROMISC, TO_MS, errbuf)
     if handle is None:
         print("No se pudo capturar la interfaz de red")
         return -1
+    updateEthernetFilter()
 
+    if loop is not None:
+        if pcap_setnonblock(handle,1,errbuf) < 0:
+            print("No se pudo poner la interfaz en modo no bloqueante")
+            pcap_close(handle)
+            handle = None
+            return -1
+        asyncFd = pcap_get_selectable_fd(handle)
+        if asyncFd < 0:
+            print("La interfaz no tiene un descriptor seleccionable")
+            pcap_close(handle)
+            handle = None
+            return -1
+        asyncLoop = loop
+        recvThread = None
+        loop.add_reader(asyncFd,process_readable)
+        levelInitialized = True
+        return 0
 
     #Una vez hemos abierto la interfaz para captura y hemos inicializado las variables globales (macAddress, handle y levelInitialized) arrancamos
     #el hilo de recepción
+    rxWorkers = []
+    if numWorkers > 0:
+        rxWorkers = [rxWorker(queueLen) for i in range(max(numWorkers,2))]
+        for worker in rxWorkers:
+            worker.start()
     recvThread = rxThread()
     recvThread.daemon = True
     recvThread.start()
@@ -190,7 +574,7 @@ def startEthernetLevel(interface):
     return 0
 
 def stopEthernetLevel():
-    global macAddress,handle,levelInitialized,recvThread
+    global macAddress,handle,levelInitialized,recvThread,rxWorkers,asyncLoop,asyncFd
     '''
     2-------------->
         Nombre: stopEthernetLevel
@@ -199,13 +583,34 @@ def stopEthernetLevel():
                 -Parar el hilo de recepción de paquetes
                 -Cerrar la interfaz (handle de pcap)
                 -Marcar la variable global de nivel incializado a False
+            Antes de parar se llama a las funciones registradas con registerStopCallback.
         Argumentos: Ninguno
         Retorno: 0 si todo es correcto y -1 en otro caso
     '''
+    for callback in stopCallbacks:
+        try:
+            callback()
+        except Exception as e:
+            logging.error("Error al parar el nivel Ethernet: {}".format(e))
     if recvThread is not None:
         recvThread.stop()
+    if asyncLoop is not None:
+        asyncLoop.remove_reader(asyncFd)
+        asyncLoop = None
+        asyncFd = -1
     if handle is not None:
-        pcap_close(handle)
+        if backend == BACKEND_AFPACKET:
+            if recvThread is not None:
+                recvThread.join()
+            afpacket_close(handle)
+        elif backend == BACKEND_VLINK:
+            vlink_close(handle)
+        else:
+            pcap_close(handle)
+    for worker in rxWorkers:
+        worker.queue.put(None)
+    rxWorkers = []
+    handle = None
     levelInitialized = False
     return 0 #solo retorna 0 no -1 en otro caso
 
@@ -230,21 +635,63 @@ def sendEthernetFrame(data,leng,etherType,dstMac):
     trama = bytearray()
 
 
-    if data is not None and leng is not None and etherType is not None and dstMac is not None:
-        trama += dstMac #Lo primero sera la direccion de destino de la Mac
-        if macAddress is not None:
-            trama += (macAddress) #Lo segundo sera la direccion de ethernet de origen
+    if data is None or leng is None or etherType is None or dstMac is None:
+        return -1
+    trama += dstMac #Lo primero sera la direccion de destino de la Mac
+    if macAddress is not None:
+        trama += (macAddress) #Lo segundo sera la direccion de ethernet de origen
+
+    trama += etherType
+    trama += data
+    return injectFrame(trama)
 
-        trama += etherType
-        trama += data
-        tamanyo_paquete = len(trama)
-        if tamanyo_paquete < ETH_FRAME_MIN:
-            trama += (bytearray(ETH_FRAME_MIN-tamanyo_paquete)) #Rellenamos con 0's hasta cumplir con el tamaño minimo requerido
-        elif tamanyo_paquete > ETH_FRAME_MAX: #tamanyo de la trama mayor que ETHER_FRAME_MAX
-            logging.error("Problema con el tamanyo de los datos especificados")
+def sendEthernetFrames(datagrams,etherType,dstMac):
+    '''
+        Nombre: sendEthernetFrames
+        Descripción: Envía un lote de tramas al mismo destino y con el mismo Ethertype (por ejemplo todos los fragmentos
+            de un datagrama IP). El payload de cada trama se da como una secuencia de trozos (cabecera IP, memoryview con
+            los datos...) que se copian una única vez, directamente en la trama.
+        Argumentos:
+            -datagrams: lista de secuencias de trozos de bytes que forman el payload de cada trama
+            -etherType: valor de tipo Ethernet a incluir en las tramas
+            -dstMac: Dirección MAC destino a incluir en las tramas
+        Retorno: 0 si se han enviado todas las tramas, -1 en otro caso
+    '''
+    if dstMac is None or macAddress is None:
+        return -1
+    cabecera = bytes(dstMac)+bytes(macAddress)+bytes(etherType)
+    for trozos in datagrams:
+        trama = bytearray(cabecera)
+        for trozo in trozos:
+            trama += trozo
+        if injectFrame(trama) != 0:
             return -1
+    return 0
+
+def injectFrame(trama):
+    '''
+        Nombre: injectFrame
+        Descripción: Rellena con ceros hasta el tamaño mínimo y envía una trama Ethernet completa por el backend activo
+        Argumentos:
+            -trama: bytearray con la trama (cabecera + payload)
+        Retorno: 0 si todo es correcto, -1 en otro caso
+    '''
+    tamanyo_paquete = len(trama)
+    if tamanyo_paquete < ETH_FRAME_MIN:
+        trama += (bytearray(ETH_FRAME_MIN-tamanyo_paquete)) #Rellenamos con 0's hasta cumplir con el tamaño minimo requerido
+        tamanyo_paquete = ETH_FRAME_MIN
+    elif tamanyo_paquete > ETH_FRAME_MAX: #tamanyo de la trama mayor que ETHER_FRAME_MAX
+        logging.error("Problema con el tamanyo de los datos especificados")
+        return -1
+    if handle is None:
+        return -1
     ret_inject = 0
-    ret_inject = pcap_inject(handle, bytes(trama), tamanyo_paquete)
+    if backend == BACKEND_AFPACKET:
+        ret_inject = afpacket_inject(handle, trama, tamanyo_paquete)
+    elif backend == BACKEND_VLINK:
+        ret_inject = vlink_inject(handle, trama, tamanyo_paquete)
+    else:
+        ret_inject = pcap_inject(handle, bytes(trama), tamanyo_paquete)
     if ret_inject == tamanyo_paquete:
         return 0
     else:
@@ -1,8 +1,10 @@
 import ip
+from checksum import chksum
 from threading import Lock
 import struct
 import logging
 import time
+import asyncio
 import pdb
 ICMP_PROTO = 1
 
@@ -14,22 +16,6 @@ timeLock = Lock()
 icmp_send_times = {}
 
 
-def icmp_chksum(msg):
-    s = 0
-    for i in range(0, len(msg), 2):
-        if (i+1) < len(msg):
-            a = msg[i]
-            b = msg[i+1]
-            s = s + (a+(b << 8))
-        elif (i+1)==len(msg):
-            s += msg[i]
-        else:
-            raise 'Error calculando el checksum'
-    s = s + (s >> 16)
-    s = ~s & 0xffff
-
-    return s
-
 def process_ICMP_message(us,header,data,srcIp):
     '''
         Nombre: process_ICMP_message
@@ -61,7 +47,7 @@ def process_ICMP_message(us,header,data,srcIp):
 
     '''
     global icmp_send_times
-    if icmp_chksum(data) != 0:
+    if chksum(data) != 0:
         logging.error('checksum icmp incorrecto')
         return
     else:
@@ -79,7 +65,12 @@ def process_ICMP_message(us,header,data,srcIp):
         icmp_id = struct.unpack('!H',data[4:6])[0]
         icmp_seqnum = struct.unpack('!H',data[6:8])[0]
         srcIp = struct.unpack('!I', srcIp)[0]
-        sendICMPMessage(data[8:], ICMP_ECHO_REPLY_TYPE, 0, icmp_id, icmp_seqnum, srcIp)
+        loop = ip.getEventLoop()
+        if loop is not None:
+            #En modo asyncio estamos en el hilo del bucle: la respuesta se envía en una tarea para no bloquearlo
+            loop.create_task(sendICMPMessageAsync(bytes(data[8:]), ICMP_ECHO_REPLY_TYPE, 0, icmp_id, icmp_seqnum, srcIp))
+        else:
+            sendICMPMessage(data[8:], ICMP_ECHO_REPLY_TYPE, 0, icmp_id, icmp_seqnum, srcIp)
     elif struct.unpack('!B',data[:1])[0] == ICMP_ECHO_REPLY_TYPE:
         dstIp = srcIp
         icmp_id = data[4:6]
@@ -122,6 +113,33 @@ def sendICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
         Retorno: True o False en función de si se ha enviado el mensaje correctamente o no
 
     '''
+    datagrama = buildICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP)
+    if datagrama is None:
+        return False
+    return ip.sendIPDatagram(dstIP, datagrama, ICMP_PROTO)           #ojo esto es un entero
+
+
+async def sendICMPMessageAsync(data,type,code,icmp_id,icmp_seqnum,dstIP):
+    '''
+        Nombre: sendICMPMessageAsync
+        Descripción: Variante awaitable de sendICMPMessage que envía el mensaje con sendIPDatagramAsync
+        Argumentos: los mismos que sendICMPMessage
+        Retorno: True o False en función de si se ha enviado el mensaje correctamente o no
+    '''
+    datagrama = buildICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP)
+    if datagrama is None:
+        return False
+    return await ip.sendIPDatagramAsync(dstIP, datagrama, ICMP_PROTO)
+
+
+def buildICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
+    '''
+        Nombre: buildICMPMessage
+        Descripción: Construye un mensaje ICMP de tipo ECHO_REQUEST o ECHO_REPLY con su checksum. Si es un ECHO_REQUEST
+        guarda además el tiempo de envío en icmp_send_times.
+        Argumentos: los mismos que sendICMPMessage
+        Retorno: Bytes con el mensaje ICMP o None si el tipo no está soportado
+    '''
     global icmp_send_times
 
     #pdb.set_trace()
@@ -145,8 +163,8 @@ def sendICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
 
         cabecera += type.to_bytes(1, byteorder='big')
         cabecera += code.to_bytes(1, byteorder='big')
-        icmp_checksum = icmp_chksum(mensaje_prueba)
-        cabecera += icmp_checksum.to_bytes(2, byteorder='little')     #ojo el checksum se hace sobre cabecera_prueba + datos
+        icmp_checksum = chksum(mensaje_prueba)
+        cabecera += struct.pack('!H',icmp_checksum)     #ojo el checksum se hace sobre cabecera_prueba + datos
         cabecera += icmp_id.to_bytes(2, byteorder='big')
         cabecera += icmp_seqnum.to_bytes(2, byteorder='big')
 
@@ -155,15 +173,15 @@ def sendICMPMessage(data,type,code,icmp_id,icmp_seqnum,dstIP):
 
         if type == ICMP_ECHO_REQUEST_TYPE:
             with timeLock:
-                clave = bytes(dstIP+icmp_id+icmp_seqnum)
+                #Misma clave que se forma en recepción: IP (4 bytes) + id (2 bytes) + seqnum (2 bytes)
+                clave = struct.pack('!IHH',dstIP,icmp_id,icmp_seqnum)
                 print("Guardando clave", clave)
                 icmp_send_times[clave] = time.time()
-                
 
-        ip.sendIPDatagram(dstIP, datagrama, ICMP_PROTO)           #ojo esto es un entero
+        return datagrama
 
     else:
-        return False
+        return None
 
 
 def initICMP():
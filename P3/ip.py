@@ -1,18 +1,19 @@
 from ethernet import *
 from arp import *
-from fcntl import ioctl
-import subprocess
-import math
+from checksum import *
+from functools import lru_cache
+from collections import OrderedDict
+import time
 
 import pdb
 
-SIOCGIFMTU = 0x8921
-SIOCGIFNETMASK = 0x891b
 #Diccionario de protocolos. Las claves con los valores numéricos de protocolos de nivel superior a IP
 #por ejemplo (1, 6 o 17) y los valores son los nombres de las funciones de callback a ejecutar.
 protocols={}
 #Valor inicial para el IPID
 IPID = 0
+#Protege IPID frente a envíos concurrentes desde varios hilos
+IPIDLock = Lock()
 #Valor de ToS por defecto
 DEFAULT_TOS = 0
 #Tamaño mínimo de la cabecera IP
@@ -25,31 +26,40 @@ DEFAULT_TTL = 64
 ICMP = 1
 TCP = 6
 UDP = 17
+#Bandera More Fragments dentro del campo banderas + offset
+IP_MF = 0x2000
+#Cabecera IPv4 sin opciones: versión+IHL, ToS, longitud total, IPID, banderas+offset, TTL, protocolo, checksum, IP origen, IP destino
+IPHeader = struct.Struct('!BBHHHBBH4s4s')
+#Campos que cambian en cada datagrama o fragmento: longitud total, IPID y banderas+offset (a partir del byte 2) y checksum (byte 10)
+IPHeaderVar = struct.Struct('!HHH')
+IPHeaderChecksum = struct.Struct('!H')
+#Caché de plantillas de cabecera por (IP destino, protocolo, opciones)
+headerTemplates = {}
+HEADER_TEMPLATES_MAX = 4096
+#Máscara del offset (en unidades de 8 bytes) dentro del campo banderas + offset
+IP_OFFSET_MASK = 0x1FFF
+#Tamaño máximo de un datagrama IP
+IP_MAX_LEN = 65535
+#Tiempo máximo (s) para completar un datagrama fragmentado
+REASS_TIMEOUT = 30
+#Memoria máxima de un datagrama en reensamblado y del total de datagramas en reensamblado
+REASS_DGRAM_MAX = IP_MAX_LEN
+REASS_MEM_MAX = 4*1024*1024
+#Datagramas en reensamblado por (IP origen, IP destino, IPID, protocolo), en orden de llegada del primer fragmento
+reassTable = OrderedDict()
+reassMem = 0
+reassLock = Lock()
+#Contadores del reensamblado
+reassStats = {'fragments':0,'reassembled':0,'timeouts':0,'overlaps':0,'evictions':0,'oversized':0}
+#Tabla de rutas: una tabla hash por longitud de prefijo (prefijo -> ipRoute) y longitudes en uso de mayor a menor
+routeTables = [{} for i in range(33)]
+routeLengths = []
+routeLock = Lock()
+#Caché de rutas por IP destino (entero de 32 bits -> ipRoute). Se vacía al cambiar la tabla
+routeCache = {}
+ROUTE_CACHE_MAX = 65536
 
 
-def chksum(msg):
-    '''
-        Nombre: chksum
-        Descripción: Esta función calcula el checksum IP sobre unos datos de entrada dados (msg)
-        Argumentos:
-            -msg: array de bytes con el contenido sobre el que se calculará el checksum
-        Retorno: Entero de 16 bits con el resultado del checksum en ORDEN DE RED
-    '''
-    s = 0
-    for i in range(0, len(msg), 2):
-        if (i+1) < len(msg):
-            a = msg[i]
-            b = msg[i+1]
-            s = s + (a+(b << 8))
-        elif (i+1)==len(msg):
-            s += msg[i]
-        else:
-            raise 'Error calculando el checksum'
-    s = s + (s >> 16)
-    s = ~s & 0xffff
-
-    return s
-
 def getMTU(interface):
     '''
         Nombre: getMTU
@@ -58,13 +68,13 @@ def getMTU(interface):
             -interface: cadena con el nombre la interfaz sobre la que consultar la MTU
         Retorno: Entero con el valor de la MTU para la interfaz especificada
     '''
-    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
-    ifr = struct.pack('16sH', interface.encode("utf-8"), 0)
-    mtu = struct.unpack('16sH', ioctl(s,SIOCGIFMTU, ifr))[1]
-
-    s.close()
-
-    return mtu
+    vif = getVirtualInterface(interface)
+    if vif is not None:
+        return vif.mtu
+    info = getInterfaceInfo(interface)
+    if info is None:
+        return None
+    return info.mtu
 
 def getNetmask(interface):
     '''
@@ -74,14 +84,13 @@ def getNetmask(interface):
             -interface: cadena con el nombre la interfaz sobre la que consultar la máscara
         Retorno: Entero de 32 bits con el valor de la máscara de red
     '''
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    ip = fcntl.ioctl(
-        s.fileno(),
-       SIOCGIFNETMASK,
-        struct.pack('256s', (interface[:15].encode('utf-8')))
-    )[20:24]
-    s.close()
-    return struct.unpack('!I',ip)[0]
+    vif = getVirtualInterface(interface)
+    if vif is not None:
+        return vif.netmask
+    info = getInterfaceInfo(interface)
+    if info is None:
+        return None
+    return info.netmask
 
 
 def getDefaultGW(interface):
@@ -90,14 +99,388 @@ def getDefaultGW(interface):
         Descripción: Esta función obteiene el gateway por defecto para una interfaz dada
         Argumentos:
             -interface: cadena con el nombre la interfaz sobre la que consultar el gateway
-        Retorno: Entero de 32 bits con la IP del gateway
+        Retorno: Entero de 32 bits con la IP del gateway (0 si la interfaz no tiene ruta por defecto)
+    '''
+    vif = getVirtualInterface(interface)
+    if vif is not None:
+        return vif.gw
+    porDefecto = [r for r in getInterfaceRoutes(interface) if r.length == 0 and r.gateway != 0]
+    if not porDefecto:
+        return 0
+    return min(porDefecto,key=lambda r: r.metric).gateway
+
+
+
+class ipRoute():
+    def __init__(self,prefix,length,gateway,interface,metric):
+        self.prefix = prefix
+        self.length = length
+        self.gateway = gateway
+        self.interface = interface
+        self.metric = metric
+
+
+def prefixMask(length):
+    '''
+        Nombre: prefixMask
+        Descripción: Devuelve la máscara de red correspondiente a una longitud de prefijo
+        Argumentos:
+            -length: longitud del prefijo (0 a 32)
+        Retorno: Entero de 32 bits con la máscara
+    '''
+    return (0xFFFFFFFF << (32-length)) & 0xFFFFFFFF
+
+
+def addRoute(prefix,length,gateway=0,interface=None,metric=0):
+    '''
+        Nombre: addRoute
+        Descripción: Añade una ruta a la tabla de rutas. Si ya existe una ruta para el mismo prefijo se sustituye salvo
+            que tenga una métrica menor
+        Argumentos:
+            -prefix: entero de 32 bits con la red destino (los bits fuera del prefijo se ignoran)
+            -length: longitud del prefijo (0 para la ruta por defecto)
+            -gateway: entero de 32 bits con la IP del siguiente salto o 0 si la red está directamente conectada
+            -interface: nombre de la interfaz de salida
+            -metric: métrica de la ruta
+        Retorno: Ninguno
     '''
-    p = subprocess.Popen(['ip r | grep default | awk \'{print $3}\''], stdout=subprocess.PIPE, shell=True)
-    dfw = p.stdout.read().decode('utf-8')
-    print(dfw)
-    return struct.unpack('!I',socket.inet_aton(dfw))[0]
+    prefix &= prefixMask(length)
+    with routeLock:
+        tabla = routeTables[length]
+        actual = tabla.get(prefix)
+        if actual is not None and actual.metric < metric:
+            return
+        tabla[prefix] = ipRoute(prefix,length,gateway,interface,metric)
+        if length not in routeLengths:
+            routeLengths.append(length)
+            routeLengths.sort(reverse=True)
+        routeCache.clear()
 
 
+def delRoute(prefix,length):
+    '''
+        Nombre: delRoute
+        Descripción: Elimina de la tabla de rutas la ruta a prefix/length
+        Argumentos:
+            -prefix: entero de 32 bits con la red destino
+            -length: longitud del prefijo
+        Retorno: True si la ruta existía, False en otro caso
+    '''
+    prefix &= prefixMask(length)
+    with routeLock:
+        tabla = routeTables[length]
+        if tabla.pop(prefix,None) is None:
+            return False
+        if not tabla:
+            routeLengths.remove(length)
+        routeCache.clear()
+    return True
+
+
+def flushRoutes():
+    '''
+        Nombre: flushRoutes
+        Descripción: Vacía la tabla de rutas
+        Argumentos: Ninguno
+        Retorno: Ninguno
+    '''
+    with routeLock:
+        for tabla in routeTables:
+            tabla.clear()
+        del routeLengths[:]
+        routeCache.clear()
+
+
+def loadRoutes(interface=None,path='/proc/net/route'):
+    '''
+        Nombre: loadRoutes
+        Descripción: Añade a la tabla de rutas las rutas activas de un fichero con el formato de /proc/net/route
+            (direcciones en hexadecimal en el orden de bytes de la máquina)
+        Argumentos:
+            -interface: si no es None solo se cargan las rutas de esa interfaz
+            -path: ruta del fichero a leer
+        Retorno: Número de rutas añadidas
+    '''
+    n = 0
+    for r in readProcRoutes(path):
+        if interface is None or r.interface == interface:
+            addRoute(r.prefix,r.length,r.gateway,r.interface,r.metric)
+            n += 1
+    return n
+
+
+def lookupRoute(dstIP):
+    '''
+        Nombre: lookupRoute
+        Descripción: Busca la ruta con el prefijo más largo que contiene a dstIP. Se consulta una tabla hash por cada
+            longitud de prefijo en uso, de la más larga a la más corta, así que el coste es como mucho proporcional a la
+            longitud del prefijo e independiente del número de rutas. El resultado se guarda en routeCache
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino
+        Retorno: ipRoute o None si no hay ninguna ruta
+    '''
+    ruta = routeCache.get(dstIP)
+    if ruta is not None:
+        return ruta
+    with routeLock:
+        for length in routeLengths:
+            ruta = routeTables[length].get(dstIP & prefixMask(length))
+            if ruta is not None:
+                if len(routeCache) >= ROUTE_CACHE_MAX:
+                    routeCache.clear()
+                routeCache[dstIP] = ruta
+                return ruta
+    return None
+
+
+def getNextHop(dstIP):
+    '''
+        Nombre: getNextHop
+        Descripción: Esta función obtiene la IP cuya MAC hay que resolver para enviar un datagrama a dstIP según la tabla
+            de rutas: la propia dstIP si la red está directamente conectada o el gateway de la ruta en otro caso
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino del datagrama
+        Retorno: Entero de 32 bits con la IP del siguiente salto o None si no hay ruta
+    '''
+    ruta = lookupRoute(dstIP)
+    if ruta is None:
+        logging.debug("No hay ruta")
+        return None
+    if ruta.gateway == 0:
+        logging.debug("Envio en mi subred")
+        return dstIP
+    logging.debug("Envio fuera de mi subred")
+    return ruta.gateway
+
+
+class ipHeaderTemplate():
+    '''
+        Plantilla de cabecera IP para un destino, protocolo y opciones dados. Guarda la cabecera con los campos variables
+        a 0 y la suma parcial del checksum de la parte fija, de modo que cada datagrama solo suma y escribe
+        longitud total, IPID, banderas+offset y checksum.
+    '''
+    def __init__(self,dstIP,protocol,opts):
+        if len(opts) % 4 != 0:
+            #Las opciones se rellenan con ceros (End of Options List) hasta un múltiplo de 4 bytes
+            opts = opts + bytes(4-len(opts) % 4)
+        hlen = IP_MIN_HLEN+len(opts)
+        self.header = bytearray(IPHeader.pack(0x40 | (hlen >> 2),DEFAULT_TOS,0,0,0,DEFAULT_TTL,protocol,0,
+            myIP,dstIP.to_bytes(4, byteorder='big')))
+        self.header += opts
+        self.sum = checksum_partial(self.header)
+
+
+def getIPHeaderTemplate(dstIP,protocol,opts=None):
+    '''
+        Nombre: getIPHeaderTemplate
+        Descripción: Devuelve (creándola si no existe) la plantilla de cabecera para dstIP, protocol y opts
+        Argumentos:
+            -dstIP: entero de 32 bits con la IP destino
+            -protocol: valor del campo protocolo
+            -opts: bytes con las opciones IP. Si es None se usan las opciones actuales (ipOpts)
+        Retorno: Plantilla ipHeaderTemplate
+    '''
+    if opts is None:
+        opts = bytes(ipOpts) if ipOpts is not None else b''
+    key = (dstIP,protocol,opts)
+    tpl = headerTemplates.get(key)
+    if tpl is None:
+        if len(headerTemplates) >= HEADER_TEMPLATES_MAX:
+            headerTemplates.clear()
+        tpl = ipHeaderTemplate(dstIP,protocol,opts)
+        headerTemplates[key] = tpl
+    return tpl
+
+
+def copiedIPOptions(opts):
+    '''
+        Nombre: copiedIPOptions
+        Descripción: Devuelve las opciones IP que deben repetirse en todos los fragmentos (bit de copia a 1).
+            El resto solo viajan en el primer fragmento
+        Argumentos:
+            -opts: bytes con las opciones IP
+        Retorno: bytes con las opciones que se copian en los fragmentos
+    '''
+    copiadas = bytearray()
+    i = 0
+    while i < len(opts):
+        tipo = opts[i]
+        if tipo == 0:           #End of Options List
+            break
+        if tipo == 1:           #No Operation
+            i += 1
+            continue
+        if i+1 >= len(opts) or opts[i+1] < 2:
+            break
+        longitud = opts[i+1]
+        if tipo & 0x80:
+            copiadas += opts[i:i+longitud]
+        i += longitud
+    return bytes(copiadas)
+
+
+@lru_cache(maxsize=256)
+def fragmentPlan(length,firstMax,restMax):
+    '''
+        Nombre: fragmentPlan
+        Descripción: Calcula los límites de todos los fragmentos de un datagrama. Se guarda en caché por tamaños, ya que
+            los mismos tamaños de datos y MTU se repiten de un datagrama a otro
+        Argumentos:
+            -length: longitud de los datos a fragmentar
+            -firstMax: máximo de datos del primer fragmento (múltiplo de 8)
+            -restMax: máximo de datos del resto de fragmentos (múltiplo de 8)
+        Retorno: Tupla de tuplas (offset, tamaño, banderas+offset) de cada fragmento
+    '''
+    plan = []
+    offset = 0
+    maximo = firstMax
+    while offset < length:
+        tamanyo = min(maximo,length-offset)
+        flags_offset = offset >> 3
+        if offset+tamanyo < length:
+            flags_offset |= IP_MF
+        plan.append((offset,tamanyo,flags_offset))
+        offset += tamanyo
+        maximo = restMax
+    return tuple(plan)
+
+
+def buildIPHeader(tpl,totalLen,ipid,flagsOffset):
+    '''
+        Nombre: buildIPHeader
+        Descripción: Construye una cabecera IP a partir de una plantilla, escribiendo los campos variables y el checksum
+        Argumentos:
+            -tpl: plantilla ipHeaderTemplate
+            -totalLen: longitud total del datagrama o fragmento (cabecera + datos)
+            -ipid: valor del IPID
+            -flagsOffset: banderas y offset (en unidades de 8 bytes) del fragmento
+        Retorno: bytearray con la cabecera IP
+    '''
+    s = tpl.sum+totalLen+ipid+flagsOffset
+    s = (s & 0xFFFF)+(s >> 16)
+    s = (s & 0xFFFF)+(s >> 16)
+    cabecera = bytearray(tpl.header)
+    IPHeaderVar.pack_into(cabecera,2,totalLen,ipid,flagsOffset)
+    IPHeaderChecksum.pack_into(cabecera,10,~s & 0xFFFF)
+    return cabecera
+
+
+class ipReassembly():
+    '''
+        Datagrama en reensamblado. Los huecos que faltan se guardan como descriptores [inicio,fin) (RFC 815) y los datos
+        se copian directamente en su posición de un único buffer, que crece por duplicación mientras no se conoce la
+        longitud total y se ajusta a ella al llegar el último fragmento.
+    '''
+    def __init__(self,now):
+        self.buf = bytearray()
+        self.holes = [(0,IP_MAX_LEN)]
+        self.total = None
+        self.expires = now+REASS_TIMEOUT
+
+
+def expireReassembly(now):
+    '''
+        Nombre: expireReassembly
+        Descripción: Descarta los datagramas cuyo tiempo de reensamblado ha expirado y, si se supera REASS_MEM_MAX, los
+            más antiguos hasta volver a estar por debajo. Debe llamarse con reassLock adquirido.
+        Argumentos:
+            -now: instante actual (time.monotonic)
+        Retorno: Ninguno
+    '''
+    global reassMem
+    while reassTable:
+        key,r = next(iter(reassTable.items()))
+        if r.expires <= now:
+            reassStats['timeouts'] += 1
+        elif reassMem > REASS_MEM_MAX:
+            reassStats['evictions'] += 1
+        else:
+            break
+        del reassTable[key]
+        reassMem -= len(r.buf)
+
+
+def reassembleFragment(key,offset,payload,more):
+    '''
+        Nombre: reassembleFragment
+        Descripción: Añade un fragmento al datagrama identificado por key. Los fragmentos que solapan con datos ya
+            recibidos se descartan (se conserva lo primero que llegó) y se cuentan en reassStats['overlaps']. Si el
+            datagrama supera REASS_DGRAM_MAX o es incoherente se descarta entero.
+        Argumentos:
+            -key: tupla (IP origen, IP destino, IPID, protocolo)
+            -offset: posición en bytes de los datos del fragmento dentro del datagrama original
+            -payload: datos del fragmento
+            -more: True si el fragmento tiene el bit MF activo
+        Retorno: bytearray con los datos del datagrama completo o None si aún faltan fragmentos
+    '''
+    global reassMem
+    end = offset+len(payload)
+    now = time.monotonic()
+    with reassLock:
+        reassStats['fragments'] += 1
+        expireReassembly(now)
+        r = reassTable.get(key)
+        #Los fragmentos intermedios deben llevar un múltiplo de 8 bytes y nada puede pasar del tamaño máximo
+        if end > REASS_DGRAM_MAX or (more and len(payload) & 7) or (more and len(payload) == 0):
+            reassStats['oversized'] += 1
+            if r is not None:
+                del reassTable[key]
+                reassMem -= len(r.buf)
+            return None
+        if r is None:
+            r = ipReassembly(now)
+            reassTable[key] = r
+        #Buscamos el hueco que contiene al fragmento. Si no hay ninguno, solapa con datos ya recibidos
+        for i,(inicio,fin) in enumerate(r.holes):
+            if inicio <= offset and end <= fin:
+                break
+        else:
+            reassStats['overlaps'] += 1
+            return None
+        if not more:
+            if r.total is not None or fin != IP_MAX_LEN:
+                #Dos últimos fragmentos distintos, o datos recibidos más allá del final
+                reassStats['overlaps'] += 1
+                del reassTable[key]
+                reassMem -= len(r.buf)
+                return None
+            r.total = end
+        nuevos = []
+        if inicio < offset:
+            nuevos.append((inicio,offset))
+        if end < fin and (more or fin != IP_MAX_LEN):
+            nuevos.append((end,fin))
+        r.holes[i:i+1] = nuevos
+        #Reservamos espacio: la longitud exacta si ya se conoce, si no crecemos por duplicación
+        tamanyo = r.total if r.total is not None else max(end,min(2*len(r.buf),REASS_DGRAM_MAX))
+        if len(r.buf) < tamanyo:
+            reassMem += tamanyo-len(r.buf)
+            r.buf.extend(bytes(tamanyo-len(r.buf)))
+        r.buf[offset:end] = payload
+        if r.holes:
+            if reassMem > REASS_MEM_MAX:
+                expireReassembly(now)
+            return None
+        del reassTable[key]
+        reassMem -= len(r.buf)
+        reassStats['reassembled'] += 1
+    del r.buf[r.total:]
+    return r.buf
+
+
+def getReassemblyStats():
+    '''
+        Nombre: getReassemblyStats
+        Descripción: Devuelve los contadores del reensamblado de datagramas IP
+        Argumentos: Ninguno
+        Retorno: Diccionario con los contadores, el número de datagramas pendientes y la memoria que ocupan
+    '''
+    with reassLock:
+        stats = dict(reassStats)
+        stats['pending'] = len(reassTable)
+        stats['memory'] = reassMem
+    return stats
+
 
 def process_IP_datagram(us,header,data,srcMac):
     '''
@@ -108,7 +491,8 @@ def process_IP_datagram(us,header,data,srcMac):
                 -Extraer los campos de la cabecera IP (includa la longitud de la cabecera)
                 -Calcular el checksum sobre los bytes de la cabecera IP
                     -Comprobar que el resultado del checksum es 0. Si es distinto el datagrama se deja de procesar
-                -Analizar los bits de de MF y el offset. Si el offset tiene un valor != 0 dejar de procesar el datagrama (no vamos a reensamblar)
+                -Analizar los bits de de MF y el offset. Si el datagrama es un fragmento se pasa a reassembleFragment y
+                solo se continúa cuando se ha completado el datagrama original
                 -Loggear (usando logging.debug) el valor de los siguientes campos:
                     -Longitud de la cabecera IP
                     -IPID
@@ -130,22 +514,24 @@ def process_IP_datagram(us,header,data,srcMac):
     '''
     global ipOpts
 
-    if ipOpts is None:
-        print(data[:20])
-        if chksum(data[:20]) != 0:
-            print("error cheksum\n")
-            return
-        print("Header IP checksum correcto")
-    else:
-        if chksum(data[:60]) != 0:
-            print("error cheksum con opciones\n")
-            return
-        print("Header IP checksum correcto con opciones")
+    #La longitud de la cabecera (con opciones) se toma del campo IHL del propio datagrama
+    ihl = (data[0] & 0x0F)*4
+    #La longitud total descarta el relleno que Ethernet añade a las tramas pequeñas
+    total = struct.unpack('!H',data[2:4])[0]
+    if ihl < IP_MIN_HLEN or total < ihl or chksum(data[:ihl]) != 0:
+        print("error cheksum\n")
+        return
+    print("Header IP checksum correcto")
 
     print("PROCESS IP FRAME")
-    if data[6:8] == '0x0000':
-        print("No reensamblar")
-        return
+    payload = data[ihl:total]
+    flagsOffset = struct.unpack('!H',data[6:8])[0]
+    if flagsOffset & (IP_MF | IP_OFFSET_MASK):
+        key = (bytes(data[12:16]),bytes(data[16:20]),bytes(data[4:6]),data[9])
+        payload = reassembleFragment(key,(flagsOffset & IP_OFFSET_MASK)*8,payload,bool(flagsOffset & IP_MF))
+        if payload is None:
+            return
+        logging.debug("Datagrama reensamblado")
 
     logging.debug("Longitud cabecera: {}".format(data[0:1])) #IHL (Longitud de cabecera)
     logging.debug("IPID:{}".format(data[4:6])) #IPID
@@ -157,10 +543,7 @@ def process_IP_datagram(us,header,data,srcMac):
     if struct.unpack('!B', data[9:10])[0] in protocols:
         print("En ip tenemos protocolo de nivel superior :{}".format(struct.unpack('!B', data[9:10])[0]))
         funcion = protocols[struct.unpack('!B', data[9:10])[0]]
-        if ipOpts is None:                  #si no hay opciones mandamos el payload desde el byte 20
-            funcion(us,header,data[20:],data[12:16])    #pasamos la IP origen es decir la que nos han enviado
-        else:
-            funcion(us,header,data[60:],data[12:16])
+        funcion(us,header,payload,data[12:16])    #pasamos la IP origen es decir la que nos han enviado
 
 
 def registerIPProtocol(callback,protocol):
@@ -194,8 +577,8 @@ def registerIPProtocol(callback,protocol):
     else:
         return
 
-def initIP(interface,opts=None):
-    global myIP, MTU, netmask, defaultGW,ipOpts
+def initIP(interface,opts=None,arpSnapshot=None):
+    global myIP, MTU, netmask, defaultGW,ipOpts,reassMem
     '''
         Nombre: initIP
         Descripción: Esta función inicializará el nivel IP. Esta función debe realizar, al menos, las siguientes tareas:
@@ -210,19 +593,34 @@ def initIP(interface,opts=None):
         Argumentos:
             -interface: cadena de texto con el nombre de la interfaz sobre la que inicializar ip
             -opts: array de bytes con las opciones a nivel IP a incluir en los datagramas o None si no hay opciones a añadir
+            -arpSnapshot: fichero con la caché ARP a cargar y guardar al parar (ver initARP) o None
         Retorno: True o False en función de si se ha inicializado el nivel o no
     '''
-    if initARP(interface) == False:
+    if initARP(interface,arpSnapshot) == False:
         return False
 
     myIP = getIP(interface)                     
-    myIP = myIP.to_bytes(4, byteorder='big')    #bytes
     MTU = getMTU(interface)                     #entero 32 bits
     netmask = getNetmask(interface)
-    netmask = netmask.to_bytes(4, byteorder='big')  #bytes
     defaultGW = getDefaultGW(interface)
+    if myIP is None or MTU is None or netmask is None:
+        return False
+    myIP = myIP.to_bytes(4, byteorder='big')    #bytes
+    netmask = netmask.to_bytes(4, byteorder='big')  #bytes
     defaultGW = defaultGW.to_bytes(4, byteorder='big') #bytes
     ipOpts = opts
+    headerTemplates.clear()
+    #Tabla de rutas: la red de la interfaz, la ruta por defecto y, si es una interfaz real, las rutas del sistema
+    flushRoutes()
+    addRoute(int.from_bytes(myIP,'big'),bin(int.from_bytes(netmask,'big')).count('1'),0,interface)
+    if int.from_bytes(defaultGW,'big') != 0:
+        addRoute(0,0,int.from_bytes(defaultGW,'big'),interface)
+    if getVirtualInterface(interface) is None:
+        for r in getInterfaceRoutes(interface):
+            addRoute(r.prefix,r.length,r.gateway,r.interface,r.metric)
+    with reassLock:
+        reassTable.clear()
+        reassMem = 0
     registerCallback(process_IP_datagram, b'\x08\x00')
     if myIP is None or MTU is None or netmask is None or defaultGW is None:
         return False
@@ -255,231 +653,51 @@ def sendIPDatagram(dstIP,data,protocol):
             -data: array de bytes con los datos a incluir como payload en el datagrama
             -protocol: valor numérico del campo IP protocolo que indica el protocolo de nivel superior de los datos
             contenidos en el payload. Por ejemplo 1, 6 o 17.
-        Retorno: True o False en función de si se ha enviado el datagrama correctamente o no
+        Retorno: True si se ha enviado el datagrama (o ha quedado en cola a la espera de la resolución ARP), False en otro caso
 
     '''
-    #pdb.set_trace()
-    tamanio_fragmento = 0
-    longitud_opciones = 0
-    if(ipOpts != None):
-        longitud_opciones = len(ipOpts)
-
-    header = bytes() #Header auxiliar para calcular el checksum
-    header_final = bytes()
-    #primer_byte = bytes()
-    tamanio_datagrama = 20+longitud_opciones+len(data)
-
-    print("Tamanio data", len(data))
-
-    tam_header = bytearray()
-    #header += b'\x00'
-    primer_byte = "{0:04b}".format(4) #Version
-
-    tam_header = 20 + longitud_opciones
-    tam_header = tam_header//4
-
-    primer_byte += "{0:04b}".format(tam_header)
-    print(primer_byte)
-    dato = 0x00
-
-    i = 0
-    b = 7
-    while i < len(primer_byte):
-        dato=dato|(int(primer_byte[i])<<b)
-        i+=1
-        b-=1
-
-
-    print(dato.to_bytes(1, byteorder='big'))
-
-    header += dato.to_bytes(1, byteorder='big') #Version e IHL
-    header += b'\x00' #Type of service
-    header += tamanio_datagrama.to_bytes(2, byteorder='big') #Longitud total del datagrama
-    header += IPID.to_bytes(2, byteorder='big') #Identificador
-
-    if len(data)+longitud_opciones+20 <= MTU: #enviamos paquete completo
-        header += b'\x00\x00' #Flags + offset
-        header += b'\x40' #Time to live
-        header += protocol.to_bytes(1, byteorder='big')
-        header += b'\x00\x00' #Por defecto 0
-        header += myIP
-        header += dstIP.to_bytes(4, byteorder='big')
-        if(ipOpts != None):
-            header += ipOpts
-        checksum = chksum(header)
-
-
-
-        #header_final += bytes(hex(dato),encoding='utf8') #Version e IHL
-
-        header_final += dato.to_bytes(1, byteorder='big')
-        header_final += b'\x00' #Type of service
-        header_final += tamanio_datagrama.to_bytes(2, byteorder='big') #Longitud total del datagrama
-        header_final += IPID.to_bytes(2, byteorder='big') #Identificador
-        header_final += b'\x00\x00' #Flags + offset
-        header_final += b'\x40' #Time to live
-        header_final += protocol.to_bytes(1, byteorder='big') #protocolo
-        header_final += checksum.to_bytes(2, byteorder='little') #cheksum calculado previamente
-        #header_final += b'\x00\x00' #Por defecto 0
-        header_final += myIP #Ip origen
-        header_final += dstIP.to_bytes(4, byteorder='big') #Ip destino
-        if(ipOpts != None):
-            header_final += ipOpts
-
-        print("vamos a enviar unos datos", data)
-        print("con cabecera:", header_final)
-        print("y checksum:", checksum)
-        header_final += data
-
-        #Enviamos el datagrama
-        if (dstIP.to_bytes(4, byteorder='big')[0] & netmask[0]) == (myIP[0] & netmask[0]):
-            mac = ARPResolution(dstIP)
-            print("Envio datagrama en mi subred...\n")
-            print(header_final)
-            if sendEthernetFrame(header_final,len(header_final),b'\x08\x00',mac) == -1:
-                return False
-        else:
-            print("Envio datagrama fuera de mi subred...\n")
-            mac = ARPResolution(defaultGW)
-            if sendEthernetFrame(header_final,len(header_final),b'\x08\x00',mac) == -1:
-                return False
-        IPID+=1
+    tpl = getIPHeaderTemplate(dstIP,protocol)
+    hlen = len(tpl.header)
+    datos = memoryview(data)
+    with IPIDLock:
+        ipid = IPID
+        IPID = (IPID+1) & 0xFFFF
+
+    if hlen+len(datos) <= MTU: #enviamos paquete completo
+        datagramas = [(buildIPHeader(tpl,hlen+len(datos),ipid,0),datos)]
     else: #aqui fragmentamos
-        header_fragmento = bytes()
-
-        header += dato.to_bytes(1, byteorder='big') #Version e IHL
-        header += b'\x00' #Type of service
-        
-
-        tam_max_fragmento = MTU - 20 - longitud_opciones
-        aux = tam_max_fragmento
-        while(aux % 8 != 0):                                       
-            aux-=1
-
-        tam_max_fragmento = aux #1480 en el ejemplo
-        tamanio_fragmento = tam_max_fragmento
-
-        header += tamanio_fragmento.to_bytes(2, byteorder='big') #Longitud total del fragmento
-        header += bytes([IPID]) #Identificador
-
-        num_fragmento = len(data)/tam_max_fragmento
-
-        if len(data) % tam_max_fragmento != 0:
-            num_fragmento = math.ceil(len(data)/tam_max_fragmento) #antes pusistes len(header) creo que es data
-
-        offset = 0
-        for i in range(num_fragmento):
-            header += b'\x00\x00' #Flags + offset
-            header += b'\x40' #Time to live
-            header += protocol.to_bytes(1, byteorder='big')
-            header += b'\x00\x00' #Por defecto 0
-            header += myIP
-            header += dstIP.to_bytes(4, byteorder='big')
-            if(ipOpts != None):
-                header += ipOpts
-
-            checksum = chksum(header)
-
-            #Enviamos el primer fragmento
-            if i == 0:
-                #Creamos el fragmento que vamos a enviar  partir de la cabecera (header base)
-
-                header_fragmento += dato.to_bytes(1, byteorder='big') #Version e IHL
-                header_fragmento += b'\x00' #Type of service
-                header_fragmento += tamanio_fragmento.to_bytes(2, byteorder='big') #Longitud total del datagrama
-                header_fragmento += bytes([IPID]) #Identificador
-                offset_flags_ini = 0x0000
-                offset_flags_ini = offset_flags_ini |(1 << 13) #MF = 1, offset = 0
-                header_fragmento += offset_flags_ini.to_bytes(2, byteorder='big') #Banderas IP y offset
-                header_fragmento += b'\x40' #Time to live
-                header_fragmento += protocol.to_bytes(1, byteorder='big')
-                header_fragmento += struct.pack('!H',checksum)
-                header_fragmento += myIP
-                header_fragmento += dstIP.to_bytes(4, byteorder='big')
-                if(ipOpts != None):
-                    header_fragmento += ipOpts
-
-                header_fragmento += data[0:tam_max_fragmento]
-
-                
-            #Enviamos el ultimo fragmento
-            elif i == num_fragmento-1:
-                #este ultimo tiene tamanyo (tam_max_fragmento - el anterior el de arriba del todo) - tam_max_fragmento (el de ahora)
-                header_fragmento += dato.to_bytes(1, byteorder='big') #Version e IHL
-                header_fragmento += b'\x00' #Type of service
-                header_fragmento += tamanio_fragmento.to_bytes(2, byteorder='big') #Longitud total del datagrama
-                header_fragmento += bytes([IPID]) #Identificador
-
-                offset_flags = 0x0000
-                offset += tam_max_fragmento / 8
-                offset_bits = "{0:b}".format(int(offset))
-
-                i=len(offset_bits)-1
-                for bit in offset_bits:
-                    offset_flags=offset_flags|(int(bit) << i) #Offset
-                    i-=1
-                
-                cero = 0
-                offset_flags=offset_flags|(cero << 13) #MF = 0
-                offset_flags=offset_flags|(cero << 14) #DF = 0
-                offset_flags=offset_flags|(cero << 15) #Reservado 0
-
-                header_fragmento += offset_flags.to_bytes(2, byteorder='big') #Offset
-                header_fragmento += b'\x40' #Time to live
-                header_fragmento += protocol.to_bytes(1, byteorder='big')
-                header_fragmento += struct.pack('!H',checksum)
-                header_fragmento += myIP
-                header_fragmento += dstIP.to_bytes(4, byteorder='big')
-                if(ipOpts != None):
-                    header_fragmento += ipOpts
-                header_fragmento += data[tam_max_fragmento:]
-               
-            #Enviamos el resto de fragmentos
-            else:
-
-                header_fragmento += dato.to_bytes(1, byteorder='big') #Version e IHL
-                header_fragmento += b'\x00' #Type of service
-                header_fragmento += tamanio_fragmento.to_bytes(2, byteorder='big') #Longitud total del datagrama
-                header_fragmento += bytes([IPID]) #Identificador
-                offset += tam_max_fragmento/8 
-                offset_flags = 0x0000
-                offset_bits = "{0:b}".format(int(offset))
-
-                i=len(offset_bits)-1
-                for bit in offset_bits:
-                    offset_flags=offset_flags|(int(bit) << i) #Offset
-                    i-=1
-
-                uno = 1
-                offset_flags=offset_flags|(uno << 13) #MF = 1     
-                    
-                inicio_data = tam_max_fragmento
-                tam_max_fragmento = tam_max_fragmento + tam_max_fragmento
-                header_fragmento += offset_flags.to_bytes(2, byteorder='big')
-                header_fragmento += b'\x40' #Time to live
-                header_fragmento += protocol.to_bytes(1, byteorder='big')
-                header_fragmento += struct.pack('!H',checksum)
-                header_fragmento += myIP
-                header_fragmento += dstIP.to_bytes(4, byteorder='big')
-                if(ipOpts != None):
-                    header_fragmento += ipOpts
-                header_fragmento += data[inicio_data:tam_max_fragmento]
-
-            #para no liarse tanto
-            if (dstIP.to_bytes(4, byteorder='big')[0] & netmask[0]) == (myIP[0] & netmask[0]): #si esta en mi subred
-                mac = ARPResolution(dstIP)
-                print("Envio fragmento en mi subred")
-                if sendEthernetFrame(header_fragmento,len(header_fragmento),b'\x08\x00',mac) == -1:
-                    print("Error en envio")
-                    return False
-                header_fragmento = bytes()
-            else:
-                print("Envio fragmento fuera de mi subred")
-                mac = ARPResolution(defaultGW)
-                if sendEthernetFrame(header_fragmento,len(header_fragmento),b'\x08\x00',mac) == -1:
-                    return False
-                header_fragmento = bytes()
-            #IPID+=1 mira a ver esto, creo que esta mal dice que es de cada datagrama no fragmento pero...
-
+        #Los fragmentos siguientes al primero solo llevan las opciones con el bit de copia
+        tplResto = getIPHeaderTemplate(dstIP,protocol,copiedIPOptions(tpl.header[IP_MIN_HLEN:]))
+        hlenResto = len(tplResto.header)
+        #Los datos de cada fragmento (salvo el último) deben ser múltiplo de 8 bytes
+        plan = fragmentPlan(len(datos),(MTU-hlen) & ~7,(MTU-hlenResto) & ~7)
+        datagramas = []
+        for offset,tamanyo,flags_offset in plan:
+            t = tpl if offset == 0 else tplResto
+            datagramas.append((buildIPHeader(t,len(t.header)+tamanyo,ipid,flags_offset),datos[offset:offset+tamanyo]))
+
+    #Todos los fragmentos van al mismo siguiente salto: se resuelve una vez y se envían en lote
+    siguienteSalto = getNextHop(dstIP)
+    if siguienteSalto is None:
+        logging.error("No hay ruta hacia el destino")
+        return False
+    #Si su MAC no está en caché los datagramas esperan en la cola del vecino mientras se resuelve
+    if not sendToNeighbour(siguienteSalto,datagramas,b'\x08\x00'):
+        print("Error en envio")
+        return False
     return True
 
+
+async def sendIPDatagramAsync(dstIP,data,protocol):
+    '''
+        Nombre: sendIPDatagramAsync
+        Descripción: Variante awaitable de sendIPDatagram. Resuelve el siguiente salto con ARPResolutionAsync sin bloquear
+        el bucle de eventos y, una vez la MAC está en la caché ARP, construye y envía el datagrama con sendIPDatagram.
+        Argumentos: los mismos que sendIPDatagram
+        Retorno: True o False en función de si se ha enviado el datagrama correctamente o no
+    '''
+    siguienteSalto = getNextHop(dstIP)
+    if siguienteSalto is None or await ARPResolutionAsync(siguienteSalto) is None:
+        logging.error("No se ha podido resolver la MAC del siguiente salto")
+        return False
+    return sendIPDatagram(dstIP,data,protocol)
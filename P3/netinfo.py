@@ -0,0 +1,342 @@
+'''
+    netinfo.py
+    Descubrimiento de interfaces y rutas del sistema. Lee de una vez los atributos de todas las interfaces (MAC, MTU,
+    IP y máscara) y la tabla de rutas, y los guarda en caché para que getHwAddr, getIP, getMTU, getNetmask y
+    getDefaultGW no tengan que abrir un socket ni lanzar procesos en cada llamada.
+    Por defecto se usa rtnetlink (tres volcados: enlaces, direcciones y rutas). Si se fija un directorio raíz con
+    setNetInfoRoot (o no hay netlink) se leen <raíz>/sys/class/net y <raíz>/proc/net, lo que permite usar un /proc
+    falso en pruebas. watchNetInfo refresca la caché cuando el núcleo notifica cambios.
+'''
+
+import socket
+import struct
+import os
+import threading
+
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x001
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+RTN_UNICAST = 1
+#Grupos multicast de rtnetlink para recibir cambios de enlaces, direcciones IPv4 y rutas IPv4
+RTMGRP_LINK = 0x01
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+#Bandera RTF_UP de /proc/net/route
+RTF_UP = 0x0001
+
+#Cabecera nlmsghdr: longitud, tipo, banderas, número de secuencia y pid
+nlmsghdr = struct.Struct('=IHHII')
+#Cabecera rtattr: longitud y tipo
+rtattr = struct.Struct('=HH')
+#ifinfomsg: familia, tipo, índice, banderas y máscara de cambio
+ifinfomsg = struct.Struct('=BxHiII')
+#ifaddrmsg: familia, longitud de prefijo, banderas, ámbito e índice
+ifaddrmsg = struct.Struct('=BBBBI')
+#rtmsg: familia, longitud de destino y origen, ToS, tabla, protocolo, ámbito, tipo y banderas
+rtmsg = struct.Struct('=BBBBBBBBI')
+u32 = struct.Struct('=I')
+
+#Directorio raíz para leer /sys y /proc (None para usar rtnetlink)
+netInfoRoot = None
+#Última información leída (netinfo_t) y semáforo que la protege
+netInfo = None
+netInfoLock = threading.Lock()
+
+
+class netif_t():
+    def __init__(self,name,index,mac,mtu):
+        self.name = name
+        self.index = index
+        self.mac = mac
+        self.mtu = mtu
+        self.ip = None
+        self.netmask = None
+
+
+class netroute_t():
+    def __init__(self,prefix,length,gateway,interface,metric):
+        self.prefix = prefix
+        self.length = length
+        self.gateway = gateway
+        self.interface = interface
+        self.metric = metric
+
+
+class netinfo_t():
+    def __init__(self,interfaces,routes):
+        self.interfaces = interfaces
+        self.routes = routes
+
+
+def _attrs(data,off):
+    #Devuelve un diccionario tipo -> valor con los atributos rtattr a partir de off
+    attrs = {}
+    while off+rtattr.size <= len(data):
+        alen,atype = rtattr.unpack_from(data,off)
+        if alen < rtattr.size:
+            break
+        attrs[atype & 0x3FFF] = data[off+rtattr.size:off+alen]
+        off += (alen+3) & ~3
+    return attrs
+
+
+def _netlink_dump(sock,msgtype,body,seq):
+    #Envía una petición de volcado y devuelve la lista de (tipo, mensaje) recibidos hasta NLMSG_DONE
+    sock.send(nlmsghdr.pack(nlmsghdr.size+len(body),msgtype,NLM_F_REQUEST | NLM_F_DUMP,seq,0)+body)
+    msgs = []
+    while True:
+        data = sock.recv(65536)
+        off = 0
+        while off+nlmsghdr.size <= len(data):
+            mlen,mtype,flags,mseq,pid = nlmsghdr.unpack_from(data,off)
+            if mlen < nlmsghdr.size:
+                return msgs
+            if mtype == NLMSG_DONE:
+                return msgs
+            if mtype == NLMSG_ERROR:
+                raise OSError('error en el volcado netlink {}'.format(msgtype))
+            msgs.append((mtype,data[off+nlmsghdr.size:off+mlen]))
+            off += (mlen+3) & ~3
+
+
+def _ip2int(data):
+    return struct.unpack('!I',data)[0]
+
+
+def _prefixMask(length):
+    return (0xFFFFFFFF << (32-length)) & 0xFFFFFFFF
+
+
+def readNetlink():
+    '''
+        Nombre: readNetlink
+        Descripción: Lee las interfaces, sus direcciones IPv4 y las rutas IPv4 de la tabla principal mediante rtnetlink
+        Argumentos: Ninguno
+        Retorno: netinfo_t con la información leída
+    '''
+    interfaces = {}
+    routes = []
+    sock = socket.socket(socket.AF_NETLINK,socket.SOCK_RAW,NETLINK_ROUTE)
+    try:
+        sock.bind((0,0))
+        porIndice = {}
+        for mtype,msg in _netlink_dump(sock,RTM_GETLINK,ifinfomsg.pack(socket.AF_UNSPEC,0,0,0,0),1):
+            if mtype != RTM_NEWLINK:
+                continue
+            index = ifinfomsg.unpack_from(msg)[2]
+            attrs = _attrs(msg,ifinfomsg.size)
+            name = bytes(attrs.get(IFLA_IFNAME,b'')).rstrip(b'\x00').decode('utf-8')
+            mtu = u32.unpack(attrs[IFLA_MTU])[0] if IFLA_MTU in attrs else None
+            interfaces[name] = porIndice[index] = netif_t(name,index,bytes(attrs.get(IFLA_ADDRESS,b'')),mtu)
+        for mtype,msg in _netlink_dump(sock,RTM_GETADDR,ifaddrmsg.pack(socket.AF_INET,0,0,0,0),2):
+            if mtype != RTM_NEWADDR:
+                continue
+            family,prefixlen,flags,scope,index = ifaddrmsg.unpack_from(msg)
+            attrs = _attrs(msg,ifaddrmsg.size)
+            addr = attrs.get(IFA_LOCAL,attrs.get(IFA_ADDRESS))
+            itf = porIndice.get(index)
+            #Si una interfaz tiene varias direcciones nos quedamos con la primera (la principal)
+            if family == socket.AF_INET and addr is not None and itf is not None and itf.ip is None:
+                itf.ip = _ip2int(addr)
+                itf.netmask = _prefixMask(prefixlen)
+        for mtype,msg in _netlink_dump(sock,RTM_GETROUTE,rtmsg.pack(socket.AF_INET,0,0,0,0,0,0,0,0),3):
+            if mtype != RTM_NEWROUTE:
+                continue
+            family,dst_len,src_len,tos,table,proto,scope,rtype,flags = rtmsg.unpack_from(msg)
+            attrs = _attrs(msg,rtmsg.size)
+            if RTA_TABLE in attrs:
+                table = u32.unpack(attrs[RTA_TABLE])[0]
+            if family != socket.AF_INET or table != RT_TABLE_MAIN or rtype != RTN_UNICAST:
+                continue
+            itf = porIndice.get(u32.unpack(attrs[RTA_OIF])[0]) if RTA_OIF in attrs else None
+            routes.append(netroute_t(_ip2int(attrs[RTA_DST]) if RTA_DST in attrs else 0,dst_len,
+                _ip2int(attrs[RTA_GATEWAY]) if RTA_GATEWAY in attrs else 0,itf.name if itf is not None else None,
+                u32.unpack(attrs[RTA_PRIORITY])[0] if RTA_PRIORITY in attrs else 0))
+    finally:
+        sock.close()
+    return netinfo_t(interfaces,routes)
+
+
+def readProcRoutes(path='/proc/net/route'):
+    '''
+        Nombre: readProcRoutes
+        Descripción: Lee las rutas activas de un fichero con el formato de /proc/net/route (direcciones en hexadecimal
+            en el orden de bytes de la máquina)
+        Argumentos:
+            -path: ruta del fichero a leer
+        Retorno: Lista de netroute_t
+    '''
+    routes = []
+    with open(path) as f:
+        next(f)
+        for linea in f:
+            campos = linea.split()
+            if len(campos) < 8 or not int(campos[3],16) & RTF_UP:
+                continue
+            destino,gateway,mascara = (socket.ntohl(int(campos[i],16)) for i in (1,2,7))
+            routes.append(netroute_t(destino,bin(mascara).count('1'),gateway,campos[0],int(campos[6])))
+    return routes
+
+
+def _readFile(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def readProcfs(root='/'):
+    '''
+        Nombre: readProcfs
+        Descripción: Lee las interfaces de <root>/sys/class/net, las rutas de <root>/proc/net/route y las IPs locales de
+            <root>/proc/net/fib_trie. Cada IP local se asigna a la interfaz cuya red directamente conectada la contiene,
+            y la máscara es la de esa red.
+        Argumentos:
+            -root: directorio raíz bajo el que están sys y proc
+        Retorno: netinfo_t con la información leída
+    '''
+    interfaces = {}
+    base = os.path.join(root,'sys','class','net')
+    for name in sorted(os.listdir(base)):
+        d = os.path.join(base,name)
+        mac = bytes.fromhex(_readFile(os.path.join(d,'address')).replace(':',''))
+        interfaces[name] = netif_t(name,int(_readFile(os.path.join(d,'ifindex'))),mac,int(_readFile(os.path.join(d,'mtu'))))
+    routes = readProcRoutes(os.path.join(root,'proc','net','route'))
+    #En fib_trie cada dirección aparece en una línea "|-- a.b.c.d" seguida de "/32 host LOCAL" si es local
+    locales = []
+    ultima = None
+    with open(os.path.join(root,'proc','net','fib_trie')) as f:
+        for linea in f:
+            linea = linea.strip()
+            if linea.startswith('|--'):
+                ultima = linea.split()[1]
+            elif linea == '/32 host LOCAL' and ultima is not None:
+                locales.append(_ip2int(socket.inet_aton(ultima)))
+    for ip in locales:
+        conectadas = [r for r in routes if r.gateway == 0 and r.interface in interfaces and r.length > 0 and
+            ip & _prefixMask(r.length) == r.prefix]
+        if not conectadas:
+            continue
+        itf = interfaces[max(conectadas,key=lambda r: r.length).interface]
+        if itf.ip is None:
+            itf.ip = ip
+            itf.netmask = _prefixMask(max(conectadas,key=lambda r: r.length).length)
+    return netinfo_t(interfaces,routes)
+
+
+def setNetInfoRoot(root):
+    '''
+        Nombre: setNetInfoRoot
+        Descripción: Fija el directorio raíz del que leer /sys y /proc (None para volver a usar rtnetlink) y descarta
+            la información en caché
+        Argumentos:
+            -root: directorio raíz o None
+        Retorno: Ninguno
+    '''
+    global netInfoRoot,netInfo
+    with netInfoLock:
+        netInfoRoot = root
+        netInfo = None
+
+
+def refreshNetInfo():
+    '''
+        Nombre: refreshNetInfo
+        Descripción: Vuelve a leer las interfaces y las rutas y sustituye la información en caché
+        Argumentos: Ninguno
+        Retorno: netinfo_t con la información leída
+    '''
+    global netInfo
+    if netInfoRoot is not None:
+        info = readProcfs(netInfoRoot)
+    else:
+        try:
+            info = readNetlink()
+        except OSError:
+            info = readProcfs('/')
+    with netInfoLock:
+        netInfo = info
+    return info
+
+
+def getNetInfo():
+    '''
+        Nombre: getNetInfo
+        Descripción: Devuelve la información de interfaces y rutas en caché, leyéndola la primera vez
+        Argumentos: Ninguno
+        Retorno: netinfo_t
+    '''
+    info = netInfo
+    if info is None:
+        info = refreshNetInfo()
+    return info
+
+
+def getInterfaceInfo(interface):
+    '''
+        Nombre: getInterfaceInfo
+        Descripción: Devuelve los atributos de una interfaz del sistema
+        Argumentos:
+            -interface: nombre de la interfaz
+        Retorno: netif_t o None si la interfaz no existe
+    '''
+    return getNetInfo().interfaces.get(interface)
+
+
+def getInterfaceRoutes(interface):
+    '''
+        Nombre: getInterfaceRoutes
+        Descripción: Devuelve las rutas del sistema que salen por una interfaz
+        Argumentos:
+            -interface: nombre de la interfaz
+        Retorno: Lista de netroute_t
+    '''
+    return [r for r in getNetInfo().routes if r.interface == interface]
+
+
+def watchNetInfo(callback=None):
+    '''
+        Nombre: watchNetInfo
+        Descripción: Arranca un hilo que escucha las notificaciones de rtnetlink sobre enlaces, direcciones IPv4 y rutas
+            IPv4, refresca la caché con cada una y llama a callback(netinfo_t) si no es None
+        Argumentos:
+            -callback: función a llamar tras cada refresco
+        Retorno: Hilo arrancado o None si no se ha podido abrir el socket netlink
+    '''
+    try:
+        sock = socket.socket(socket.AF_NETLINK,socket.SOCK_RAW,NETLINK_ROUTE)
+        sock.bind((0,RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+    except OSError:
+        return None
+
+    def run():
+        while True:
+            try:
+                sock.recv(65536)
+            except OSError:
+                return
+            info = refreshNetInfo()
+            if callback is not None:
+                callback(info)
+
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return t
@@ -40,6 +40,8 @@ if __name__ == "__main__":
     parser.add_argument('--dstIP',dest='dstIP',default = False,help='Dirección IP destino')
     parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
     parser.add_argument('--addOptions', dest='addOptions', default=False, action='store_true',help='Añadir opciones a los datagranas IP')
+    parser.add_argument('--backend',dest='backend',default='pcap',choices=['pcap','afpacket'],help='Acceso a la interfaz: libpcap o anillos AF_PACKET')
+    parser.add_argument('--arpCache',dest='arpCache',default=None,help='Fichero en el que conservar la caché ARP entre ejecuciones')
     parser.add_argument('--dataFile',dest='dataFile',default = False,help='Fichero con datos a enviar')
     args = parser.parse_args()
 
@@ -70,11 +72,11 @@ if __name__ == "__main__":
             #Pasamos los datos de cadena a bytes
             data = data.encode()
     
-    startEthernetLevel(args.interface)    
+    startEthernetLevel(args.interface,ioBackend=args.backend)
     initICMP()
     initUDP()
 
-    if initIP(args.interface,ipOpts) == False:
+    if initIP(args.interface,ipOpts,args.arpCache) == False:
         logging.error('Inicializando nivel IP')
         sys.exit(-1)
         
@@ -0,0 +1,89 @@
+'''
+    pruebaVirtual.py
+    Prueba de carga de la pila (ARP, IP con fragmentación, ICMP y UDP) sobre un enlace virtual en memoria.
+    No necesita tarjeta de red ni permisos de root: cada host es un proceso con su propia instancia de la pila
+    conectado a un enlace creado con vlink_create.
+    Ejemplo: python3 pruebaVirtual.py --num 1000 --size 3000 --latency 0.001 --loss 0.01
+'''
+
+import vlink
+from ethernet import *
+from ip import *
+import icmp
+import udp
+
+import sys
+import os
+import argparse
+import multiprocessing
+import time
+import logging
+
+NETMASK = '255.255.255.0'
+IP_SERVIDOR = '10.0.0.1'
+IP_CLIENTE = '10.0.0.2'
+MAC_SERVIDOR = bytes([0x02,0,0,0,0,1])
+MAC_CLIENTE = bytes([0x02,0,0,0,0,2])
+DST_PORT = 7
+
+
+def contar(contador,funcion):
+    def callback(us,header,data,srcIp):
+        with contador.get_lock():
+            contador.value += 1
+        funcion(us,header,data,srcIp)
+    return callback
+
+
+def host(link,port,mac,myIP,args,recibidos,listo,fin):
+    if not args.verbose:
+        sys.stdout = open(os.devnull,'w')
+    vlink.addVirtualInterface('veth{}'.format(port),link,port,mac,myIP,NETMASK)
+    startEthernetLevel('veth{}'.format(port))
+    icmp.initICMP()
+    udp.initUDP()
+    initIP('veth{}'.format(port))
+    #Contamos los mensajes ICMP y UDP entregados por IP a cada host
+    protocols[icmp.ICMP_PROTO] = contar(recibidos,protocols[icmp.ICMP_PROTO])
+    protocols[udp.UDP_PROTO] = contar(recibidos,protocols[udp.UDP_PROTO])
+    listo.wait()
+    if port == 1:
+        data = bytes(args.size)
+        dst = struct.unpack('!I',socket.inet_aton(IP_SERVIDOR))[0]
+        t = time.time()
+        for i in range(args.num):
+            icmp.sendICMPMessage(data,icmp.ICMP_ECHO_REQUEST_TYPE,0,1,i % 65536,dst)
+            udp.sendUDPDatagram(data,DST_PORT,dst)
+        t = time.time()-t
+        sys.__stdout__.write('Cliente: {} pings y {} datagramas UDP de {} bytes enviados en {:.3f} s\n'.format(args.num,args.num,args.size,t))
+        #Margen para que lleguen las últimas respuestas
+        time.sleep(args.latency*4+0.5)
+        fin.set()
+    fin.wait()
+    stopEthernetLevel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prueba de carga de la pila sobre un enlace virtual en memoria')
+    parser.add_argument('--num', dest='num', type=int, default=100,help='Número de pings y de datagramas UDP a enviar')
+    parser.add_argument('--size', dest='size', type=int, default=64,help='Tamaño de los datos de cada mensaje')
+    parser.add_argument('--mtu', dest='mtu', type=int, default=1500,help='MTU del enlace')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0,help='Latencia del enlace en segundos')
+    parser.add_argument('--loss', dest='loss', type=float, default=0.0,help='Probabilidad de pérdida de cada trama')
+    parser.add_argument('--verbose', dest='verbose', default=False, action='store_true',help='Mostrar la salida de la pila')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.WARNING, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+
+    link = vlink.vlink_create(2,args.mtu,args.latency,args.loss)
+    recibidos = [multiprocessing.Value('i',0) for i in range(2)]
+    listo = multiprocessing.Barrier(2)
+    fin = multiprocessing.Event()
+    hosts = [multiprocessing.Process(target=host,args=(link,0,MAC_SERVIDOR,IP_SERVIDOR,args,recibidos[0],listo,fin)),
+        multiprocessing.Process(target=host,args=(link,1,MAC_CLIENTE,IP_CLIENTE,args,recibidos[1],listo,fin))]
+    for p in hosts:
+        p.start()
+    for p in hosts:
+        p.join()
+    print('Servidor: {} mensajes ICMP/UDP recibidos'.format(recibidos[0].value))
+    print('Cliente: {} mensajes ICMP recibidos (respuestas a ping)'.format(recibidos[1].value))
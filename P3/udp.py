@@ -1,4 +1,5 @@
 import ip
+from checksum import chksum, pseudo_header_sum
 import struct
 import logging
 import socket
@@ -43,6 +44,12 @@ def process_UDP_datagram(us,header,data,srcIP):
 
     '''
     print("PROCESS UDP DATAGRAM")
+    #Un checksum a 0 indica que el emisor no lo ha calculado
+    if len(data) < UDP_HLEN:
+        return
+    if data[6:8] != b'\x00\x00' and chksum(data,pseudo_header_sum(srcIP,ip.myIP,UDP_PROTO,len(data))) != 0:
+        logging.error('checksum udp incorrecto')
+        return
     logging.debug("puerto origen: {}".format(data[0:2]))            #puerto origen
     logging.debug("puerto destino: {}".format(data[2:4]))            #puerto destino
     logging.debug("datos contenidos: {}".format(data[8:]))            #datos contenidos
@@ -69,6 +76,28 @@ def sendUDPDatagram(data,dstPort,dstIP):
     '''
     #pdb.set_trace()
     print("SEND UDP DATAGRAM\n")
+    return ip.sendIPDatagram(dstIP, buildUDPDatagram(data,dstPort), UDP_PROTO)
+
+
+async def sendUDPDatagramAsync(data,dstPort,dstIP):
+    '''
+        Nombre: sendUDPDatagramAsync
+        Descripción: Variante awaitable de sendUDPDatagram que envía el datagrama con sendIPDatagramAsync
+        Argumentos: los mismos que sendUDPDatagram
+        Retorno: True o False en función de si se ha enviado el datagrama correctamente o no
+    '''
+    return await ip.sendIPDatagramAsync(dstIP, buildUDPDatagram(data,dstPort), UDP_PROTO)
+
+
+def buildUDPDatagram(data,dstPort):
+    '''
+        Nombre: buildUDPDatagram
+        Descripción: Construye un datagrama UDP (cabecera + datos) con checksum a 0 y un puerto origen libre
+        Argumentos:
+            -data: array de bytes con los datos a incluir como payload en el datagrama UDP
+            -dstPort: entero de 16 bits que indica el número de puerto destino a usar
+        Retorno: Bytes con el datagrama UDP
+    '''
     datagrama = bytes()
     cabecera = bytes()
 
@@ -80,7 +109,7 @@ def sendUDPDatagram(data,dstPort,dstIP):
     datagrama += cabecera
     datagrama += data
 
-    ip.sendIPDatagram(dstIP, datagrama, UDP_PROTO)
+    return datagrama
 
 
 def initUDP():
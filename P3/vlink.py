@@ -0,0 +1,202 @@
+'''
+    vlink.py
+    Enlace virtual en memoria para ejecutar la pila sin tarjeta de red ni permisos de root.
+    Un enlace (vlink_create) se comporta como un concentrador Ethernet de N puertos: cada trama que se envía por un
+    puerto se entrega al resto, con MTU, latencia y probabilidad de pérdida configurables. Como el estado de cada
+    nivel de la pila es global a su módulo, cada instancia de la pila se ejecuta en su propio proceso y los puertos
+    son colas de multiprocessing.
+    Las interfaces virtuales se registran con addVirtualInterface, que también fija los parámetros que devuelven
+    getHwAddr, getIP, getMTU, getNetmask y getDefaultGW para esa interfaz.
+'''
+
+from rc1_pcap import pcap_pkthdr, timeval
+import multiprocessing
+import queue
+import random
+import struct
+import socket
+import time
+
+#Tamaño de la cabecera Ethernet, que no cuenta para la MTU
+ETH_HLEN = 14
+
+#Interfaces virtuales registradas. Diccionario nombre -> vinterface_t
+virtualInterfaces = {}
+
+
+class vlink_t():
+    def __init__(self,nports,mtu,latency,loss):
+        self.ports = [multiprocessing.Queue() for i in range(nports)]
+        self.mtu = mtu
+        self.latency = latency
+        self.loss = loss
+
+
+class vinterface_t():
+    def __init__(self,link,port,mac,ip,netmask,mtu,gw):
+        self.link = link
+        self.port = port
+        self.mac = mac
+        self.ip = ip
+        self.netmask = netmask
+        self.mtu = mtu
+        self.gw = gw
+
+
+class vhandle_t():
+    def __init__(self,link,port):
+        self.link = link
+        self.port = port
+        self.breakloop = False
+        self.sent = 0
+        self.lost = 0
+
+
+def _ip2int(ip):
+    if type(ip) is str:
+        return struct.unpack('!I',socket.inet_aton(ip))[0]
+    return ip
+
+
+def vlink_create(nports=2,mtu=1500,latency=0.0,loss=0.0):
+    '''
+        Nombre: vlink_create
+        Descripción: Crea un enlace virtual. Debe crearse antes de arrancar los procesos que lo usan
+        Argumentos:
+            -nports: número de puertos (instancias de la pila) conectados al enlace
+            -mtu: MTU del enlace. Las tramas con más de mtu bytes tras la cabecera Ethernet se descartan
+            -latency: retardo (en segundos) con el que se entrega cada trama
+            -loss: probabilidad (0 a 1) de que una trama se pierda
+        Retorno: Enlace vlink_t
+    '''
+    return vlink_t(nports,mtu,latency,loss)
+
+
+def addVirtualInterface(name,link,port,mac,ip,netmask,gw=None):
+    '''
+        Nombre: addVirtualInterface
+        Descripción: Registra una interfaz virtual conectada al puerto port del enlace link
+        Argumentos:
+            -name: nombre de la interfaz
+            -link: enlace vlink_t
+            -port: número de puerto del enlace
+            -mac: bytes con la dirección MAC de la interfaz
+            -ip: IP de la interfaz (entero de 32 bits o cadena X.X.X.X)
+            -netmask: máscara de red (entero de 32 bits o cadena X.X.X.X)
+            -gw: gateway por defecto (entero de 32 bits, cadena X.X.X.X o None)
+        Retorno: Ninguno
+    '''
+    virtualInterfaces[name] = vinterface_t(link,port,bytes(mac),_ip2int(ip),_ip2int(netmask),link.mtu,
+        _ip2int(gw) if gw is not None else 0)
+
+
+def getVirtualInterface(name):
+    '''
+        Nombre: getVirtualInterface
+        Descripción: Devuelve la interfaz virtual registrada con ese nombre
+        Argumentos:
+            -name: nombre de la interfaz
+        Retorno: vinterface_t o None si no es una interfaz virtual
+    '''
+    return virtualInterfaces.get(name)
+
+
+def vlink_open(interface,errbuf):
+    '''
+        Nombre: vlink_open
+        Descripción: Equivalente a pcap_open_live para una interfaz virtual
+        Argumentos:
+            -interface: nombre de la interfaz virtual
+            -errbuf: bytearray donde se añade el mensaje de error si lo hay
+        Retorno: Manejador vhandle_t o None si la interfaz no está registrada
+    '''
+    vif = virtualInterfaces.get(interface)
+    if vif is None:
+        errbuf.extend(bytes('{} no es una interfaz virtual'.format(interface),'utf-8'))
+        return None
+    return vhandle_t(vif.link,vif.port)
+
+
+def vlink_loop(handle,cnt,callback_fun,user,to_ms=100):
+    '''
+        Nombre: vlink_loop
+        Descripción: Equivalente a pcap_loop. Entrega las tramas que llegan al puerto respetando la latencia del enlace
+        Argumentos:
+            -handle: manejador vhandle_t
+            -cnt: número de tramas a procesar (-1 para infinitas)
+            -callback_fun: función de callback con el prototipo de pcap_loop
+            -user: datos de usuario
+            -to_ms: tiempo máximo de espera antes de volver a comprobar breakloop
+        Retorno: 0 si se ha alcanzado cnt, -2 si se ha llamado a vlink_breakloop
+    '''
+    handle.breakloop = False
+    q = handle.link.ports[handle.port]
+    latency = handle.link.latency
+    n = 0
+    while not handle.breakloop:
+        try:
+            sent,frame = q.get(timeout=to_ms/1000)
+        except queue.Empty:
+            continue
+        if latency > 0:
+            delay = sent+latency-time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        now = time.time()
+        header = pcap_pkthdr()
+        header.len = len(frame)
+        header.caplen = len(frame)
+        header.ts = timeval(int(now),int((now % 1)*1000000))
+        callback_fun(user,header,bytearray(frame))
+        n += 1
+        if cnt > 0 and n >= cnt:
+            return 0
+    handle.breakloop = False
+    return -2
+
+
+def vlink_breakloop(handle):
+    '''
+        Nombre: vlink_breakloop
+        Descripción: Equivalente a pcap_breakloop
+        Argumentos:
+            -handle: manejador vhandle_t
+        Retorno: Ninguno
+    '''
+    handle.breakloop = True
+
+
+def vlink_inject(handle,buf,size):
+    '''
+        Nombre: vlink_inject
+        Descripción: Equivalente a pcap_inject. Entrega la trama al resto de puertos del enlace salvo que supere la
+            MTU o se pierda
+        Argumentos:
+            -handle: manejador vhandle_t
+            -buf: bytes con la trama Ethernet completa
+            -size: número de bytes de buf a enviar
+        Retorno: Número de bytes enviados o -1 si la trama supera la MTU
+    '''
+    link = handle.link
+    if size-ETH_HLEN > link.mtu:
+        return -1
+    handle.sent += 1
+    if link.loss > 0 and random.random() < link.loss:
+        handle.lost += 1
+        return size
+    item = (time.monotonic(),bytes(buf[:size]))
+    for port,q in enumerate(link.ports):
+        if port != handle.port:
+            q.put(item)
+    return size
+
+
+def vlink_close(handle):
+    '''
+        Nombre: vlink_close
+        Descripción: Equivalente a pcap_close
+        Argumentos:
+            -handle: manejador vhandle_t
+        Retorno: Ninguno
+    '''
+    handle.breakloop = True
@@ -0,0 +1,248 @@
+'''
+    columnas.py
+    Exportación de una traza pcap a columnas NumPy para hacer estadísticas vectorizadas en lugar de usar un callback
+    de Python por paquete. Cada paquete es un registro de PACKET_DTYPE (marca de tiempo, caplen, len, MACs, ethertype,
+    IPs, protocolo, IPID, banderas+offset, TTL y puertos) y los campos se extraen por lotes de miles de tramas con
+    indexado de arrays, sin recorrer los bytes en Python.
+    Salida: .npy con el array estructurado (se puede cargar mapeado en memoria) o .npz con un array por columna.
+    NumPy es opcional: el resto de la práctica funciona sin él y solo este módulo lo necesita.
+    Ejemplo: python3 columnas.py --file random.pcap --out random.npy --resumen
+'''
+
+from rc1_pcap import *
+import argparse
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ETHERTYPE_IP = 0x0800
+VLAN_TPIDS = (0x8100, 0x88A8, 0x9100)
+ICMP = 1
+TCP = 6
+UDP = 17
+IP_OFFSET_MASK = 0x1FFF
+#Paquetes por lote y bytes de cada trama que se copian para extraer las cabeceras (Ethernet con dos etiquetas VLAN,
+#IPv4 con opciones y puertos de nivel 4)
+BATCH_PACKETS = 4096
+PREFIX_LEN = 96
+
+if np is not None:
+    PACKET_DTYPE = np.dtype([('ts','<f8'),('caplen','<u4'),('len','<u4'),('eth_src','<u8'),('eth_dst','<u8'),
+        ('ethertype','<u2'),('ip_src','<u4'),('ip_dst','<u4'),('proto','u1'),('ttl','u1'),('ipid','<u2'),
+        ('flags_offset','<u2'),('sport','<u2'),('dport','<u2')])
+else:
+    PACKET_DTYPE = None
+
+
+def checkNumpy():
+    '''
+        Nombre: checkNumpy
+        Descripción: Comprueba que NumPy está instalado
+        Argumentos: Ninguno
+        Retorno: Ninguno. Lanza ImportError si NumPy no está disponible
+    '''
+    if np is None:
+        raise ImportError('columnas.py necesita NumPy (pip install numpy)')
+
+
+def parsePackets(buf,offsets,byteorder='<',nsec=False):
+    '''
+        Nombre: parsePackets
+        Descripción: Extrae las columnas de un lote de paquetes de una traza mapeada en memoria
+        Argumentos:
+            -buf: array uint8 con el fichero pcap completo (np.frombuffer sobre el mapeo)
+            -offsets: array con el desplazamiento de la cabecera de registro de cada paquete del lote
+            -byteorder: '<' o '>', orden de bytes de las cabeceras de registro de la traza
+            -nsec: True si la traza tiene marcas de tiempo en nanosegundos
+        Retorno: Array estructurado de PACKET_DTYPE con un elemento por paquete. Los campos IP y de nivel 4 son 0 en
+            los paquetes que no son IPv4 (o no tienen puertos)
+    '''
+    checkNumpy()
+    off = np.asarray(offsets,dtype=np.int64)
+    n = len(off)
+    out = np.zeros(n,dtype=PACKET_DTYPE)
+    if n == 0:
+        return out
+    rec = buf[off[:,None] + np.arange(PCAP_RECORD_HLEN)].view(byteorder + 'u4')
+    caplen = rec[:,2].astype(np.int64)
+    out['ts'] = rec[:,0] + rec[:,1] * (1e-9 if nsec else 1e-6)
+    out['caplen'] = rec[:,2]
+    out['len'] = rec[:,3]
+
+    #Primeros PREFIX_LEN bytes de cada trama, a 0 a partir de caplen
+    cols = np.arange(PREFIX_LEN)
+    idx = np.minimum(off[:,None] + PCAP_RECORD_HLEN + cols,len(buf) - 1)
+    frm = buf[idx]
+    frm[cols >= caplen[:,None]] = 0
+    frm = frm.astype(np.uint64)
+    filas = np.arange(n)
+
+    def be(pos,size):
+        v = np.zeros(n,dtype=np.uint64)
+        for i in range(size):
+            v = (v << np.uint64(8)) | frm[filas,np.minimum(pos + i,PREFIX_LEN - 1)]
+        return v
+
+    out['eth_dst'] = be(np.zeros(n,dtype=np.int64),6)
+    out['eth_src'] = be(np.full(n,6,dtype=np.int64),6)
+    l3 = np.full(n,14,dtype=np.int64)
+    tipo = be(l3 - 2,2)
+    for i in range(2):
+        vlan = np.isin(tipo,VLAN_TPIDS)
+        l3 += vlan * 4
+        tipo = np.where(vlan,be(l3 - 2,2),tipo)
+    out['ethertype'] = tipo
+
+    verIhl = be(l3,1)
+    ip = (tipo == ETHERTYPE_IP) & (verIhl >> np.uint64(4) == 4) & (caplen >= l3 + 20)
+    proto = np.where(ip,be(l3 + 9,1),0)
+    flagsOffset = np.where(ip,be(l3 + 6,2),0)
+    out['ip_src'] = np.where(ip,be(l3 + 12,4),0)
+    out['ip_dst'] = np.where(ip,be(l3 + 16,4),0)
+    out['proto'] = proto
+    out['ttl'] = np.where(ip,be(l3 + 8,1),0)
+    out['ipid'] = np.where(ip,be(l3 + 4,2),0)
+    out['flags_offset'] = flagsOffset
+
+    #Puertos (TCP/UDP) o tipo y código (ICMP), solo en el primer fragmento. Si la trama se ha truncado antes quedan a 0
+    l4 = l3 + (verIhl & np.uint64(0x0F)).astype(np.int64) * 4
+    primero = ip & (flagsOffset & np.uint64(IP_OFFSET_MASK) == 0)
+    puertos = primero & ((proto == TCP) | (proto == UDP)) & (caplen >= l4 + 4)
+    icmp = primero & (proto == ICMP) & (caplen >= l4 + 2)
+    out['sport'] = np.where(puertos,be(l4,2),np.where(icmp,be(l4,1),0))
+    out['dport'] = np.where(puertos,be(l4 + 2,2),np.where(icmp,be(l4 + 1,1),0))
+    return out
+
+
+def iterBatches(handle,batch=BATCH_PACKETS,index=None):
+    '''
+        Nombre: iterBatches
+        Descripción: Generador que recorre una traza por lotes de paquetes
+        Argumentos:
+            -handle: manejador abierto con pcap_open_offline_mmap
+            -batch: número de paquetes por lote
+            -index: pcap_index_t de la traza con step 1 (None para construirlo)
+        Retorno: Generador de arrays estructurados de PACKET_DTYPE
+    '''
+    checkNumpy()
+    if index is None or index.step != 1:
+        index = pcap_index_build(handle,1)
+    buf = np.frombuffer(handle.mm,dtype=np.uint8)
+    offsets = np.frombuffer(index.offsets,dtype=np.uint64).astype(np.int64)
+    byteorder = handle.record.format[0]
+    for i in range(0,len(offsets),batch):
+        yield parsePackets(buf,offsets[i:i + batch],byteorder,handle.nsec)
+
+
+def exportTrace(fname,out,batch=BATCH_PACKETS):
+    '''
+        Nombre: exportTrace
+        Descripción: Convierte una traza en columnas y las guarda en out. Con cualquier extensión salvo .npz se
+            escribe un .npy con el array estructurado, lote a lote sobre un fichero mapeado, así que no hace falta
+            tener la traza entera en memoria. Con .npz se escribe primero ese .npy en un fichero temporal junto a out
+            y después se guarda cada columna con np.savez leyéndola del fichero mapeado (también sin cargar la traza)
+        Argumentos:
+            -fname: fichero pcap
+            -out: fichero de salida (.npy o .npz)
+            -batch: número de paquetes por lote
+        Retorno: Número de paquetes exportados o None si no se puede abrir la traza
+    '''
+    checkNumpy()
+    errbuf = bytearray()
+    handle = pcap_open_offline_mmap(fname,errbuf)
+    if handle is None:
+        logging.error('Error abriendo la traza {}: {}'.format(fname,errbuf.decode('utf-8','replace')))
+        return None
+    index = pcap_index_build(handle,1)
+    destino = out + '.tmp.npy' if out.endswith('.npz') else out
+    paquetes = np.lib.format.open_memmap(destino,mode='w+',dtype=PACKET_DTYPE,shape=(index.packets,))
+    pos = 0
+    for lote in iterBatches(handle,batch,index):
+        paquetes[pos:pos + len(lote)] = lote
+        pos += len(lote)
+    paquetes.flush()
+    n = len(paquetes)
+    del paquetes
+    pcap_close_mmap(handle)
+    if destino != out:
+        #np.savez escribe cada columna (una vista no contigua del mapeo) por trozos
+        paquetes = np.load(destino,mmap_mode='r')
+        try:
+            np.savez(out,**{campo:paquetes[campo] for campo in PACKET_DTYPE.names})
+        finally:
+            del paquetes
+            os.remove(destino)
+    return n
+
+
+def loadColumns(path):
+    '''
+        Nombre: loadColumns
+        Descripción: Carga un fichero generado por exportTrace. Los .npy se mapean en memoria (solo se leen del disco
+            las partes que se usen); los .npz se leen columna a columna al acceder a ellas
+        Argumentos:
+            -path: fichero .npy o .npz
+        Retorno: Array estructurado mapeado (.npy) u objeto NpzFile indexable por nombre de columna (.npz)
+    '''
+    checkNumpy()
+    if path.endswith('.npz'):
+        return np.load(path)
+    return np.load(path,mmap_mode='r')
+
+
+def summary(paquetes,top=5):
+    '''
+        Nombre: summary
+        Descripción: Ejemplo de estadísticas vectorizadas sobre las columnas: totales, tiempo entre llegadas,
+            histograma de tamaños y las IP origen que más bytes envían
+        Argumentos:
+            -paquetes: array estructurado o NpzFile devuelto por loadColumns
+            -top: número de IP origen a mostrar
+        Retorno: Lista de líneas de texto
+    '''
+    ts = np.asarray(paquetes['ts'])
+    longitud = np.asarray(paquetes['len'])
+    lineas = ['{} paquetes, {} bytes'.format(len(ts),int(longitud.sum()))]
+    if len(ts) > 1:
+        iat = np.diff(ts)
+        lineas.append('Tiempo entre llegadas: media {:.6f} s, mediana {:.6f} s, máximo {:.6f} s'.format(iat.mean(),
+            np.median(iat),iat.max()))
+    hist,bordes = np.histogram(longitud,bins=[0,64,128,256,512,1024,1518,np.inf])
+    lineas.append('Tamaños: ' + ', '.join('[{:g},{:g}): {}'.format(a,b,h) for a,b,h in zip(bordes[:-1],bordes[1:],hist)))
+    ipSrc = np.asarray(paquetes['ip_src'])
+    ips,inversa = np.unique(ipSrc[ipSrc != 0],return_inverse=True)
+    if len(ips):
+        bytesPorIP = np.bincount(inversa,weights=longitud[ipSrc != 0])
+        for i in np.argsort(bytesPorIP)[::-1][:top]:
+            lineas.append('{}: {} bytes'.format(socket.inet_ntoa(struct.pack('!I',int(ips[i]))),int(bytesPorIP[i])))
+    return lineas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exporta los campos de cabecera de una traza pcap a columnas NumPy')
+    parser.add_argument('--file', dest='tracefile', required=True,help='Fichero pcap a convertir')
+    parser.add_argument('--out', dest='out', required=True,help='Fichero de salida (.npy o .npz)')
+    parser.add_argument('--batch', dest='batch', type=int, default=BATCH_PACKETS,help='Paquetes por lote')
+    parser.add_argument('--resumen', dest='resumen', default=False, action='store_true',help='Mostrar estadísticas de la traza')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+
+    if np is None:
+        logging.error('NumPy no está instalado')
+        sys.exit(-1)
+    t = time.time()
+    n = exportTrace(args.tracefile,args.out,args.batch)
+    if n is None:
+        sys.exit(-1)
+    logging.info('{} paquetes exportados a {} en {:.3f} s'.format(n,args.out,time.time()-t))
+    if args.resumen:
+        for linea in summary(loadColumns(args.out)):
+            print(linea)
@@ -0,0 +1,440 @@
+'''
+    flujos.py
+    Análisis offline de trazas: recorre una traza pcap completa (mapeada en memoria con pcap_open_offline_mmap),
+    analiza las cabeceras Ethernet/IPv4/UDP/TCP/ICMP de cada paquete y mantiene una tabla de flujos indexada por la
+    5-tupla (IP origen, IP destino, protocolo, puerto origen, puerto destino) con paquetes, bytes, primera y última
+    marca de tiempo y número de fragmentos. Para ICMP los "puertos" son el tipo y el código.
+    Los flujos que llevan FLOW_IDLE_TIMEOUT segundos (tiempo de la traza) sin paquetes, o los más antiguos si se
+    superan FLOW_MAX flujos, se vuelcan a la salida y se eliminan de la tabla, así que la memoria no depende del tamaño
+    de la traza.
+    Ejemplo: python3 flujos.py --file practica1.pcap --out flujos.csv
+'''
+
+from rc1_pcap import *
+import argparse
+import csv
+import json
+import logging
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+ETHERTYPE_IP = 0x0800
+VLAN_TPIDS = (0x8100, 0x88A8, 0x9100)
+ICMP = 1
+TCP = 6
+UDP = 17
+IP_MF = 0x2000
+IP_OFFSET_MASK = 0x1FFF
+#Segundos sin paquetes tras los que un flujo se da por terminado y número máximo de flujos en la tabla
+FLOW_IDLE_TIMEOUT = 60
+FLOW_MAX = 100000
+#Número máximo de datagramas fragmentados cuyo flujo se recuerda para asociarle los fragmentos siguientes
+FRAG_MAX = 10000
+#Campos de cada flujo en la salida
+FLOW_FIELDS = ['src','dst','proto','sport','dport','packets','bytes','first','last','fragments']
+
+ethType = struct.Struct('!H')
+#Cabecera IPv4: versión+IHL, longitud total, IPID, banderas+offset, protocolo, IP origen, IP destino
+ipHeader = struct.Struct('!BxHHHxBxxII')
+l4Ports = struct.Struct('!HH')
+icmpTypeCode = struct.Struct('!BB')
+#Flujo terminado en los ficheros temporales del modo paralelo: 5-tupla, paquetes, bytes, primera, última, fragmentos
+flowPartRecord = struct.Struct('!IIBHHQQddI')
+
+
+class flowTable_t():
+    '''
+        Tabla de flujos. flows es un OrderedDict 5-tupla -> [paquetes, bytes, primera, última, fragmentos] ordenado por
+        el último paquete visto, así que los flujos a expirar están siempre al principio.
+        Un flujo termina cuando pasan más de idle segundos entre dos de sus paquetes: el siguiente paquete con la misma
+        5-tupla empieza un flujo nuevo. Así los flujos de salida solo dependen de la traza (no de cuándo se revisa la
+        tabla ni de cómo se reparte entre procesos), salvo los que se expulsan antes de tiempo por superar maxFlows.
+    '''
+    def __init__(self,idle=FLOW_IDLE_TIMEOUT,maxFlows=FLOW_MAX,onExpire=None):
+        self.flows = OrderedDict()
+        self.fragKeys = OrderedDict()
+        self.idle = idle
+        self.maxFlows = maxFlows
+        #Función a la que se pasan (clave, valores) de cada flujo que se elimina. Si es None no se expira ningún flujo
+        self.onExpire = onExpire
+        self.packets = 0
+        self.bytes = 0
+        self.nonIP = 0
+        self.expired = 0
+        self.lastCheck = 0
+
+    def process(self,us,header,data):
+        '''
+            Nombre: process
+            Descripción: Añade un paquete a la tabla. Tiene el prototipo de las funciones de callback de pcap_loop
+            Argumentos:
+                -us: datos de usuario (no se usan)
+                -header: cabecera pcap_pkthdr
+                -data: bytes o memoryview con la trama Ethernet
+            Retorno: Ninguno
+        '''
+        self.packets += 1
+        self.bytes += header.len
+        ts = header.ts.tv_sec + header.ts.tv_usec * 1e-6
+        if len(data) < 34:
+            self.nonIP += 1
+            return
+        off = 14
+        tipo = ethType.unpack_from(data,12)[0]
+        while tipo in VLAN_TPIDS and len(data) >= off + 24:
+            tipo = ethType.unpack_from(data,off + 2)[0]
+            off += 4
+        if tipo != ETHERTYPE_IP or len(data) < off + 20:
+            self.nonIP += 1
+            return
+        verIhl,total,ipid,flagsOffset,proto,src,dst = ipHeader.unpack_from(data,off)
+        if verIhl >> 4 != 4:
+            self.nonIP += 1
+            return
+        l4 = off + (verIhl & 0x0F) * 4
+        fragmento = flagsOffset & (IP_MF | IP_OFFSET_MASK)
+        if fragmento and flagsOffset & IP_OFFSET_MASK:
+            #Fragmento no inicial: no lleva cabecera de nivel 4, se usa el flujo del primer fragmento si se ha visto
+            fragKey = (src,dst,ipid,proto)
+            clave = self.fragKeys.get(fragKey)
+            if not flagsOffset & IP_MF:
+                self.fragKeys.pop(fragKey,None)
+            if clave is None:
+                clave = (src,dst,proto,0,0)
+        else:
+            if proto == TCP or proto == UDP:
+                sport,dport = l4Ports.unpack_from(data,l4) if len(data) >= l4 + 4 else (0,0)
+            elif proto == ICMP:
+                sport,dport = icmpTypeCode.unpack_from(data,l4) if len(data) >= l4 + 2 else (0,0)
+            else:
+                sport,dport = 0,0
+            clave = (src,dst,proto,sport,dport)
+            if fragmento:
+                self.fragKeys[(src,dst,ipid,proto)] = clave
+                if len(self.fragKeys) > FRAG_MAX:
+                    self.fragKeys.popitem(last=False)
+
+        flows = self.flows
+        flujo = flows.get(clave)
+        if flujo is not None and ts - flujo[3] > self.idle and self.onExpire is not None:
+            #El flujo anterior con esta 5-tupla ya había terminado
+            self.finish(clave,flows.pop(clave))
+            flujo = None
+        if flujo is None:
+            flows[clave] = [1,header.len,ts,ts,1 if fragmento else 0]
+            if len(flows) > self.maxFlows and self.onExpire is not None:
+                self.expire(ts,True)
+        else:
+            flujo[0] += 1
+            flujo[1] += header.len
+            flujo[3] = ts
+            if fragmento:
+                flujo[4] += 1
+            flows.move_to_end(clave)
+        if ts - self.lastCheck >= 1 and self.onExpire is not None:
+            self.lastCheck = ts
+            self.expire(ts)
+
+    def expire(self,now,full=False):
+        '''
+            Nombre: expire
+            Descripción: Vuelca con onExpire y elimina los flujos sin paquetes desde hace más de idle segundos y, si
+                full es True, el flujo más antiguo aunque no haya expirado
+            Argumentos:
+                -now: marca de tiempo actual de la traza
+                -full: True si la tabla ha superado maxFlows
+            Retorno: Ninguno
+        '''
+        flows = self.flows
+        while flows:
+            clave = next(iter(flows))
+            if now - flows[clave][3] <= self.idle and not full:
+                break
+            full = False
+            self.finish(clave,flows.pop(clave))
+
+    def finish(self,clave,flujo):
+        '''
+            Nombre: finish
+            Descripción: Entrega a onExpire un flujo terminado que ya se ha sacado de la tabla
+            Argumentos:
+                -clave: 5-tupla del flujo
+                -flujo: lista [paquetes, bytes, primera, última, fragmentos]
+            Retorno: Ninguno
+        '''
+        self.expired += 1
+        self.onExpire(clave,flujo)
+
+    def flush(self):
+        '''
+            Nombre: flush
+            Descripción: Vuelca con onExpire todos los flujos que quedan en la tabla y la vacía. Sin onExpire los flujos
+                se quedan en la tabla
+            Argumentos: Ninguno
+            Retorno: Ninguno
+        '''
+        self.fragKeys.clear()
+        if self.onExpire is None:
+            return
+        for clave,flujo in self.flows.items():
+            self.onExpire(clave,flujo)
+        self.flows.clear()
+
+    def merge(self,other):
+        '''
+            Nombre: merge
+            Descripción: Acumula en esta tabla los flujos y contadores de otra (por ejemplo la de otro trozo de la traza)
+            Argumentos:
+                -other: flowTable_t a sumar
+            Retorno: Ninguno
+        '''
+        self.packets += other.packets
+        self.bytes += other.bytes
+        self.nonIP += other.nonIP
+        self.expired += other.expired
+        for clave,otro in other.flows.items():
+            flujo = self.flows.get(clave)
+            if flujo is None:
+                self.flows[clave] = list(otro)
+            else:
+                flujo[0] += otro[0]
+                flujo[1] += otro[1]
+                flujo[2] = min(flujo[2],otro[2])
+                flujo[3] = max(flujo[3],otro[3])
+                flujo[4] += otro[4]
+
+    def join(self,clave,flujo):
+        '''
+            Nombre: join
+            Descripción: Une flujo (el primero de su 5-tupla en un trozo de la traza) con el flujo de la misma 5-tupla que
+                seguía abierto al final de los trozos anteriores, si no hay más de idle segundos entre ambos. Si los hay,
+                el flujo abierto ha terminado y se vuelca
+            Argumentos:
+                -clave: 5-tupla del flujo
+                -flujo: lista [paquetes, bytes, primera, última, fragmentos]
+            Retorno: Flujo resultante (sin añadir a la tabla)
+        '''
+        anterior = self.flows.pop(clave,None)
+        if anterior is None:
+            return flujo
+        if flujo[2] - anterior[3] > self.idle:
+            self.finish(clave,anterior)
+            return flujo
+        return [anterior[0] + flujo[0],anterior[1] + flujo[1],anterior[2],flujo[3],anterior[4] + flujo[4]]
+
+    def stitch(self,parte):
+        '''
+            Nombre: stitch
+            Descripción: Añade el resultado de un trozo de la traza procesado por flowRange_t. Se debe llamar con los
+                trozos en el orden de la traza. Los flujos de la tabla son los que siguen abiertos al final del último
+                trozo añadido y onExpire recibe los mismos flujos que si la traza se hubiera recorrido de una vez
+            Argumentos:
+                -parte: flowRange_t ya cerrado
+            Retorno: Ninguno
+        '''
+        self.packets += parte.packets
+        self.bytes += parte.bytes
+        self.nonIP += parte.nonIP
+        self.expired += parte.expired
+        flows = self.flows
+        if parte.startTs is not None:
+            #Los flujos abiertos que acabaron más de idle segundos antes del trozo ya no pueden continuar
+            for clave in [clave for clave,flujo in flows.items() if parte.startTs - flujo[3] > self.idle]:
+                self.finish(clave,flows.pop(clave))
+        for clave,flujo in parte.heads.items():
+            self.finish(clave,self.join(clave,flujo))
+        for clave,flujo in parte.readPart():
+            self.onExpire(clave,flujo)
+        for clave,flujo in parte.flows.items():
+            if flujo[2] - parte.startTs <= self.idle:
+                flujo = self.join(clave,flujo)
+            elif clave in flows:
+                self.finish(clave,flows.pop(clave))
+            flows[clave] = flujo
+
+
+class flowRange_t(flowTable_t):
+    '''
+        Tabla de flujos de un trozo de la traza para el modo paralelo. Los flujos que terminan dentro del trozo se
+        escriben en un fichero temporal (partPath), salvo los que empiezan en los primeros idle segundos del trozo (heads):
+        esos pueden ser la continuación de un flujo de trozos anteriores y se devuelven para unirlos con stitch, igual que
+        los que siguen abiertos al final (flows).
+    '''
+    def __init__(self,idle=FLOW_IDLE_TIMEOUT,maxFlows=FLOW_MAX):
+        flowTable_t.__init__(self,idle,maxFlows,self.emit)
+        self.heads = {}
+        self.startTs = None
+        self.part = None
+        self.partPath = None
+
+    def process(self,us,header,data):
+        if self.startTs is None:
+            self.startTs = header.ts.tv_sec + header.ts.tv_usec * 1e-6
+        flowTable_t.process(self,us,header,data)
+
+    def emit(self,clave,flujo):
+        if flujo[2] - self.startTs <= self.idle:
+            self.heads[clave] = flujo
+            self.expired -= 1
+            return
+        if self.part is None:
+            fd,self.partPath = tempfile.mkstemp(prefix='flujos.',suffix='.part')
+            self.part = os.fdopen(fd,'wb')
+        self.part.write(flowPartRecord.pack(*clave,*flujo))
+
+    def close(self):
+        '''
+            Nombre: close
+            Descripción: Cierra el fichero temporal al terminar el trozo (se llama en el proceso del trozo)
+            Argumentos: Ninguno
+            Retorno: Ninguno
+        '''
+        if self.part is not None:
+            self.part.close()
+            self.part = None
+
+    def readPart(self):
+        '''
+            Nombre: readPart
+            Descripción: Generador que lee los flujos del fichero temporal y lo borra al terminar
+            Argumentos: Ninguno
+            Retorno: Generador de tuplas (5-tupla, flujo)
+        '''
+        if self.partPath is None:
+            return
+        try:
+            with open(self.partPath,'rb') as f:
+                while True:
+                    registro = f.read(flowPartRecord.size)
+                    if len(registro) < flowPartRecord.size:
+                        break
+                    campos = flowPartRecord.unpack(registro)
+                    yield campos[:5],list(campos[5:])
+        finally:
+            os.remove(self.partPath)
+            self.partPath = None
+
+
+def flowCallback(tabla,header,data):
+    '''
+        Nombre: flowCallback
+        Descripción: Callback para pcap_loop_parallel: añade el paquete a la tabla de flujos que se pasa como datos de usuario
+        Argumentos:
+            -tabla: flowTable_t
+            -header: cabecera pcap_pkthdr
+            -data: trama Ethernet
+        Retorno: Ninguno
+    '''
+    tabla.process(None,header,data)
+
+
+def flowRecord(clave,flujo):
+    '''
+        Nombre: flowRecord
+        Descripción: Convierte un flujo de la tabla en un diccionario con los campos de FLOW_FIELDS
+        Argumentos:
+            -clave: 5-tupla del flujo
+            -flujo: lista [paquetes, bytes, primera, última, fragmentos]
+        Retorno: Diccionario con el flujo
+    '''
+    src,dst,proto,sport,dport = clave
+    return {'src':socket.inet_ntoa(struct.pack('!I',src)),'dst':socket.inet_ntoa(struct.pack('!I',dst)),
+        'proto':proto,'sport':sport,'dport':dport,'packets':flujo[0],'bytes':flujo[1],
+        'first':round(flujo[2],6),'last':round(flujo[3],6),'fragments':flujo[4]}
+
+
+class flowWriter_t():
+    '''
+        Salida de flujos en CSV o JSON (según la extensión del fichero, '-' para CSV por la salida estándar). Los flujos
+        se escriben según se van expirando, sin guardarlos en memoria.
+    '''
+    def __init__(self,path):
+        self.json = path.endswith('.json')
+        self.f = sys.stdout if path == '-' else open(path,'w',newline='')
+        self.count = 0
+        if self.json:
+            self.f.write('[')
+        else:
+            self.csv = csv.DictWriter(self.f,fieldnames=FLOW_FIELDS)
+            self.csv.writeheader()
+
+    def write(self,clave,flujo):
+        registro = flowRecord(clave,flujo)
+        if self.json:
+            self.f.write((',\n' if self.count else '\n') + json.dumps(registro))
+        else:
+            self.csv.writerow(registro)
+        self.count += 1
+
+    def close(self):
+        if self.json:
+            self.f.write('\n]\n')
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+def analyzeTrace(fname,writer=None,idle=FLOW_IDLE_TIMEOUT,maxFlows=FLOW_MAX,workers=1):
+    '''
+        Nombre: analyzeTrace
+        Descripción: Recorre una traza completa y construye su tabla de flujos
+        Argumentos:
+            -fname: fichero pcap
+            -writer: flowWriter_t al que se vuelcan los flujos (según expiran y al final) o None para dejarlos todos
+            en la tabla devuelta
+            -idle: segundos sin paquetes tras los que expira un flujo
+            -maxFlows: número máximo de flujos en la tabla
+            -workers: número de procesos (None para usar todos los núcleos). Con más de uno cada proceso recorre un
+            trozo de la traza y escribe los flujos que terminan en él; los que pueden cruzar el límite entre trozos se
+            unen al final en orden (stitch), así que se obtienen los mismos flujos que con un solo proceso
+        Retorno: flowTable_t con los contadores (y los flujos si writer es None) o None si no se puede abrir la traza
+    '''
+    errbuf = bytearray()
+    handle = pcap_open_offline_mmap(fname,errbuf)
+    if handle is None:
+        logging.error('Error abriendo la traza {}: {}'.format(fname,errbuf.decode('utf-8','replace')))
+        return None
+    if handle.linktype != DLT_EN10MB:
+        logging.error('La traza {} no es Ethernet (linktype {})'.format(fname,handle.linktype))
+        pcap_close_mmap(handle)
+        return None
+    if workers != 1 and writer is not None:
+        partes = pcap_loop_parallel(handle,flowCallback,flowRange_t(idle,maxFlows),None,workers,flowRange_t.close)
+        tabla = flowTable_t(idle,maxFlows,writer.write)
+        for parte in partes:
+            tabla.stitch(parte)
+    elif workers != 1:
+        #Sin salida no se expira ningún flujo: basta con sumar las tablas de los trozos
+        tabla = pcap_loop_parallel(handle,flowCallback,flowTable_t(idle,maxFlows),flowTable_t.merge,workers)
+    else:
+        tabla = flowTable_t(idle,maxFlows,writer.write if writer is not None else None)
+        process = tabla.process
+        for header,data in pcap_iter_mmap(handle):
+            process(None,header,data)
+    tabla.flush()
+    pcap_close_mmap(handle)
+    return tabla
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tabla de flujos (5-tupla) de una traza pcap')
+    parser.add_argument('--file', dest='tracefile', required=True,help='Fichero pcap a analizar')
+    parser.add_argument('--out', dest='out', default='-',help='Fichero de salida (.csv o .json, - para la salida estándar)')
+    parser.add_argument('--idle', dest='idle', type=float, default=FLOW_IDLE_TIMEOUT,help='Segundos sin paquetes tras los que expira un flujo')
+    parser.add_argument('--maxFlows', dest='maxFlows', type=int, default=FLOW_MAX,help='Número máximo de flujos en memoria')
+    parser.add_argument('--workers', dest='workers', type=int, default=1,help='Número de procesos (0 para usar todos los núcleos)')
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = '[%(asctime)s %(levelname)s]\t%(message)s')
+
+    writer = flowWriter_t(args.out)
+    t = time.time()
+    tabla = analyzeTrace(args.tracefile,writer,args.idle,args.maxFlows,args.workers or None)
+    writer.close()
+    if tabla is None:
+        sys.exit(-1)
+    logging.info('{} paquetes ({} no IPv4), {} bytes, {} flujos en {:.3f} s'.format(tabla.packets,tabla.nonIP,
+        tabla.bytes,writer.count,time.time()-t))
@@ -16,6 +16,8 @@ from argparse import RawTextHelpFormatter
 import time
 import logging
 import struct
+import decimal
+import flujos
 
 
 ETH_FRAME_MAX = 1514
@@ -26,11 +28,15 @@ num_paquete = 0
 TIME_OFFSET = 30*60
 #fichero_captura = ''
 nbytes = 0
+usar_mmap = False
 
 def signal_handler(nsignal,frame):
 	logging.info('Control C pulsado')
 	if handle:
-		pcap_breakloop(handle)
+		if usar_mmap:
+			pcap_breakloop_mmap(handle)
+		else:
+			pcap_breakloop(handle)
 		
 
 def procesa_paquete(us,header,data):
@@ -68,6 +74,12 @@ if __name__ == "__main__":
 	parser.add_argument('--file', dest='tracefile', default=False,help='Fichero pcap a abrir')
 	parser.add_argument('--itf', dest='interface', default=False,help='Interfaz a abrir')
 	parser.add_argument('--nbytes', dest='nbytes', type=int, default=14,help='Número de bytes a mostrar por paquete')
+	parser.add_argument('--mmap', dest='mmap', default=False, action='store_true',help='Leer la traza mapeándola en memoria (sin libpcap)')
+	#Punto de inicio en la traza: por tiempo o por número de paquete, no ambos
+	inicio = parser.add_mutually_exclusive_group()
+	inicio.add_argument('--desde', dest='desde', type=decimal.Decimal, default=None,help='Empezar en el primer paquete con marca de tiempo >= DESDE (segundos, implica --mmap)')
+	inicio.add_argument('--paquete', dest='paquete', type=int, default=None,help='Empezar en el paquete número PAQUETE, desde 0 (implica --mmap)')
+	parser.add_argument('--flujos', dest='flujos', default=False,help='Analizar la traza completa (--file) y escribir su tabla de flujos en el fichero indicado (.csv o .json)')
 	parser.add_argument('--debug', dest='debug', default=False, action='store_true',help='Activar Debug messages')
 	args = parser.parse_args()
 
@@ -81,6 +93,18 @@ if __name__ == "__main__":
 		parser.print_help()
 		sys.exit(-1)
 
+	if args.flujos:
+		if args.tracefile is False:
+			logging.error('--flujos necesita una traza (--file)')
+			sys.exit(-1)
+		writer = flujos.flowWriter_t(args.flujos)
+		tabla = flujos.analyzeTrace(args.tracefile, writer)
+		writer.close()
+		if tabla is None:
+			sys.exit(-1)
+		logging.info('{} paquetes, {} flujos escritos en {}'.format(tabla.packets, writer.count, args.flujos))
+		sys.exit(0)
+
 	signal.signal(signal.SIGINT, signal_handler)
 
 	errbuf = bytearray()
@@ -106,6 +130,21 @@ if __name__ == "__main__":
 			print("Error creando el dumper")
 			sys.exit(-1)
 
+	elif args.tracefile and (args.mmap or args.desde is not None or args.paquete is not None):
+		usar_mmap = True
+		handle = pcap_open_offline_mmap(args.tracefile, errbuf)
+		if handle is None:
+			print("Error abriendo la traza previamente capturada")
+			sys.exit(-1)
+		if args.desde is not None or args.paquete is not None:
+			#El índice se guarda junto a la traza y se reutiliza mientras la traza no cambie
+			indice = pcap_index_open(handle)
+			if args.paquete is not None:
+				if not pcap_seek_packet_mmap(handle, indice, args.paquete):
+					logging.error('La traza solo tiene {} paquetes'.format(indice.packets))
+			else:
+				pcap_seek_time_mmap(handle, indice, args.desde)
+
 	elif args.tracefile:
 		handle = pcap_open_offline(args.tracefile, errbuf)
 		if handle is None:
@@ -113,7 +152,10 @@ if __name__ == "__main__":
 			sys.exit(-1)
 
 	
-	ret = pcap_loop(handle,50,procesa_paquete,None)
+	if usar_mmap:
+		ret = pcap_loop_mmap(handle,50,procesa_paquete,None)
+	else:
+		ret = pcap_loop(handle,50,procesa_paquete,None)
 	if ret == -1:
 		logging.error('Error al capturar un paquete')
 	elif ret == -2:
@@ -127,7 +169,10 @@ if __name__ == "__main__":
 		pcap_close(descriptor)
 
 	if handle is not None:
-		pcap_close(handle)
+		if usar_mmap:
+			pcap_close_mmap(handle)
+		else:
+			pcap_close(handle)
 
 	if pdumper is not None:
 		pcap_dump_close(pdumper)
\ No newline at end of file
@@ -1,4 +1,15 @@
 import ctypes,sys
+import array
+import bisect
+import copy
+import decimal
+import fractions
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import time
 from ctypes.util import find_library
 
 user_callback = None
@@ -14,7 +25,39 @@ def mycallback(us,h,data):
         user_callback (us,header,bytearray(data[:header.caplen]))
 
 
-pcap = ctypes.cdll.LoadLibrary("libpcap.so")
+class pcap_unavailable():
+    '''
+        Sustituto de la biblioteca cuando no se puede cargar libpcap: cualquier función de libpcap lanza OSError al
+        llamarse, pero el módulo se puede importar y las funciones *_mmap (lectura de trazas en Python) funcionan igual.
+    '''
+    def __init__(self,error):
+        self.error = error
+
+    def __getattr__(self,name):
+        error = self.error
+        def unavailable(*args):
+            raise OSError('libpcap no disponible ({}): no se puede llamar a {}'.format(error,name))
+        return unavailable
+
+def pcap_load():
+    '''
+        Nombre: pcap_load
+        Descripción: Carga libpcap (libpcap.so o, si no existe el enlace de desarrollo, la versión que encuentre find_library)
+        Argumentos: Ninguno
+        Retorno: Biblioteca cargada con ctypes o pcap_unavailable si no está instalada
+    '''
+    try:
+        return ctypes.cdll.LoadLibrary("libpcap.so")
+    except OSError as e:
+        nombre = find_library('pcap')
+        if nombre is None:
+            return pcap_unavailable(str(e))
+        try:
+            return ctypes.cdll.LoadLibrary(nombre)
+        except OSError as e:
+            return pcap_unavailable(str(e))
+
+pcap = pcap_load()
 
 
 class timeval():
@@ -31,6 +74,16 @@ class pcap_pkthdr():
 class pcappkthdr(ctypes.Structure):
     _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long), ("caplen", ctypes.c_uint32), ("len", ctypes.c_uint32)]
 
+#Prototipos de las funciones que se llaman por cada paquete. Se fijan una sola vez al importar el módulo
+#const u_char *pcap_next(pcap_t *p, struct pcap_pkthdr *h)
+_pcap_next = pcap.pcap_next
+_pcap_next.restype = ctypes.POINTER(ctypes.c_uint8)
+_pcap_next.argtypes = [ctypes.c_void_p, ctypes.POINTER(pcappkthdr)]
+#int pcap_next_ex(pcap_t *p, struct pcap_pkthdr **pkt_header, const u_char **pkt_data)
+_pcap_next_ex = pcap.pcap_next_ex
+_pcap_next_ex.restype = ctypes.c_int
+_pcap_next_ex.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.POINTER(pcappkthdr)), ctypes.POINTER(ctypes.POINTER(ctypes.c_uint8))]
+
 
 def pcap_open_offline(fname,errbuf):
     #pcap_t *pcap_open_offline(const char *fname, char *errbuf);
@@ -103,14 +156,59 @@ def pcap_dump_close(handle):
 
 def pcap_next(handle,header):
     #const u_char *pcap_next(pcap_t *p, struct pcap_pkthdr *h)
-    pn = pcap.pcap_next
-    pn.restype = ctypes.c_char_p
     h = pcappkthdr()
-    aux = pn(handle,ctypes.byref(h))
+    aux = _pcap_next(handle,ctypes.byref(h))
+    if not aux:
+        return None
     header.len = h.len
     header.caplen = h.caplen
     header.ts = timeval(h.tv_sec,h.tv_usec)
-    return bytearray(aux)
+    #Se copian exactamente caplen bytes: los datos binarios pueden contener ceros
+    return bytearray(ctypes.string_at(aux,h.caplen))
+
+def pcap_next_ex(handle,header,zerocopy=False):
+    '''
+        Nombre: pcap_next_ex
+        Descripción: Lee el siguiente paquete de handle usando pcap_next_ex de libpcap
+        Argumentos:
+            -handle: manejador de pcap
+            -header: estructura pcap_pkthdr que se rellena con len, caplen y ts
+            -zerocopy: si es True se devuelve un memoryview sobre el buffer de libpcap, que solo es válido
+                hasta la siguiente lectura del mismo handle. Si es False se devuelven bytes (una copia)
+        Retorno: Tupla (ret,data) con el retorno de pcap_next_ex (1 paquete leído, 0 timeout, -1 error,
+            -2 fin de traza o pcap_breakloop) y los datos del paquete (None si ret no es 1)
+    '''
+    h = ctypes.POINTER(pcappkthdr)()
+    d = ctypes.POINTER(ctypes.c_uint8)()
+    ret = _pcap_next_ex(handle,ctypes.byref(h),ctypes.byref(d))
+    if ret != 1:
+        return ret,None
+    caplen = h[0].caplen
+    header.len = h[0].len
+    header.caplen = caplen
+    header.ts = timeval(h[0].tv_sec,h[0].tv_usec)
+    if zerocopy:
+        return ret,memoryview((ctypes.c_uint8*caplen).from_address(ctypes.addressof(d.contents))).cast('B')
+    return ret,ctypes.string_at(d,caplen)
+
+def iter_packets(handle,zerocopy=False):
+    '''
+        Nombre: iter_packets
+        Descripción: Generador que devuelve los paquetes de un handle (en vivo o de traza) sin usar pcap_loop ni
+            funciones de callback. Los timeouts de lectura de las capturas en vivo se ignoran; el generador termina
+            al acabar la traza, al llamar a pcap_breakloop o si se produce un error.
+        Argumentos:
+            -handle: manejador de pcap
+            -zerocopy: ver pcap_next_ex. Con zerocopy el memoryview deja de ser válido al pedir el siguiente paquete
+        Retorno: Generador de tuplas (header,data)
+    '''
+    while True:
+        header = pcap_pkthdr()
+        ret,data = pcap_next_ex(handle,header,zerocopy)
+        if ret == 1:
+            yield header,data
+        elif ret < 0:
+            return
 
 
 def pcap_loop(handle,cnt,callback_fun,user):
@@ -148,6 +246,654 @@ def pcap_breakloop(hanlde):
     pbl = pcap.pcap_breakloop
     pbl(hanlde)
 
+def pcap_setnonblock(handle,nonblock,errbuf):
+    #int pcap_setnonblock(pcap_t *p, int nonblock, char *errbuf);
+    psn = pcap.pcap_setnonblock
+    psn.restype = ctypes.c_int
+    eb = ctypes.create_string_buffer(256)
+    ret = psn(handle,ctypes.c_int(nonblock),eb)
+    errbuf.extend(bytes(format(eb.value).encode('ascii')))
+    return ret
+
+def pcap_get_selectable_fd(handle):
+    #int pcap_get_selectable_fd(pcap_t *p);
+    pgsf = pcap.pcap_get_selectable_fd
+    pgsf.restype = ctypes.c_int
+    return pgsf(handle)
+
+
+#Filtros BPF. El programa compilado lo reserva libpcap y debe liberarse con pcap_freecode
+PCAP_NETMASK_UNKNOWN = 0xffffffff
+
+class bpf_program(ctypes.Structure):
+    _fields_ = [("bf_len", ctypes.c_uint), ("bf_insns", ctypes.c_void_p)]
+
+def pcap_compile(handle,program,filter_str,optimize,netmask):
+    #int pcap_compile(pcap_t *p, struct bpf_program *fp, const char *str, int optimize, bpf_u_int32 netmask);
+    pc = pcap.pcap_compile
+    pc.restype = ctypes.c_int
+    fs = bytes(str(filter_str), 'ascii')
+    return pc(handle,ctypes.byref(program),fs,ctypes.c_int(optimize),ctypes.c_uint32(netmask))
+
+def pcap_setfilter(handle,program):
+    #int pcap_setfilter(pcap_t *p, struct bpf_program *fp);
+    psf = pcap.pcap_setfilter
+    psf.restype = ctypes.c_int
+    return psf(handle,ctypes.byref(program))
+
+def pcap_freecode(program):
+    #void pcap_freecode(struct bpf_program *);
+    pfc = pcap.pcap_freecode
+    pfc(ctypes.byref(program))
+
+def pcap_geterr(handle):
+    #char *pcap_geterr(pcap_t *p);
+    pge = pcap.pcap_geterr
+    pge.restype = ctypes.c_char_p
+    return pge(handle).decode('ascii','replace')
+
+
+#Lector de trazas pcap en Python puro: mapea el fichero en memoria (mmap) y recorre las cabeceras de registro
+#sin pasar por libpcap ni por el trampolín de ctypes. Los datos se entregan como memoryview sin copias.
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_FILE_HLEN = 24
+PCAP_RECORD_HLEN = 16
+
+class pcap_mmap_t():
+    def __init__(self,f,mm,byteorder,nsec,snaplen,linktype):
+        self.f = f
+        self.mm = mm
+        self.view = memoryview(mm)
+        self.record = struct.Struct(byteorder + 'IIII')
+        self.nsec = nsec
+        self.snaplen = snaplen
+        self.linktype = linktype
+        self.offset = PCAP_FILE_HLEN
+        self.breakloop = False
+
+def pcap_open_offline_mmap(fname,errbuf):
+    '''
+        Nombre: pcap_open_offline_mmap
+        Descripción: Equivalente a pcap_open_offline que mapea en memoria el fichero pcap (formato clásico,
+            en cualquier orden de bytes y con marcas de tiempo en micro o nanosegundos)
+        Argumentos:
+            -fname: nombre del fichero pcap a abrir
+            -errbuf: bytearray donde se añade el mensaje de error si lo hay
+        Retorno: Manejador pcap_mmap_t o None en caso de error
+    '''
+    try:
+        f = open(fname,'rb')
+    except OSError as e:
+        errbuf.extend(bytes(str(e),'utf-8'))
+        return None
+    try:
+        mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    except (ValueError,OSError) as e:
+        f.close()
+        errbuf.extend(bytes(str(e),'utf-8'))
+        return None
+    if len(mm) < PCAP_FILE_HLEN:
+        mm.close()
+        f.close()
+        errbuf.extend(b'Fichero pcap truncado')
+        return None
+    magic = struct.unpack_from('<I',mm,0)[0]
+    if magic in (PCAP_MAGIC_USEC,PCAP_MAGIC_NSEC):
+        byteorder = '<'
+    else:
+        byteorder = '>'
+        magic = struct.unpack_from('>I',mm,0)[0]
+        if magic not in (PCAP_MAGIC_USEC,PCAP_MAGIC_NSEC):
+            mm.close()
+            f.close()
+            errbuf.extend(b'Formato de fichero pcap desconocido')
+            return None
+    snaplen,linktype = struct.unpack_from(byteorder + 'II',mm,16)
+    return pcap_mmap_t(f,mm,byteorder,magic == PCAP_MAGIC_NSEC,snaplen,linktype)
+
+def pcap_next_mmap(handle):
+    '''
+        Nombre: pcap_next_mmap
+        Descripción: Devuelve el siguiente paquete de un manejador abierto con pcap_open_offline_mmap
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+        Retorno: Tupla (header,data) con una estructura pcap_pkthdr y un memoryview con caplen bytes, o None al final de la traza
+    '''
+    off = handle.offset
+    if off + PCAP_RECORD_HLEN > len(handle.mm):
+        return None
+    tv_sec,tv_frac,caplen,length = handle.record.unpack_from(handle.mm,off)
+    off += PCAP_RECORD_HLEN
+    if off + caplen > len(handle.mm):
+        #Registro truncado al final del fichero
+        return None
+    header = pcap_pkthdr()
+    header.len = length
+    header.caplen = caplen
+    header.ts = timeval(tv_sec,tv_frac // 1000 if handle.nsec else tv_frac)
+    handle.offset = off + caplen
+    return header,handle.view[off:off + caplen]
+
+def pcap_iter_mmap(handle,end=None):
+    '''
+        Nombre: pcap_iter_mmap
+        Descripción: Generador que recorre el resto de la traza devolviendo tuplas (header,data) sin copias
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -end: desplazamiento en el fichero donde parar (None para llegar al final). Debe ser el límite de un registro
+        Retorno: Generador de tuplas (pcap_pkthdr,memoryview)
+    '''
+    mm = handle.mm
+    view = handle.view
+    unpack_from = handle.record.unpack_from
+    nsec = handle.nsec
+    size = len(mm) if end is None else min(end,len(mm))
+    off = handle.offset
+    while off + PCAP_RECORD_HLEN <= size:
+        tv_sec,tv_frac,caplen,length = unpack_from(mm,off)
+        start = off + PCAP_RECORD_HLEN
+        off = start + caplen
+        if off > size:
+            break
+        header = pcap_pkthdr()
+        header.len = length
+        header.caplen = caplen
+        header.ts = timeval(tv_sec,tv_frac // 1000 if nsec else tv_frac)
+        handle.offset = off
+        yield header,view[start:off]
+
+def pcap_loop_mmap(handle,cnt,callback_fun,user):
+    '''
+        Nombre: pcap_loop_mmap
+        Descripción: Equivalente a pcap_loop para manejadores pcap_mmap_t. Llama a callback_fun(user,header,data)
+            por cada paquete, con el mismo prototipo que las funciones de callback de pcap_loop
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -cnt: número máximo de paquetes a procesar (-1 o 0 para procesar toda la traza)
+            -callback_fun: función de callback
+            -user: datos de usuario que se pasan a la función de callback
+        Retorno: 0 si se ha terminado la traza o alcanzado cnt, -2 si se ha llamado a pcap_breakloop_mmap
+    '''
+    handle.breakloop = False
+    n = 0
+    for header,data in pcap_iter_mmap(handle):
+        callback_fun(user,header,data)
+        n += 1
+        if handle.breakloop:
+            handle.breakloop = False
+            return -2
+        if cnt > 0 and n >= cnt:
+            break
+    return 0
+
+def pcap_breakloop_mmap(handle):
+    '''
+        Nombre: pcap_breakloop_mmap
+        Descripción: Equivalente a pcap_breakloop para manejadores pcap_mmap_t
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+        Retorno: Ninguno
+    '''
+    handle.breakloop = True
+
+def pcap_close_mmap(handle):
+    '''
+        Nombre: pcap_close_mmap
+        Descripción: Libera el mapeo en memoria y cierra el fichero. Si algún memoryview entregado sigue vivo
+            el mapeo se liberará cuando dejen de usarse
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+        Retorno: Ninguno
+    '''
+    handle.view.release()
+    try:
+        handle.mm.close()
+    except BufferError:
+        pass
+    handle.f.close()
+
+#Índice de acceso aleatorio: fichero auxiliar (traza + PCAP_INDEX_SUFFIX) con el desplazamiento y la marca de tiempo
+#de uno de cada step registros. Cabecera PCAP_INDEX_MAGIC + pcapIndexHeader (tamaño y mtime de la traza, step, número
+#de paquetes, número de entradas, orden de bytes) seguida de los arrays de desplazamientos y de tiempos.
+PCAP_INDEX_MAGIC = b'PIDX\x01'
+PCAP_INDEX_SUFFIX = '.idx'
+PCAP_INDEX_STEP = 64
+pcapIndexHeader = struct.Struct('<QqIQQB')
+
+class pcap_index_t():
+    def __init__(self,size,mtime,step):
+        self.size = size
+        self.mtime = mtime
+        self.step = step
+        self.packets = 0
+        #Desplazamiento en el fichero del registro i*step
+        self.offsets = array.array('Q')
+        #Máximo acumulado de las marcas de tiempo (ns) hasta el registro i*step, así el array está ordenado aunque la
+        #traza no lo esté del todo
+        self.times = array.array('q')
 
+def _pcap_ts_ns(handle,tv_sec,tv_frac):
+    return tv_sec * 1000000000 + (tv_frac if handle.nsec else tv_frac * 1000)
 
+def pcap_index_build(handle,step=PCAP_INDEX_STEP):
+    '''
+        Nombre: pcap_index_build
+        Descripción: Construye el índice de una traza en una sola pasada por las cabeceras de registro
+        Argumentos:
+            -handle: manejador pcap_mmap_t (no se modifica su posición)
+            -step: se guarda uno de cada step registros (1 para indexar todos)
+        Retorno: pcap_index_t
+    '''
+    st = os.fstat(handle.f.fileno())
+    index = pcap_index_t(st.st_size,st.st_mtime_ns,step)
+    mm = handle.mm
+    unpack_from = handle.record.unpack_from
+    size = len(mm)
+    offsets = index.offsets
+    times = index.times
+    off = PCAP_FILE_HLEN
+    n = 0
+    maximo = -1
+    while off + PCAP_RECORD_HLEN <= size:
+        tv_sec,tv_frac,caplen,length = unpack_from(mm,off)
+        if off + PCAP_RECORD_HLEN + caplen > size:
+            break
+        ts = _pcap_ts_ns(handle,tv_sec,tv_frac)
+        if ts > maximo:
+            maximo = ts
+        if n % step == 0:
+            offsets.append(off)
+            times.append(maximo)
+        off += PCAP_RECORD_HLEN + caplen
+        n += 1
+    index.packets = n
+    return index
 
+def pcap_index_save(index,fname):
+    '''
+        Nombre: pcap_index_save
+        Descripción: Escribe un índice en fichero
+        Argumentos:
+            -index: pcap_index_t
+            -fname: fichero donde guardarlo
+        Retorno: True si se ha escrito o False en caso de error
+    '''
+    try:
+        with open(fname,'wb') as f:
+            f.write(PCAP_INDEX_MAGIC + pcapIndexHeader.pack(index.size,index.mtime,index.step,index.packets,
+                len(index.offsets),sys.byteorder == 'little'))
+            index.offsets.tofile(f)
+            index.times.tofile(f)
+    except OSError:
+        return False
+    return True
+
+def pcap_index_load(fname,size=None,mtime=None):
+    '''
+        Nombre: pcap_index_load
+        Descripción: Lee un índice de fichero
+        Argumentos:
+            -fname: fichero del índice
+            -size: tamaño que debe tener la traza (None para no comprobarlo)
+            -mtime: mtime en ns que debe tener la traza (None para no comprobarlo)
+        Retorno: pcap_index_t o None si no existe, es inválido o corresponde a otra versión de la traza
+    '''
+    try:
+        with open(fname,'rb') as f:
+            if f.read(len(PCAP_INDEX_MAGIC)) != PCAP_INDEX_MAGIC:
+                return None
+            cabecera = f.read(pcapIndexHeader.size)
+            if len(cabecera) != pcapIndexHeader.size:
+                return None
+            tam,mt,step,packets,n,little = pcapIndexHeader.unpack(cabecera)
+            if (size is not None and tam != size) or (mtime is not None and mt != mtime) or step == 0:
+                return None
+            index = pcap_index_t(tam,mt,step)
+            index.packets = packets
+            index.offsets.fromfile(f,n)
+            index.times.fromfile(f,n)
+    except (OSError,EOFError,struct.error):
+        return None
+    if bool(little) != (sys.byteorder == 'little'):
+        index.offsets.byteswap()
+        index.times.byteswap()
+    return index
+
+def pcap_index_open(handle,step=PCAP_INDEX_STEP,fname=None):
+    '''
+        Nombre: pcap_index_open
+        Descripción: Devuelve el índice de la traza abierta en handle. Reutiliza el fichero auxiliar si el tamaño y el
+            mtime de la traza no han cambiado y, si no, lo reconstruye y lo guarda (si se puede escribir)
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -step: se guarda uno de cada step registros
+            -fname: fichero del índice (None para usar el nombre de la traza + PCAP_INDEX_SUFFIX)
+        Retorno: pcap_index_t
+    '''
+    if fname is None:
+        fname = handle.f.name + PCAP_INDEX_SUFFIX
+    st = os.fstat(handle.f.fileno())
+    index = pcap_index_load(fname,st.st_size,st.st_mtime_ns)
+    if index is not None and index.step == step:
+        return index
+    index = pcap_index_build(handle,step)
+    pcap_index_save(index,fname)
+    return index
+
+def _pcap_time_ns(ts):
+    '''
+        Nombre: _pcap_time_ns
+        Descripción: Convierte una marca de tiempo a nanosegundos enteros sin pasar por aritmética de coma flotante (un
+            double solo tiene unos 240 ns de resolución con fechas actuales). Los float se interpretan por su
+            representación decimal más corta (1570739305.69091 es exactamente ese valor) y las fracciones de
+            nanosegundo se redondean hacia arriba, así que "ts >= t" y "ts < t" se conservan al compararlas en ns
+        Argumentos:
+            -ts: tupla (segundos,nanosegundos), o segundos como int, float, decimal.Decimal o fractions.Fraction
+        Retorno: Entero con la marca de tiempo en nanosegundos
+    '''
+    if isinstance(ts,tuple):
+        return ts[0] * 1000000000 + ts[1]
+    if isinstance(ts,float):
+        ts = decimal.Decimal(repr(ts))
+    return math.ceil(fractions.Fraction(ts) * 1000000000)
+
+def _pcap_skip_mmap(handle,off,n,ts=None):
+    '''
+        Nombre: _pcap_skip_mmap
+        Descripción: Avanza desde off hasta n registros, parando antes si se encuentra uno con marca de tiempo >= ts
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -off: desplazamiento de un registro
+            -n: número máximo de registros a saltar
+            -ts: marca de tiempo en ns (None para saltar siempre n registros)
+        Retorno: Desplazamiento del registro alcanzado
+    '''
+    mm = handle.mm
+    unpack_from = handle.record.unpack_from
+    size = len(mm)
+    while n > 0 and off + PCAP_RECORD_HLEN <= size:
+        tv_sec,tv_frac,caplen,length = unpack_from(mm,off)
+        if ts is not None and _pcap_ts_ns(handle,tv_sec,tv_frac) >= ts:
+            break
+        off += PCAP_RECORD_HLEN + caplen
+        n -= 1
+    return off
+
+def pcap_seek_packet_mmap(handle,index,num):
+    '''
+        Nombre: pcap_seek_packet_mmap
+        Descripción: Coloca el manejador en el paquete número num (empezando en 0) usando el índice
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -index: pcap_index_t de la traza
+            -num: número de paquete
+        Retorno: True si el paquete existe o False si num está fuera de la traza (el manejador queda al final)
+    '''
+    if num < 0 or num >= index.packets:
+        handle.offset = len(handle.mm)
+        return False
+    i = num // index.step
+    handle.offset = _pcap_skip_mmap(handle,index.offsets[i],num - i * index.step)
+    return True
+
+def pcap_seek_time_mmap(handle,index,ts):
+    '''
+        Nombre: pcap_seek_time_mmap
+        Descripción: Coloca el manejador en el primer paquete con marca de tiempo >= ts. Si la traza no está en orden
+            cronológico puede quedar antes de algún paquete anterior a ts, nunca después de uno posterior
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -index: pcap_index_t de la traza
+            -ts: marca de tiempo: tupla (segundos,nanosegundos) o segundos como int, float, Decimal o Fraction
+        Retorno: Ninguno
+    '''
+    ns = _pcap_time_ns(ts)
+    i = bisect.bisect_left(index.times,ns)
+    if i == 0:
+        handle.offset = PCAP_FILE_HLEN
+        return
+    #El registro (i-1)*step y los anteriores son < ts: el buscado está entre él y el registro i*step
+    handle.offset = _pcap_skip_mmap(handle,index.offsets[i - 1],index.step,ns)
+
+def pcap_iter_time_mmap(handle,index,start,end):
+    '''
+        Nombre: pcap_iter_time_mmap
+        Descripción: Generador con los paquetes cuya marca de tiempo está en [start,end) sin leer el resto de la traza
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -index: pcap_index_t de la traza
+            -start: marca de tiempo inicial (en los formatos que admite pcap_seek_time_mmap)
+            -end: marca de tiempo final (en los formatos que admite pcap_seek_time_mmap)
+        Retorno: Generador de tuplas (pcap_pkthdr,memoryview)
+    '''
+    pcap_seek_time_mmap(handle,index,start)
+    ns = _pcap_time_ns(end)
+    i = bisect.bisect_left(index.times,ns)
+    limite = index.offsets[i] if i < len(index.offsets) else None
+    mm = handle.mm
+    unpack_from = handle.record.unpack_from
+    for header,data in pcap_iter_mmap(handle,limite):
+        #Se compara con la marca de tiempo completa del registro (header.ts está truncada a microsegundos)
+        tv_sec,tv_frac = unpack_from(mm,handle.offset - header.caplen - PCAP_RECORD_HLEN)[:2]
+        if _pcap_ts_ns(handle,tv_sec,tv_frac) >= ns:
+            handle.offset -= header.caplen + PCAP_RECORD_HLEN
+            return
+        yield header,data
+
+#Procesado en paralelo: la traza se divide en rangos de bytes que empiezan y terminan en el límite de un registro y
+#cada rango se recorre en un proceso distinto con su propio mapeo del fichero.
+PARALLEL_MIN_RANGE = 1 << 20
+
+def pcap_split_mmap(handle,n):
+    '''
+        Nombre: pcap_split_mmap
+        Descripción: Recorre las cabeceras de registro desde la posición actual del manejador (sin tocar los datos
+            de los paquetes) y divide el resto de la traza en n rangos de tamaño parecido
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -n: número de rangos
+        Retorno: Lista de tuplas (inicio,fin) con desplazamientos en el fichero, ordenada y sin huecos
+    '''
+    mm = handle.mm
+    unpack_from = handle.record.unpack_from
+    size = len(mm)
+    off = start = handle.offset
+    paso = max((size - start) // max(n,1),1)
+    corte = start + paso
+    rangos = []
+    while off + PCAP_RECORD_HLEN <= size:
+        caplen = unpack_from(mm,off)[2]
+        if off + PCAP_RECORD_HLEN + caplen > size:
+            break
+        off += PCAP_RECORD_HLEN + caplen
+        if off >= corte and len(rangos) < n - 1:
+            rangos.append((start,off))
+            start = off
+            corte = off + paso
+    if off > start or not rangos:
+        rangos.append((start,off))
+    return rangos
+
+def _pcap_range_worker(args):
+    '''
+        Nombre: _pcap_range_worker
+        Descripción: Recorre un rango de la traza en un proceso del pool llamando a callback_fun por cada paquete
+        Argumentos:
+            -args: tupla (fichero,inicio,fin,callback_fun,user,end_fun)
+        Retorno: user tras procesar el rango
+    '''
+    fname,start,end,callback_fun,user,end_fun = args
+    errbuf = bytearray()
+    handle = pcap_open_offline_mmap(fname,errbuf)
+    if handle is None:
+        raise OSError(errbuf.decode('utf-8','replace'))
+    handle.offset = start
+    for header,data in pcap_iter_mmap(handle,end):
+        callback_fun(user,header,data)
+    data = None
+    pcap_close_mmap(handle)
+    if end_fun is not None:
+        end_fun(user)
+    return user
+
+def pcap_loop_parallel(handle,callback_fun,user,merge_fun=None,workers=None,end_fun=None):
+    '''
+        Nombre: pcap_loop_parallel
+        Descripción: Equivalente a pcap_loop_mmap(handle,-1,callback_fun,user) que reparte el resto de la traza entre
+            varios procesos. Cada proceso recibe una copia de user, llama a callback_fun(user,header,data) por cada
+            paquete de su rango y devuelve su copia. callback_fun y user deben poder serializarse con pickle (funciones
+            definidas a nivel de módulo, sin ficheros ni sockets abiertos)
+        Argumentos:
+            -handle: manejador pcap_mmap_t
+            -callback_fun: función de callback
+            -user: datos de usuario (acumulador) que se copian a cada proceso
+            -merge_fun: función merge_fun(user,parcial) que acumula en user el resultado de un rango. Se llama en el
+            proceso actual y en el orden de los rangos dentro de la traza, así que el resultado es determinista
+            -workers: número de procesos (None para usar todos los núcleos)
+            -end_fun: función end_fun(user) que se llama en cada proceso al terminar su rango, antes de devolver su
+            copia (por ejemplo para cerrar los ficheros que haya abierto la función de callback)
+        Retorno: user si se indica merge_fun, o la lista de resultados parciales en el orden de la traza
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1,min(workers,(len(handle.mm) - handle.offset) // PARALLEL_MIN_RANGE))
+    rangos = pcap_split_mmap(handle,workers)
+    tareas = [(handle.f.name,inicio,fin,callback_fun,copy.deepcopy(user),end_fun) for inicio,fin in rangos]
+    if len(tareas) == 1:
+        parciales = [_pcap_range_worker(tareas[0])]
+    else:
+        with multiprocessing.Pool(len(tareas)) as pool:
+            parciales = pool.map(_pcap_range_worker,tareas,chunksize=1)
+    handle.offset = rangos[-1][1]
+    if merge_fun is None:
+        return parciales
+    for parcial in parciales:
+        merge_fun(user,parcial)
+    return user
+
+
+#Entrega de paquetes por lotes: el trampolín de C copia cada paquete en un buffer preasignado y la función
+#de usuario se invoca una sola vez por lote (N paquetes o T milisegundos).
+PCAP_HANDLER = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_char_p,ctypes.POINTER(pcappkthdr),ctypes.POINTER(ctypes.c_uint8))
+BATCH_SIZE = 64
+BATCH_TIMEOUT_MS = 10
+
+class pcap_batch():
+    '''
+        Lote de paquetes. Los datos de los count paquetes están contiguos en buf y se describen con las tablas
+        offsets, caplens, lens, tv_sec y tv_usec. El buffer se reutiliza entre lotes, por lo que la función de
+        callback debe copiar lo que quiera conservar antes de retornar.
+    '''
+    def __init__(self,maxpkts,snaplen,timeout_ms=BATCH_TIMEOUT_MS):
+        self.maxpkts = maxpkts
+        self.timeout_ms = timeout_ms
+        self.snaplen = snaplen
+        self.buf = bytearray(maxpkts*snaplen)
+        self.view = memoryview(self.buf)
+        self.base = ctypes.addressof((ctypes.c_char*len(self.buf)).from_buffer(self.buf))
+        self.offsets = array.array('I',bytes(4*maxpkts))
+        self.caplens = array.array('I',bytes(4*maxpkts))
+        self.lens = array.array('I',bytes(4*maxpkts))
+        self.tv_sec = array.array('q',bytes(8*maxpkts))
+        self.tv_usec = array.array('q',bytes(8*maxpkts))
+        self.count = 0
+        self.used = 0
+        self.first = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def data(self,i):
+        off = self.offsets[i]
+        return self.view[off:off+self.caplens[i]]
+
+    def header(self,i):
+        header = pcap_pkthdr()
+        header.len = self.lens[i]
+        header.caplen = self.caplens[i]
+        header.ts = timeval(self.tv_sec[i],self.tv_usec[i])
+        return header
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.header(i),self.data(i)
+
+    def add(self,h,data):
+        caplen = min(h[0].caplen,self.snaplen)
+        i = self.count
+        if i == 0:
+            self.first = time.monotonic()
+        ctypes.memmove(self.base+self.used,data,caplen)
+        self.offsets[i] = self.used
+        self.caplens[i] = caplen
+        self.lens[i] = h[0].len
+        self.tv_sec[i] = h[0].tv_sec
+        self.tv_usec[i] = h[0].tv_usec
+        self.used += caplen
+        self.count = i+1
+
+    def reset(self):
+        self.count = 0
+        self.used = 0
+
+def _batch_handler(batch,callback_fun,user):
+    def handler(us,h,data):
+        batch.add(h,data)
+        if batch.count == batch.maxpkts or (time.monotonic()-batch.first)*1000 >= batch.timeout_ms:
+            _flush_batch(batch,callback_fun,user)
+    return PCAP_HANDLER(handler)
+
+def _flush_batch(batch,callback_fun,user):
+    if batch.count > 0:
+        try:
+            callback_fun(user,batch)
+        finally:
+            batch.reset()
+
+def pcap_loop_batch(handle,cnt,callback_fun,user,batch_size=BATCH_SIZE,timeout_ms=BATCH_TIMEOUT_MS,snaplen=65535):
+    '''
+        Nombre: pcap_loop_batch
+        Descripción: Equivalente a pcap_loop que entrega los paquetes por lotes. Se llama a callback_fun(user,batch)
+            cada vez que se acumulan batch_size paquetes o han pasado timeout_ms desde el primer paquete del lote,
+            y una última vez con los paquetes pendientes al terminar el bucle.
+        Argumentos:
+            -handle: manejador de pcap
+            -cnt: número de paquetes a procesar (-1 para infinitos)
+            -callback_fun: función de callback con prototipo funcion(user,batch), siendo batch un pcap_batch
+            -user: datos de usuario
+            -batch_size: número máximo de paquetes por lote
+            -timeout_ms: tiempo máximo (en milisegundos) que un paquete puede esperar en el lote
+            -snaplen: tamaño máximo de cada paquete dentro del lote
+        Retorno: Valor devuelto por pcap_loop
+    '''
+    batch = pcap_batch(batch_size,snaplen,timeout_ms)
+    cf = _batch_handler(batch,callback_fun,user)
+    pl = pcap.pcap_loop
+    pl.restype = ctypes.c_int
+    ret = pl(handle,ctypes.c_int(cnt),cf,ctypes.c_void_p(user))
+    _flush_batch(batch,callback_fun,user)
+    return ret
+
+def pcap_dispatch_batch(handle,cnt,callback_fun,user,batch):
+    '''
+        Nombre: pcap_dispatch_batch
+        Descripción: Equivalente a pcap_dispatch que acumula los paquetes en el lote batch (creado por el llamante y
+            reutilizado entre llamadas). El lote se entrega a callback_fun(user,batch) cuando se llena o cuando ha
+            pasado batch.timeout_ms desde su primer paquete, comprobándose esto último también al volver de
+            pcap_dispatch aunque no hayan llegado paquetes (timeout de lectura de pcap_open_live).
+        Argumentos:
+            -handle: manejador de pcap
+            -cnt: número máximo de paquetes a procesar en esta llamada (-1 para todos los del buffer)
+            -callback_fun: función de callback con prototipo funcion(user,batch)
+            -user: datos de usuario
+            -batch: lote pcap_batch a rellenar
+        Retorno: Valor devuelto por pcap_dispatch
+    '''
+    cf = _batch_handler(batch,callback_fun,user)
+    pd = pcap.pcap_dispatch
+    pd.restype = ctypes.c_int
+    ret = pd(handle,ctypes.c_int(cnt),cf,ctypes.c_void_p(user))
+    if ret < 0 or (batch.count > 0 and (time.monotonic()-batch.first)*1000 >= batch.timeout_ms):
+        _flush_batch(batch,callback_fun,user)
+    return ret